@@ -106,7 +106,7 @@ def main():
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image('data.nii').dim
+    nx, ny, nz, nt, px, py, pz, pt = Image('data.nii', lazy=True).dim
     sct.printv('.. '+str(nx)+' x '+str(ny)+' x '+str(nz), verbose)
 
     # upsample data
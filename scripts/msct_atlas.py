@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_atlas
+# Sparse representation of an atlas of tracts (e.g., white matter atlas of the template). Only a small fraction of the
+# voxels of the volume belongs to a tract, so the weights of all tracts are stored in a sparse matrix
+# (nb_tracts x nb_voxels) defined over the union of non-null voxels, together with the (flat) index of these voxels in
+# the volume.
+#
+# Example:
+#   atlas = SparseAtlas.load(['label/atlas/PAM50_atlas_00.nii.gz', 'label/atlas/PAM50_atlas_01.nii.gz'])
+#   atlas = atlas.threshold(0.5)
+#   data1d = atlas.sample(data)  # metric values in the voxels of the atlas
+#   weights = atlas.weights  # scipy.sparse.csr_matrix (nb_tracts x nb_voxels)
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2016 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Author: Julien Cohen-Adad
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import numpy as np
+from scipy import sparse
+import sct_utils as sct
+
+
+class SparseAtlas(object):
+    def __init__(self, weights, index, shape):
+        """
+        :param weights: sparse matrix (nb_tracts x nb_vox) of the weights of each tract in each voxel
+        :param index: array (nb_vox) of flat indexes (C order) of the voxels in the volume, sorted
+        :param shape: shape of the volume
+        """
+        self.weights = sparse.csr_matrix(weights)
+        self.index = index
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return self.weights.shape[0]
+
+    @classmethod
+    def from_volumes(cls, list_data):
+        """
+        Build the atlas from tract volumes. Volumes are read one at a time, so list_data can be a generator (only one
+        dense volume is in memory).
+        :param list_data: iterable of numpy arrays of the same shape
+        :return: SparseAtlas
+        """
+        rows, index, values = [], [], []
+        shape = None
+        for i_tract, data in enumerate(list_data):
+            if shape is None:
+                shape = data.shape
+            elif data.shape != shape:
+                sct.printv('ERROR: All tracts of the atlas should have the same dimensions.', 1, 'error')
+            data = np.asarray(data).ravel()
+            ind = np.flatnonzero(data)
+            rows.append(np.ones(len(ind), dtype=int) * i_tract)
+            index.append(ind)
+            values.append(data[ind].astype(np.float64))
+        nb_tracts = len(rows)
+        rows, index, values = np.concatenate(rows), np.concatenate(index), np.concatenate(values)
+        # union of non-null voxels of all tracts, and column of each value in this union
+        index_union, cols = np.unique(index, return_inverse=True)
+        weights = sparse.coo_matrix((values, (rows, cols)), shape=(nb_tracts, len(index_union)))
+        return cls(weights, index_union, shape)
+
+    @classmethod
+    def load(cls, list_fname, orientation='', verbose=1):
+        """
+        Load the atlas from tract files.
+        :param list_fname: list of file names, one per tract
+        :param orientation: if specified (e.g., 'RPI'), tracts are reoriented in memory
+        :return: SparseAtlas
+        """
+        from msct_image import Image
+        from sct_image import reorient
+
+        def read_tracts():
+            for fname in list_fname:
+                im = Image(fname, verbose=verbose)
+                if orientation:
+                    im = reorient(im, orientation)
+                yield im.data
+        return cls.from_volumes(read_tracts())
+
+    def sample(self, data):
+        """
+        Get the values of a volume in the voxels of the atlas.
+        :param data: numpy array with the same shape as the atlas, or with additional leading dimensions (e.g., several
+        metrics stacked along the first dimension)
+        :return: array (..., nb_vox)
+        """
+        ndim = len(self.shape)
+        if data.shape[-ndim:] != self.shape:
+            sct.printv('ERROR: Data and atlas DO NOT HAVE SAME DIMENSIONS: '+str(data.shape)+' vs. '+str(self.shape), 1, 'error')
+        return np.take(data.reshape(data.shape[:-ndim] + (-1,)), self.index, axis=-1)
+
+    def get_dense(self, i_tract):
+        """
+        :return: dense volume of tract i_tract
+        """
+        data = np.zeros(self.shape, dtype=np.float64)
+        data.flat[self.index] = self.weights[i_tract].toarray().ravel()
+        return data
+
+    def get_sum(self):
+        """
+        :return: sum of the weights of each tract, i.e. the fractional volume of each tract (in number of voxels)
+        """
+        return np.asarray(self.weights.sum(axis=1)).ravel()
+
+    def _new(self, weights):
+        weights = sparse.csr_matrix(weights)
+        weights.eliminate_zeros()
+        return SparseAtlas(weights, self.index, self.shape)
+
+    def binarize(self, threshold=0.5):
+        """
+        :return: SparseAtlas with weights set to 1 where weight >= threshold, 0 elsewhere
+        """
+        weights = self.weights.copy()
+        weights.data = (weights.data >= threshold).astype(np.float64)
+        return self._new(weights)
+
+    def threshold(self, threshold=0.5):
+        """
+        :return: SparseAtlas with weights lower than threshold set to 0
+        """
+        weights = self.weights.copy()
+        weights.data[weights.data < threshold] = 0
+        return self._new(weights)
+
+    def combine(self, list_ids, keep_other_tracts=False):
+        """
+        Sum tracts together.
+        :param list_ids: list of tract indexes to sum
+        :param keep_other_tracts: if True, other tracts are kept after the summed tract (first position), otherwise
+        the output atlas only contains the summed tract.
+        :return: SparseAtlas
+        """
+        weights = self.weights
+        weights_sum = sparse.csr_matrix(weights[list_ids].sum(axis=0))
+        if keep_other_tracts:
+            ids_other = [i for i in range(len(self)) if i not in list_ids]
+            weights_sum = sparse.vstack([weights_sum, weights[ids_other]])
+        return self._new(weights_sum)
+
+    def select_slices(self, slices_list):
+        """
+        Keep slices of the last dimension, in the order of slices_list (same as data[..., slices_list]).
+        :param slices_list: list of slice indexes
+        :return: SparseAtlas with shape (..., len(slices_list))
+        """
+        nz = self.shape[-1]
+        index_xy, index_z = np.divmod(self.index, nz)
+        cols, index = [], []
+        for i_slice, z in enumerate(slices_list):
+            ind = np.flatnonzero(index_z == z)
+            cols.append(ind)
+            index.append(index_xy[ind] * len(slices_list) + i_slice)
+        cols, index = np.concatenate(cols).astype(int), np.concatenate(index).astype(int)
+        order = np.argsort(index)
+        return SparseAtlas(self.weights[:, cols[order]], index[order], self.shape[:-1] + (len(slices_list),))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# msct_cache
+# Persistent, content-addressed cache of files (e.g., warping fields). Each entry is a folder named after a hash key,
+# which is computed from the content the files depend on. When the cache exceeds its maximum size, least recently
+# used entries are removed.
+#
+# Example:
+#   cache = FileCache('~/.sct_cache/straightening', max_size=get_max_size('SCT_STRAIGHTENING_CACHE_SIZE'))
+#   key = cache.compute_key([data_centerline, affine, 'nurbs', 2.0])
+#   if not cache.get(key, ['warp.nii.gz']):
+#       ...  # compute warp.nii.gz
+#       cache.put(key, ['warp.nii.gz'])
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2016 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Author: Benjamin De Leener
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import os
+import shutil
+import time
+import hashlib
+import numpy as np
+import sct_utils as sct
+
+# default maximum size of a cache (MB)
+MAX_SIZE = 2000
+
+
+def get_max_size(name_env, default=MAX_SIZE):
+    """
+    Maximum size of a cache (MB), set by the environment variable name_env if it is defined.
+    :param name_env: name of the environment variable (size in MB)
+    :return: float
+    """
+    value = os.environ.get(name_env, '')
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        sct.printv('ERROR: the environment variable '+name_env+' should be a size in MB (found: '+value+').', 1, 'error')
+
+
+class FileCache(object):
+    def __init__(self, path_cache, max_size=MAX_SIZE, verbose=1):
+        """
+        :param path_cache: folder of the cache (created if it does not exist)
+        :param max_size: maximum size of the cache, in MB
+        """
+        self.path_cache = os.path.abspath(os.path.expanduser(path_cache))
+        self.max_size = max_size
+        self.verbose = verbose
+        if not os.path.isdir(self.path_cache):
+            os.makedirs(self.path_cache)
+
+    @staticmethod
+    def compute_key(list_items):
+        """
+        Compute a hash key from a list of items (numpy arrays, numbers or strings).
+        :return: hexadecimal string
+        """
+        sha = hashlib.sha1()
+        for item in list_items:
+            if isinstance(item, np.ndarray):
+                sha.update(str(item.dtype) + str(item.shape))
+                sha.update(np.ascontiguousarray(item).tostring())
+            else:
+                sha.update(repr(item))
+            # separator between items
+            sha.update('|')
+        return sha.hexdigest()
+
+    def get(self, key, list_fname, path_output='./'):
+        """
+        Copy files of a cache entry to path_output.
+        :param key: hash key (see compute_key())
+        :param list_fname: list of file names stored in the entry
+        :return: True if the entry exists (cache hit), False otherwise
+        """
+        path_entry = self.get_path(key, list_fname)
+        if not path_entry:
+            return False
+        for fname in list_fname:
+            shutil.copy(os.path.join(path_entry, fname), os.path.join(path_output, fname))
+        return True
+
+    def get_path(self, key, list_fname):
+        """
+        Get the folder of a cache entry, without copying its files (e.g., to memory-map them).
+        :param key: hash key (see compute_key())
+        :param list_fname: list of file names stored in the entry
+        :return: path of the entry if it exists (cache hit), '' otherwise
+        """
+        path_entry = os.path.join(self.path_cache, key)
+        if not all([os.path.isfile(os.path.join(path_entry, fname)) for fname in list_fname]):
+            return ''
+        # update time of last use
+        os.utime(path_entry, None)
+        sct.printv('.. cache hit: '+path_entry, self.verbose)
+        return path_entry
+
+    def put(self, key, list_fname, path_input='./'):
+        """
+        Store files in a cache entry, then remove least recently used entries if the cache is too large.
+        :param key: hash key (see compute_key())
+        :param list_fname: list of files to store
+        """
+        path_entry = os.path.join(self.path_cache, key)
+        # files are first copied in a temporary folder, so that an interrupted copy does not create an incomplete entry
+        path_tmp = path_entry + '.tmp' + str(os.getpid())
+        if os.path.isdir(path_tmp):
+            shutil.rmtree(path_tmp)
+        os.makedirs(path_tmp)
+        for fname in list_fname:
+            shutil.copy(os.path.join(path_input, fname), os.path.join(path_tmp, fname))
+        if os.path.isdir(path_entry):
+            shutil.rmtree(path_entry)
+        os.rename(path_tmp, path_entry)
+        sct.printv('.. stored in cache: '+path_entry, self.verbose)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the size of the cache is below max_size.
+        """
+        list_entry = []
+        for key in os.listdir(self.path_cache):
+            path_entry = os.path.join(self.path_cache, key)
+            if os.path.isdir(path_entry) and '.tmp' not in key:
+                size = sum([os.path.getsize(os.path.join(path_entry, fname)) for fname in os.listdir(path_entry)])
+                list_entry.append((os.path.getmtime(path_entry), size, path_entry))
+        size_total = sum([entry[1] for entry in list_entry])
+        # oldest first
+        for time_entry, size, path_entry in sorted(list_entry):
+            if size_total <= self.max_size * 1024 ** 2:
+                break
+            sct.printv('.. remove from cache (last used: '+time.ctime(time_entry)+'): '+path_entry, self.verbose)
+            shutil.rmtree(path_entry, ignore_errors=True)
+            size_total -= size
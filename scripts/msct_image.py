@@ -196,15 +196,18 @@ def decompose_affine_transform(A44):
 
 class Image(object):
     """
-
+    Image(fname) loads header and data from file.
+    Image(fname, lazy=True) only loads the header: data are memory-mapped (.nii) or decoded (.nii.gz) on first access
+    to Image.data. Use it when only dim, hdr or orientation are needed.
     """
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1, lazy=False):
         from sct_utils import extract_fname
         from nibabel import AnalyzeHeader
 
         # initialization of all parameters
         self.im_file = None
-        self.data = None
+        self._data = None
+        self._data_pending = False  # True if data are not read from im_file yet (lazy mode)
         self.orientation = None
         self.absolutepath = ""
         self.path = ""
@@ -221,7 +224,7 @@ class Image(object):
 
         # load an image from file
         if type(param) is str:
-            self.loadFromPath(param, verbose)
+            self.loadFromPath(param, verbose, lazy=lazy)
             self.compute_transform_matrix()
         # copy constructor
         elif isinstance(param, type(self)):
@@ -245,6 +248,18 @@ class Image(object):
         else:
             raise TypeError('Image constructor takes at least one argument.')
 
+    @property
+    def data(self):
+        if self._data_pending:
+            self._data = self.im_file.get_data()
+            self._data_pending = False
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._data_pending = False
+
     def __deepcopy__(self, memo):
         from copy import deepcopy
         return type(self)(deepcopy(self.data, memo), deepcopy(self.hdr, memo), deepcopy(self.orientation, memo), deepcopy(self.absolutepath, memo), deepcopy(self.dim, memo))
@@ -263,10 +278,12 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path, verbose):
+    def loadFromPath(self, path, verbose, lazy=False):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param lazy: if True, only the header is read. Data are read on first access to self.data: .nii files are
+        memory-mapped (copy-on-write, i.e. modifying self.data does not modify the file), .nii.gz files are decoded.
         :return:
         """
         from nibabel import load, spatialimages
@@ -275,10 +292,17 @@ class Image(object):
 
         # check_file_exist(path, verbose=verbose)
         try:
-            self.im_file = load(path)
+            if lazy:
+                self.im_file = load(path, mmap='c')
+            else:
+                self.im_file = load(path)
         except spatialimages.ImageFileError:
             printv('Error: make sure ' + path + ' is an image.', 1, 'error')
-        self.data = self.im_file.get_data()
+        if lazy:
+            self._data = None
+            self._data_pending = True
+        else:
+            self.data = self.im_file.get_data()
         self.hdr = self.im_file.get_header()
         self.orientation = get_orientation(self)
         self.absolutepath = path
@@ -426,85 +450,65 @@ class Image(object):
             slices.append(slc.flatten())
         return slices
 
-    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, coordValue=False):
+    def getNonZeroCoordinatesArray(self, sorting=None, reverse_coord=False):
         """
-        This function return all the non-zero coordinates that the image contains.
-        Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
-        If reverse_coord is True, coordinate are sorted from larger to smaller.
+        This function return all the non-zero coordinates that the image contains, as a record array with fields x, y,
+        z and value (z is 0 for 2D images). Vectorized equivalent of getNonZeroCoordinates().
+        Coordinates can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z'
+        or sorting='value'. Sorting is stable. If reverse_coord is True, coordinate are sorted from larger to smaller.
+        Example:
+            coord = im.getNonZeroCoordinatesArray(sorting='z')
+            im.data[coord.x, coord.y, coord.z] = 0
+        :return: numpy.recarray of length N
         """
-        from msct_types import Coordinate
         from sct_utils import printv
-        n_dim = 1
-        if self.dim[3] == 1:
-            n_dim = 3
-        else:
-            n_dim = 4
-        if self.dim[2] == 1:
-            n_dim = 2
+        ind = (self.data > 0).nonzero()
+        if len(ind) == 2:
+            ind = ind + (np.zeros(ind[0].shape, dtype=ind[0].dtype), )
+        elif len(ind) != 3:
+            printv('ERROR: getNonZeroCoordinates only works on 2D and 3D images.', 1, 'error')
+        list_coordinates = np.rec.fromarrays([ind[0], ind[1], ind[2], self.data[ind[:self.data.ndim]]],
+                                             names='x,y,z,value')
 
-        try:
-            if n_dim == 3:
-                X, Y, Z = (self.data > 0).nonzero()
-                list_coordinates = [Coordinate([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
-            elif n_dim == 2:
-                X, Y = (self.data > 0).nonzero()
-                list_coordinates = [Coordinate([X[i], Y[i], self.data[X[i], Y[i]]]) for i in range(0, len(X))]
-        except Exception, e:
-            print 'ERROR', e
-            printv('ERROR: Exception ' + str(e) + ' caught while geting non Zeros coordinates', 1, 'error')
-
-        if coordValue:
-            from msct_types import CoordinateValue
-            if n_dim == 3:
-                list_coordinates = [CoordinateValue([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
-            else:
-                list_coordinates = [CoordinateValue([X[i], Y[i], self.data[X[i], Y[i]]]) for i in range(0, len(X))]
-        else:
-            from msct_types import Coordinate
-            if n_dim == 3:
-                list_coordinates = [Coordinate([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
-            else:
-                list_coordinates = [Coordinate([X[i], Y[i], self.data[X[i], Y[i]]]) for i in range(0, len(X))]
         if sorting is not None:
             if reverse_coord not in [True, False]:
                 raise ValueError('reverse_coord parameter must be a boolean')
-
-            if sorting == 'x':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.x, reverse=reverse_coord)
-            elif sorting == 'y':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.y, reverse=reverse_coord)
-            elif sorting == 'z':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.z, reverse=reverse_coord)
-            elif sorting == 'value':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.value, reverse=reverse_coord)
-            else:
+            if sorting not in ['x', 'y', 'z', 'value']:
                 raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
+            key = list_coordinates[sorting]
+            if reverse_coord:
+                # same order as sorted(reverse=True): equal elements keep their original order
+                order = (len(key) - 1 - np.argsort(key[::-1], kind='mergesort'))[::-1]
+            else:
+                order = np.argsort(key, kind='mergesort')
+            list_coordinates = list_coordinates[order]
 
         return list_coordinates
 
+    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, coordValue=False):
+        """
+        This function return all the non-zero coordinates that the image contains.
+        Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
+        If reverse_coord is True, coordinate are sorted from larger to smaller.
+        N.B. this function creates one Coordinate object per voxel. Use getNonZeroCoordinatesArray() on large images.
+        """
+        from msct_types import Coordinate, CoordinateValue
+        coord = self.getNonZeroCoordinatesArray(sorting=sorting, reverse_coord=reverse_coord)
+        coord_class = CoordinateValue if coordValue else Coordinate
+        if len(self.data.shape) == 2:
+            list_coordinates = [coord_class([x, y, value]) for x, y, value in zip(coord.x, coord.y, coord.value)]
+        else:
+            list_coordinates = [coord_class([x, y, z, value]) for x, y, z, value in zip(coord.x, coord.y, coord.z, coord.value)]
+        return list_coordinates
+
     def getCoordinatesAveragedByValue(self):
         """
         This function computes the mean coordinate of group of labels in the image. This is especially useful for label's images.
         :return: list of coordinates that represent the center of mass of each group of value.
         """
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
-
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        averaged_coordinates = []
-        for value, list_coord in groups.iteritems():
-            averaged_coordinates.append(sum(list_coord) / float(len(list_coord)))
-
-        averaged_coordinates = sorted(averaged_coordinates, key=lambda obj: obj.value, reverse=False)
-        return averaged_coordinates
+        from msct_types import Coordinate
+        coord = average_coordinates_by_value(self.getNonZeroCoordinatesArray())
+        return [Coordinate([x, y, z, value]) for x, y, z, value in zip(coord.x, coord.y, coord.z, coord.value)]
 
     # crop the image in order to keep only voxels in the mask, therefore the mask's slices must be squares or rectangles of the same size
     # orientation must be IRP to be able to go trough slices as first dimension
@@ -1062,6 +1066,30 @@ class Image(object):
 
 
 
+class ImageMetadata(object):
+    """
+    Metadata of an image file, read from the header only (voxel data are never read). Use it instead of Image when
+    only shape, voxel size, affine or orientation are needed.
+    Example:
+        meta = ImageMetadata('t2.nii.gz')
+        nx, ny, nz, nt, px, py, pz, pt = meta.dim
+    """
+    def __init__(self, fname):
+        from nibabel import load, spatialimages
+        from sct_utils import printv
+        from sct_image import get_orientation
+        try:
+            self.hdr = load(fname).header
+        except spatialimages.ImageFileError:
+            printv('Error: make sure ' + fname + ' is an image.', 1, 'error')
+        self.absolutepath = fname
+        self.shape = self.hdr.get_data_shape()
+        self.pixdim = self.hdr.get_zooms()
+        self.affine = self.hdr.get_best_affine()
+        self.dim = get_dimension(self)
+        self.orientation = get_orientation(self)
+
+
 def find_zmin_zmax(fname):
     import sct_utils as sct
     # crop image
@@ -1071,9 +1099,38 @@ def find_zmin_zmax(fname):
     return int(zmin), int(zmax)
 
 
+def average_coordinates_by_value(coord):
+    """
+    Compute the mean coordinate of each group of voxels that have the same value.
+    :param coord: record array, as returned by Image.getNonZeroCoordinatesArray()
+    :return: record array with fields x, y, z (float) and value, sorted by value
+    """
+    values, inverse = np.unique(coord.value, return_inverse=True)
+    count = np.bincount(inverse).astype(float)
+    return np.rec.fromarrays([np.bincount(inverse, weights=coord.x) / count,
+                              np.bincount(inverse, weights=coord.y) / count,
+                              np.bincount(inverse, weights=coord.z) / count,
+                              values], names='x,y,z,value')
+
+
+def average_coordinates_by_slice(coord):
+    """
+    Compute the center of mass of non-zero voxels in each z slice, weighted by voxel value.
+    :param coord: record array, as returned by Image.getNonZeroCoordinatesArray()
+    :return: z (sorted), x_mean, y_mean: numpy arrays of the same length
+    """
+    z, inverse = np.unique(coord.z, return_inverse=True)
+    weights = coord.value.astype(float)
+    sum_weights = np.bincount(inverse, weights=weights)
+    x_mean = np.bincount(inverse, weights=coord.x * weights) / sum_weights
+    y_mean = np.bincount(inverse, weights=coord.y * weights) / sum_weights
+    return z, x_mean, y_mean
+
+
 def get_dimension(im_file, verbose=1):
     """
-    Get dimension from nibabel object. Manages 2D, 3D or 4D images.
+    Get dimension from nibabel object, Image, ImageMetadata or file name (in which case only the header is read).
+    Manages 2D, 3D or 4D images.
     :return: nx, ny, nz, nt, px, py, pz, pt
     """
     import nibabel.nifti1
@@ -1082,8 +1139,10 @@ def get_dimension(im_file, verbose=1):
     nx, ny, nz, nt, px, py, pz, pt = 1, 1, 1, 1, 1, 1, 1, 1
     if type(im_file) is nibabel.nifti1.Nifti1Image:
         header = im_file.header
-    elif type(im_file) is Image:
+    elif type(im_file) in [Image, ImageMetadata]:
         header = im_file.hdr
+    elif isinstance(im_file, str):
+        header = nibabel.load(im_file).header
     else:
         header = None
         sct.printv('WARNING: the provided image file isn\'t a nibabel.nifti1.Nifti1Image instance nor a msct_image.Image instance', verbose, 'warning')
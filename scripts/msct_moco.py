@@ -20,11 +20,19 @@
 
 import os
 import sys
+import shutil
 import commands
 import numpy as np
 import sct_utils as sct
 from msct_image import Image
 from sct_image import split_data
+from sct_apply_transfo import Transform
+
+# file of motion parameters in the mat folder (see MotionParameters)
+FILE_PARAMS = 'moco_params.npz'
+
+# parameters of register() in worker processes, set by init_moco_worker() (see register_volumes())
+moco_param = None
 
 
 #=======================================================================================================================
@@ -81,30 +89,50 @@ def moco(param):
 
     # Motion correction: initialization
     index = np.arange(nt)
-    file_data_splitT_num = []
-    file_data_splitT_moco_num = []
+    file_data_splitT_num = [file_data_splitT + str(it).zfill(4) for it in index]
+    file_data_splitT_moco_num = [file_data + suffix + '_T' + str(it).zfill(4) for it in index]
+    file_mat = [folder_mat + 'mat.T' + str(it) for it in index]
     failed_transfo = [0 for i in range(nt)]
-    file_mat = [[] for i in range(nt)]
+
+    # generate warping fields from stored motion parameters
+    if todo == 'apply':
+        sct.printv('\nGenerate warping fields...', verbose)
+        params = MotionParameters.load(folder_mat + FILE_PARAMS)
+        if params.translations.shape[0] != nt:
+            sct.printv('\nERROR in '+os.path.basename(__file__)+': Number of volumes in '+folder_mat+FILE_PARAMS+' ('+str(params.translations.shape[0])+') and in data ('+str(nt)+') are not the same.\n', 1, 'error')
+        for it in index:
+            params.write_warp(it, file_mat[it]+'Warp.nii.gz')
+
+    # With iterative averaging, the target changes after each of the first volumes, which are therefore registered
+    # sequentially. Once the target is fixed, the remaining volumes are registered in parallel.
+    if param.iterative_averaging and todo != 'apply':
+        nb_sequential = min(nt, 10)
+    else:
+        nb_sequential = 0
+    im_target = Image(file_target+ext)
+    data_target = im_target.data.astype(np.float64)
 
     # Motion correction: Loop across T
-    for indice_index in range(nt):
+    for indice_index in range(nb_sequential):
 
-        # create indices and display stuff
+        # display stuff
         it = index[indice_index]
-        file_data_splitT_num.append(file_data_splitT + str(it).zfill(4))
-        file_data_splitT_moco_num.append(file_data + suffix + '_T' + str(it).zfill(4))
         sct.printv(('\nVolume '+str((it))+'/'+str(nt-1)+':'), verbose)
-        file_mat[it] = folder_mat + 'mat.T' + str(it)
 
         # run 3D registration
         failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
 
         # average registered volume with target image
         # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
-        if param.iterative_averaging and indice_index < 10 and failed_transfo[it] == 0:
-            sct.run('sct_maths -i '+file_target+ext+' -mul '+str(indice_index+1)+' -o '+file_target+ext)
-            sct.run('sct_maths -i '+file_target+ext+' -add '+file_data_splitT_moco_num[it]+ext+' -o '+file_target+ext)
-            sct.run('sct_maths -i '+file_target+ext+' -div '+str(indice_index+2)+' -o '+file_target+ext)
+        if failed_transfo[it] == 0:
+            data_target = (data_target * (indice_index+1) + Image(file_data_splitT_moco_num[it]+ext).data) / (indice_index+2)
+            im_target.data = data_target
+            im_target.save(verbose=0)
+
+    # register remaining volumes (target is fixed)
+    list_args = [(i, file_data_splitT_num[i], file_target, file_mat[i], file_data_splitT_moco_num[i]) for i in index[nb_sequential:]]
+    for it, failed in register_volumes(param, list_args):
+        failed_transfo[it] = failed
 
     # Replace failed transformation with the closest good one
     sct.printv(('\nReplace failed transformations...'), verbose)
@@ -116,14 +144,29 @@ def moco(param):
             index_good = abs_dist.index(min(abs_dist))
             sct.printv('  transfo #'+str(fT[it])+' --> use transfo #'+str(gT[index_good]), verbose)
             # copy transformation
-            sct.run('cp '+file_mat[gT[index_good]]+'Warp.nii.gz'+' '+file_mat[fT[it]]+'Warp.nii.gz')
+            shutil.copy(file_mat[gT[index_good]]+'Warp.nii.gz', file_mat[fT[it]]+'Warp.nii.gz')
             # apply transformation
-            sct.run('sct_apply_transfo -i '+file_data_splitT_num[fT[it]]+'.nii -d '+file_target+'.nii -w '+file_mat[fT[it]]+'Warp.nii.gz'+' -o '+file_data_splitT_moco_num[fT[it]]+'.nii'+' -x '+param.interp, verbose)
+            Transform(input_filename=file_data_splitT_num[fT[it]]+ext, warp=[file_mat[fT[it]]+'Warp.nii.gz'],
+                      fname_dest=file_target+ext, output_filename=file_data_splitT_moco_num[fT[it]]+ext,
+                      interp=param.interp, verbose=0).apply()
         else:
             # exit program if no transformation exists.
             sct.printv('\nERROR in '+os.path.basename(__file__)+': No good transformation exist. Exit program.\n', verbose, 'error')
             sys.exit(2)
 
+    # store motion parameters of all volumes in a single file
+    if todo != 'apply':
+        sct.printv('\nStore motion parameters...', verbose)
+        params = MotionParameters.read_warps([file_mat[it]+'Warp.nii.gz' for it in index])
+        params.failed[fT] = True
+        params.save(folder_mat + FILE_PARAMS)
+
+    # remove warping fields
+    for it in index:
+        for fname in [file_mat[it]+'Warp.nii.gz', file_mat[it]+'InverseWarp.nii.gz']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
     # Merge data along T
     file_data_moco = file_data+suffix
     if todo != 'estimate':
@@ -144,6 +187,41 @@ def moco(param):
     sct.run('rm target.nii')
 
 
+#=======================================================================================================================
+# register_volumes: registration of several volumes to the same target, in parallel if param.cpu_number > 1
+#=======================================================================================================================
+def register_volumes(param, list_args):
+    """
+    :param list_args: list of (index, file_src, file_dest, file_mat, file_out). file_dest must not change until all
+    volumes are registered.
+    :return: list of (index, failed_transfo), in the order of list_args
+    """
+    if param.cpu_number > 1 and len(list_args) > 1:
+        list_failed = {}
+        with sct.process_pool(min(param.cpu_number, len(list_args)), initializer=init_moco_worker, initargs=(param,)) as pool:
+            for it, failed in pool.imap_unordered(register_volume, list_args):
+                list_failed[it] = failed
+        # errors in worker processes are reported here, so that the program exits from the main process
+        if None in list_failed.values():
+            sct.printv('\nERROR in '+os.path.basename(__file__)+': Registration failed. Exit program.\n', 1, 'error')
+        return [(args[0], list_failed[args[0]]) for args in list_args]
+    else:
+        return [(args[0], register(param, *args[1:])) for args in list_args]
+
+
+def init_moco_worker(param):
+    global moco_param
+    moco_param = param
+
+
+def register_volume(args):
+    sct.printv(('\nVolume '+str(args[0])+':'), moco_param.verbose)
+    try:
+        return args[0], register(moco_param, *args[1:])
+    except SystemExit:
+        return args[0], None
+
+
 #=======================================================================================================================
 # register:  registration of two volumes (or two images)
 #=======================================================================================================================
@@ -205,112 +283,173 @@ def register(param, file_src, file_dest, file_mat, file_out):
 
 
 #=======================================================================================================================
-# spline
+# MotionParameters
 #=======================================================================================================================
-def spline(folder_mat,nt,nz,verbose,index_b0 = [],graph=0):
-    # get path of the toolbox
-    status, path_sct = commands.getstatusoutput('echo $SCT_DIR')
-    # append path that contains scripts, to be able to load modules
-    sys.path.append(path_sct + '/scripts')
-    import sct_utils as sct
+class MotionParameters(object):
+    """
+    Slice-wise translations of all volumes of a series, stored in a single file (see FILE_PARAMS) instead of one
+    warping field per volume. Warping fields output by isct_antsSliceRegularizedRegistration are constant within each
+    slice, so they are fully described by:
+      translations: nt x nz x 2 array. x and y components of the displacement of each slice (ITK convention, in mm)
+      failed: array of nt booleans. True if registration of the volume failed (transformation of the closest volume
+              was used instead)
+      header: header of the warping fields (geometry of the target image), used to generate warping fields
+    """
+    def __init__(self, nt, nz, header=None):
+        self.translations = np.zeros((nt, nz, 2))
+        self.failed = np.zeros(nt, dtype=bool)
+        self.header = header
+
+    @staticmethod
+    def load(fname):
+        from nibabel import Nifti1Header
+        archive = np.load(fname)
+        params = MotionParameters(0, 0, Nifti1Header(archive['header'].tostring()))
+        params.translations = archive['translations']
+        params.failed = archive['failed']
+        return params
+
+    def save(self, fname):
+        np.savez(fname, translations=self.translations, failed=self.failed,
+                 header=np.fromstring(self.header.binaryblock, dtype=np.uint8))
+
+    @staticmethod
+    def read_warps(list_fname_warp):
+        """
+        Read warping fields of all volumes.
+        :param list_fname_warp: list of nt warping fields (nx x ny x nz x 1 x 3)
+        :return: MotionParameters
+        """
+        from nibabel import load
+        params = None
+        for it, fname_warp in enumerate(list_fname_warp):
+            nii = load(fname_warp)
+            data = nii.get_data()
+            if params is None:
+                params = MotionParameters(len(list_fname_warp), data.shape[2], nii.header.copy())
+            params.translations[it] = np.mean(data[:, :, :, 0, :2], axis=(0, 1), dtype=np.float64)
+        return params
+
+    def write_warp(self, it, fname_warp):
+        """
+        Generate the warping field of volume it.
+        """
+        from nibabel import Nifti1Image, save
+        nx, ny, nz = self.header.get_data_shape()[:3]
+        data = np.zeros((nx, ny, nz, 1, 3), dtype=self.header.get_data_dtype())
+        data[:, :, :, 0, :2] = self.translations[it]
+        save(Nifti1Image(data, None, self.header), fname_warp)
+
+    def regularize(self):
+        """
+        Smooth translations along T with a cubic smoothing spline, for each slice and each direction.
+        """
+        from scipy.interpolate import UnivariateSpline
+        nt, nz = self.translations.shape[:2]
+        T = np.arange(nt)
+        # one column per slice and direction (smoothing splines have data-dependent knots, so they are fitted separately)
+        data = self.translations.reshape(nt, nz * 2)
+        data_smooth = np.column_stack([UnivariateSpline(T, data[:, i], k=3, s=None)(T) for i in range(nz * 2)])
+        self.translations = data_smooth.reshape(nt, nz, 2)
 
-    sct.printv('\n\n\n------------------------------------------------------------------------------',verbose)
-    sct.printv('Spline Regularization along T: Smoothing Patient Motion...',verbose)
 
-    file_mat = [[[] for i in range(nz)] for i in range(nt)]
+#=======================================================================================================================
+# apply_motion_parameters
+#=======================================================================================================================
+def apply_motion_parameters(fname_data, fname_params, fname_out, interp='spline', verbose=1):
+    """
+    Apply motion parameters estimated on a series (see MotionParameters) to another 4D series with the same geometry
+    (e.g., denoised data, other echo, phase), without estimation and without generating warping fields. Voxel
+    coordinates of the output grid in the input image are computed once; each volume only adds the offsets of its
+    slices. Volumes are read and interpolated one at a time.
+    :param fname_data: 4D image
+    :param fname_params: motion parameters (moco_params.npz)
+    :param fname_out: motion-corrected 4D image
+    :param interp: 'nn' | 'linear' | 'spline'
+    :return: fname_out
+    """
+    import nibabel
+    from scipy.ndimage import spline_filter
+    from sct_apply_transfo import RAS2LPS, INTERP_ORDER, interpolate
+
+    params = MotionParameters.load(fname_params)
+    nii = nibabel.load(fname_data)
+    nx, ny, nz = params.header.get_data_shape()[:3]
+    nt = params.translations.shape[0]
+    if len(nii.shape) != 4 or nii.shape[:3] != (nx, ny, nz) or nii.shape[3] != nt:
+        sct.printv('\nERROR in '+os.path.basename(__file__)+': Size of data '+str(nii.shape)+' does not match size of '
+                   'motion parameters '+str((nx, ny, nz, nt))+'.\n', 1, 'error')
+
+    # voxel coordinates in the input image, for null motion
+    sct.printv('\nCompute sampling coordinates...', verbose)
+    affine_warp = np.dot(RAS2LPS, params.header.get_best_affine())
+    affine_data_inv = np.linalg.inv(np.dot(RAS2LPS, nii.header.get_best_affine()))
+    affine_vox = np.dot(affine_data_inv, affine_warp)
+    coord_grid = np.dot(affine_vox[:3, :3], np.mgrid[0:nx, 0:ny, 0:nz].reshape(3, -1)) + affine_vox[:3, 3:4]
+    index_z = np.tile(np.arange(nz), nx * ny)
+    # motion of each slice (LPS, in mm), expressed as an offset in voxels of the input image
+    displacement = np.zeros((nt, nz, 3))
+    displacement[:, :, :2] = params.translations
+    offset = np.dot(displacement, affine_data_inv[:3, :3].T)
+
+    # interpolate each volume
+    sct.printv('\nApply motion correction...', verbose)
+    order = INTERP_ORDER[interp]
+    data_out = np.zeros((nx, ny, nz, nt), dtype=np.float32)
     for it in range(nt):
-        for iz in range(nz):
-            file_mat[it][iz] = folder_mat + 'mat.T' + str(it) + '_Z' + str(iz) + '.txt'
-
-    #Copying the existing Matrices to another folder
-    old_mat = folder_mat + 'old/'
-    if not os.path.exists(old_mat): os.makedirs(old_mat)
-    cmd = 'cp ' + folder_mat + '*.txt ' + old_mat
-    status, output = sct.run(cmd, verbose)
-
-    sct.printv('\nloading matrices...',verbose)
-    X = [[[] for i in range(nt)] for i in range(nz)]
-    Y = [[[] for i in range(nt)] for i in range(nz)]
-    X_smooth = [[[] for i in range(nt)] for i in range(nz)]
-    Y_smooth = [[[] for i in range(nt)] for i in range(nz)]
-    for iz in range(nz):
-        for it in range(nt):
-            file =  open(file_mat[it][iz])
-            Matrix = np.loadtxt(file)
-            file.close()
+        sct.printv('  Volume '+str(it)+'/'+str(nt-1), verbose)
+        data = np.asarray(nii.dataobj[..., it], dtype=np.float64)
+        if order > 1:
+            data = spline_filter(data, order=order)
+        coord = coord_grid + offset[it, index_z].T
+        data_out[..., it] = interpolate(data, coord, order, prefiltered=True).reshape(nx, ny, nz)
 
-            X[iz][it] = Matrix[0,3]
-            Y[iz][it] = Matrix[1,3]
+    # write output with the header of the input data
+    hdr_out = nii.header.copy()
+    hdr_out.set_data_dtype(np.float32)
+    im_out = Image(data_out, hdr=hdr_out, absolutepath=fname_out, verbose=verbose)
+    im_out.save(squeeze_data=False, verbose=verbose)
+    return fname_out
 
-    # Generate motion splines
-    sct.printv('\nGenerate motion splines...',verbose)
-    T = np.arange(nt)
-    if graph:
-        import pylab as pl
 
-    for iz in range(nz):
-
-#        frequency = scipy.fftpack.fftfreq(len(X[iz][:]), d=1)
-#        spectrum = np.abs(scipy.fftpack.fft(X[iz][:], n=None, axis=-1, overwrite_x=False))
-#        Wn = np.amax(frequency)/10
-#        N = 5              #Order of the filter
-#        b, a = scipy.signal.iirfilter(N, Wn, rp=None, rs=None, btype='low', analog=False, ftype='butter', output='ba')
-#        X_smooth[iz][:] = scipy.signal.filtfilt(b, a, X[iz][:], axis=-1, padtype=None)
-
-        spline = scipy.interpolate.UnivariateSpline(T, X[iz][:], w=None, bbox=[None, None], k=3, s=None)
-        X_smooth[iz][:] = spline(T)
-
-        if graph:
-            pl.plot(T,X_smooth[iz][:],label='spline_smoothing')
-            pl.plot(T,X[iz][:],marker='*',linestyle='None',label='original_val')
-            if len(index_b0)!=0:
-                T_b0 = [T[i_b0] for i_b0 in index_b0]
-                X_b0 = [X[iz][i_b0] for i_b0 in index_b0]
-                pl.plot(T_b0,X_b0,marker='D',linestyle='None',color='k',label='b=0')
-            pl.title('X')
-            pl.grid()
-            pl.legend()
-            pl.show()
-
-#        frequency = scipy.fftpack.fftfreq(len(Y[iz][:]), d=1)
-#        spectrum = np.abs(scipy.fftpack.fft(Y[iz][:], n=None, axis=-1, overwrite_x=False))
-#        Wn = np.amax(frequency)/10
-#        N = 5              #Order of the filter
-#        b, a = scipy.signal.iirfilter(N, Wn, rp=None, rs=None, btype='low', analog=False, ftype='butter', output='ba')
-#        Y_smooth[iz][:] = scipy.signal.filtfilt(b, a, Y[iz][:], axis=-1, padtype=None)
-
-        spline = scipy.interpolate.UnivariateSpline(T, Y[iz][:], w=None, bbox=[None, None], k=3, s=None)
-        Y_smooth[iz][:] = spline(T)
-
-        if graph:
-            pl.plot(T,Y_smooth[iz][:],label='spline_smoothing')
-            pl.plot(T,Y[iz][:],marker='*', linestyle='None',label='original_val')
-            if len(index_b0)!=0:
-                T_b0 = [T[i_b0] for i_b0 in index_b0]
-                Y_b0 = [Y[iz][i_b0] for i_b0 in index_b0]
-                pl.plot(T_b0,Y_b0,marker='D',linestyle='None',color='k',label='b=0')
-            pl.title('Y')
-            pl.grid()
-            pl.legend()
-            pl.show()
-
-    #Storing the final Matrices
-    sct.printv('\nStoring the final Matrices...',verbose)
-    for iz in range(nz):
-        for it in range(nt):
-            file =  open(file_mat[it][iz])
-            Matrix = np.loadtxt(file)
-            file.close()
+#=======================================================================================================================
+# spline
+#=======================================================================================================================
+def spline(folder_mat, nt, nz, verbose, index_b0=[], graph=0):
 
-            Matrix[0,3] = X_smooth[iz][it]
-            Matrix[1,3] = Y_smooth[iz][it]
+    sct.printv('\n\n\n------------------------------------------------------------------------------', verbose)
+    sct.printv('Spline Regularization along T: Smoothing Patient Motion...', verbose)
 
-            file =  open(file_mat[it][iz],'w')
-            np.savetxt(file_mat[it][iz], Matrix, fmt="%s", delimiter='  ', newline='\n')
-            file.close()
+    sct.printv('\nloading motion parameters...', verbose)
+    params = MotionParameters.load(folder_mat + FILE_PARAMS)
+    # keep non-regularized parameters
+    params.save(folder_mat + 'old_' + FILE_PARAMS)
+    translations = params.translations
+
+    # Generate motion splines
+    sct.printv('\nGenerate motion splines...', verbose)
+    params.regularize()
+
+    if graph:
+        import pylab as pl
+        T = np.arange(nt)
+        for iz in range(nz):
+            for i_dim, name_dim in enumerate(['X', 'Y']):
+                pl.plot(T, params.translations[:, iz, i_dim], label='spline_smoothing')
+                pl.plot(T, translations[:, iz, i_dim], marker='*', linestyle='None', label='original_val')
+                if len(index_b0) != 0:
+                    pl.plot(T[index_b0], translations[index_b0, iz, i_dim], marker='D', linestyle='None', color='k', label='b=0')
+                pl.title(name_dim)
+                pl.grid()
+                pl.legend()
+                pl.show()
+
+    # Storing the final parameters
+    sct.printv('\nStoring the final motion parameters...', verbose)
+    params.save(folder_mat + FILE_PARAMS)
 
     sct.printv('\n...Done. Patient motion has been smoothed', verbose)
-    sct.printv('------------------------------------------------------------------------------\n',verbose)
+    sct.printv('------------------------------------------------------------------------------\n', verbose)
 
 
 #=======================================================================================================================
@@ -26,7 +26,6 @@ from msct_gmseg_utils import *
 import sct_utils as sct
 import pickle, gzip
 import commands
-from math import exp
 
 
 class ModelParam:
@@ -47,6 +46,7 @@ class ModelParam:
         self.mode_weight_similarity = False  # model_param
         self.k = 0.8 # percentage of variability explained in the kept eigenvectors (PCA modes)
         self.equation_id = 1  # model_param
+        self.use_slice_index = False  # model_param
         self.verbose = 1  # both
 
     def __repr__(self):
@@ -64,6 +64,7 @@ class ModelParam:
         s += 'mode_weight_similarity: ' + str(self.mode_weight_similarity) + '\n'
         s += 'k: ' + str(self.k) + '\n'
         s += 'equation_id: ' + str(self.equation_id) + '\n'
+        s += 'use_slice_index: ' + str(self.use_slice_index) + '\n'
         return s
 
 
@@ -501,11 +502,23 @@ class Model:
         self.epsilon = round(1.0/self.dictionary.J, 4)/2
         self.tau = 0
 
+        # segmentations of the dictionary slices stacked once for the label fusion (see build_seg_tensor())
+        self.wm_seg_sum = None
+        self.gm_seg_sum = None
+        self.nb_wm_seg = None
+        self.nb_gm_seg = None
+        self.build_seg_tensor()
+
         if self.param.todo_model == 'compute':
             self.compute_model()
         elif self.param.todo_model == 'load':
             self.load_model()
 
+        # nearest-neighbour index over the coordinates of the dictionary slices (see build_slice_index())
+        self.slice_index = None
+        if self.param.use_slice_index:
+            self.build_slice_index()
+
         if self.param.verbose == 2:
             self.pca.plot_projected_dic()
 
@@ -545,80 +558,159 @@ class Model:
 
         :return:
         """
-        if dataset_coord is None:
+        use_dataset = dataset_coord is None
+        if use_dataset:
             # in the dataset_coord matrix, each column correspond to the projection of one of the original data image,
-            # the transpose operator .T enable the loop to iterate over all the images coord
+            # the transpose operator .T gives one row per image
             dataset_coord = self.pca.dataset_coord.T
             dataset_levels = [dic_slice.level for dic_slice in self.dictionary.slices]
 
-        beta = []
+        # 3D TARGET: one row of similarities per target slice. 2D TARGET: one row.
+        target_3d = isinstance(coord_target[0], (list, np.ndarray))
+        if target_3d:
+            use_levels = target_levels is not None and target_levels is not [None] and self.param.use_levels != '0'
+        else:
+            use_levels = target_levels is not None and self.param.use_levels != '0'
+            coord_target = [coord_target]
+            target_levels = [target_levels]
+
+        if use_dataset and self.slice_index is not None and tau > 0 and self.epsilon > 0 and (not use_levels or self.param.equation_id == 1):
+            # only compare each target slice with the dictionary slices found by the index
+            beta = np.asarray([self.compute_beta_index(coord_target_slice, target_levels[i_target] if use_levels else None, tau=tau) for i_target, coord_target_slice in enumerate(coord_target)])
+        else:
+            distance, level_diff = self.compute_distances(coord_target, target_levels if use_levels else None, dataset_coord, dataset_levels)
+            beta = self.compute_beta_from_distances(distance, level_diff, tau=tau)
+
+        return beta if target_3d else beta[0]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def compute_distances(self, coord_target, target_levels, dataset_coord, dataset_levels):
+        """
+        Compute the distance in the reduced model space and the level difference between each target slice and each
+        model slice (terms of the model similarity that do not depend on tau)
+
+        :param coord_target: coordinates of the target slices in the reduced model space (one row per slice)
+
+        :param target_levels: level of each target slice, or None to ignore levels
+
+        :return distance: array (nb target slices x nb model slices) of euclidean distances, weighted by the
+        eigenvalue of each mode if param.mode_weight_similarity
+
+        :return level_diff: array (nb target slices x nb model slices) of absolute level differences, or None
+        """
+        from scipy.spatial.distance import cdist
+        coord_target = np.asarray(coord_target, dtype=np.float64)
+        dataset_coord = np.asarray(dataset_coord, dtype=np.float64)
         if self.param.mode_weight_similarity:
-            mode_weight = [val/sum(self.pca.kept_eigenval) for val in self.pca.kept_eigenval]
             # TODO: WARNING: see if the weights shouldnt be inversed: a bigger weight for the first modes will make the distances along those modes bigger: maybe we want to do the opposite
+            mode_weight = np.asarray(self.pca.kept_eigenval, dtype=np.float64) / sum(self.pca.kept_eigenval)
+            coord_target = coord_target * mode_weight
+            dataset_coord = dataset_coord * mode_weight
+        distance = cdist(coord_target, dataset_coord, 'euclidean')
+
+        if target_levels is None:
+            level_diff = None
         else:
-            mode_weight = None
-
-        # 3D TARGET
-        if isinstance(coord_target[0], (list, np.ndarray)):
-            for i_target, coord_projected_slice in enumerate(coord_target):
-                beta_slice = []
-                for j_slice, coord_slice_j in enumerate(dataset_coord):
-                    if mode_weight is None:
-                        square_norm = np.linalg.norm((coord_projected_slice - coord_slice_j), 2)
-                    else:
-                        from scipy.spatial.distance import wminkowski
-                        square_norm = wminkowski(coord_projected_slice, coord_slice_j, 2, mode_weight)
-
-                    if target_levels is not None and target_levels is not [None] and self.param.use_levels is not '0':
-                        if self.param.equation_id == 1:
-                            # EQUATION #1 (better results ==> kept)
-                            beta_slice.append(exp(-self.param.weight_gamma*abs(target_levels[i_target] - dataset_levels[j_slice]))*exp(-tau*square_norm))  # TODO: before = no absolute
-                        elif self.param.equation_id == 2:
-                            # EQUATION #2
-                            if target_levels[i_target] == dataset_levels[j_slice]:
-                                beta_slice.append(exp(tau*square_norm))
-                            else:
-                                beta_slice.append(exp(-tau*square_norm)/self.param.weight_gamma*abs(target_levels[i_target] - dataset_levels[j_slice])) #TODO: before = no absolute
+            level_diff = np.abs(np.asarray(target_levels, dtype=np.float64)[:, np.newaxis] - np.asarray(dataset_levels, dtype=np.float64)[np.newaxis, :])
 
-                    else:
-                        beta_slice.append(exp(-tau*square_norm))
+        return distance, level_diff
 
-                try:
-                    beta_slice /= np.sum(beta_slice)
-                except ZeroDivisionError:
-                    sct.printv('WARNING : similarities are null', self.param.verbose, 'warning')
-                    print beta_slice
+    # ------------------------------------------------------------------------------------------------------------------
+    def compute_beta_from_distances(self, distance, level_diff=None, tau=0.006, excluded=None):
+        """
+        Compute the model similarity (beta) from the distances and level differences given by compute_distances()
+
+        Similarities are computed in the log domain and normalized row by row (softmax), so that they do not all
+        underflow to zero for large distances
 
-                beta.append(beta_slice)
+        :param excluded: boolean array (same shape as distance) of model slices to exclude (null similarity)
 
-        # 2D TARGET
+        :return beta: array (nb target slices x nb model slices), each row sums to 1
+        """
+        if level_diff is None:
+            log_beta = -tau*distance
+        elif self.param.equation_id == 1:
+            # EQUATION #1 (better results ==> kept)
+            log_beta = -self.param.weight_gamma*level_diff - tau*distance  # TODO: before = no absolute
         else:
-            for j_slice, coord_slice_j in enumerate(dataset_coord):
-                if mode_weight is None:
-                    square_norm = np.linalg.norm((coord_target - coord_slice_j), 2)
-                else:
-                    from scipy.spatial.distance import wminkowski
-                    square_norm = wminkowski(coord_target, coord_slice_j, 2, mode_weight)
-                if target_levels is not None and self.param.use_levels is not '0':
-                    if self.param.equation_id == 1:
-                        # EQUATION #1 (better results ==> kept)
-                        beta.append(exp(-self.param.weight_gamma*abs(target_levels - dataset_levels[j_slice]))*exp(-tau*square_norm) )#TODO: before = no absolute
-                    elif self.param.equation_id == 2:
-                        # EQUATION #2
-                        if target_levels == dataset_levels[j_slice]:
-                            beta.append(exp(tau*square_norm))
-                        else:
-                            beta.append(exp(-tau*square_norm)/self.param.weight_gamma*abs(target_levels - dataset_levels[j_slice]))
-                else:
-                    beta.append(exp(-tau*square_norm))
+            # EQUATION #2
+            with np.errstate(divide='ignore'):
+                log_beta = np.where(level_diff == 0, tau*distance, -tau*distance - np.log(self.param.weight_gamma) + np.log(level_diff))  # TODO: before = no absolute
+        if excluded is not None:
+            log_beta = np.where(excluded, -np.inf, log_beta)
 
-            try:
-                beta /= np.sum(beta)
-            except ZeroDivisionError:
-                sct.printv('WARNING : similarities are null', self.param.verbose, 'warning')
-                print beta
+        beta = np.exp(log_beta - log_beta.max(axis=1)[:, np.newaxis])
+        beta /= beta.sum(axis=1)[:, np.newaxis]
+        return beta
 
-        return np.asarray(beta)
+    # ------------------------------------------------------------------------------------------------------------------
+    def build_slice_index(self):
+        """
+        Build a KD-tree over the coordinates of the dictionary slices in the reduced model space, with one tree per
+        vertebral level (one tree for all slices if levels are not used)
+
+        :return:
+        """
+        from scipy.spatial import cKDTree
+        sct.printv('\nBuilding the index of the dictionary slices ...', self.param.verbose, 'normal')
+        dataset_coord = np.asarray(self.pca.dataset_coord.T, dtype=np.float64)
+        if self.param.mode_weight_similarity:
+            dataset_coord = dataset_coord * (np.asarray(self.pca.kept_eigenval, dtype=np.float64) / sum(self.pca.kept_eigenval))
+        if self.param.use_levels != '0':
+            dic_levels = np.asarray([dic_slice.level for dic_slice in self.dictionary.slices], dtype=np.float64)
+        else:
+            dic_levels = np.zeros(len(self.dictionary.slices))
+        self.slice_index = []
+        for level in np.unique(dic_levels):
+            index_level = np.nonzero(dic_levels == level)[0]
+            self.slice_index.append((level, index_level, cKDTree(dataset_coord[index_level])))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def compute_beta_index(self, coord_target, target_level=None, tau=0.006):
+        """
+        Compute the model similarity (beta) between one target slice and the dictionary slices, using the index built
+        by build_slice_index()
+
+        Only dictionary slices whose similarity is at least epsilon/J times the highest similarity are compared to the
+        target: the neglected slices account for less than epsilon of the partition function Z, so that the selection
+        of the slices (beta > epsilon) is the same as with compute_beta(), except for beta within epsilon (relative) of
+        epsilon. Only for similarities that decrease with the distance (no levels, or equation #1).
+
+        :param coord_target: coordinates of the target slice in the reduced model space
+
+        :param target_level: level of the target slice, or None to ignore levels
+
+        :return beta: array (J) of similarities, null for the slices that were not compared to the target
+        """
+        coord_target = np.asarray(coord_target, dtype=np.float64)
+        if self.param.mode_weight_similarity:
+            coord_target = coord_target * (np.asarray(self.pca.kept_eigenval, dtype=np.float64) / sum(self.pca.kept_eigenval))
+        nb_slices = len(self.dictionary.slices)
+        # cost (-log of the non-normalized similarity) of the level difference for each level of the dictionary
+        if target_level is None:
+            list_level_diff_index = [0 for level, index_level, tree in self.slice_index]
+        else:
+            list_level_diff_index = [abs(float(target_level) - level) for level, index_level, tree in self.slice_index]
+        list_cost_level = [self.param.weight_gamma*level_diff for level_diff in list_level_diff_index]
+        # lowest cost, from the nearest neighbour of each level
+        cost_min = min([cost_level + tau*tree.query(coord_target, k=1)[0] for cost_level, (level, index_level, tree) in zip(list_cost_level, self.slice_index)])
+        # highest cost of the slices to compare to the target
+        cost_max = cost_min + np.log(nb_slices / self.epsilon)
+
+        list_index, list_distance, list_level_diff = [], [], []
+        for cost_level, level_diff, (level, index_level, tree) in zip(list_cost_level, list_level_diff_index, self.slice_index):
+            if cost_level > cost_max:
+                continue
+            index_candidates = np.asarray(tree.query_ball_point(coord_target, (cost_max - cost_level) / tau), dtype=int)
+            list_index.append(index_level[index_candidates])
+            list_distance.append(np.sqrt(((tree.data[index_candidates] - coord_target) ** 2).sum(axis=1)))
+            list_level_diff.append(np.ones(len(index_candidates)) * level_diff)
+        index = np.concatenate(list_index)
+
+        beta = np.zeros(nb_slices)
+        level_diff = np.concatenate(list_level_diff)[np.newaxis, :] if target_level is not None else None
+        beta[index] = self.compute_beta_from_distances(np.concatenate(list_distance)[np.newaxis, :], level_diff, tau=tau)[0]
+        return beta
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_tau(self):
@@ -644,26 +736,29 @@ class Model:
 
             """
             sum_norm = 0
-            for dic_slice in self.dictionary.slices:
-                projected_dic_slice_coord = self.pca.project_array(dic_slice.im_M_flat)
-                coord_dic_slice_dataset = np.delete(self.pca.dataset_coord.T, dic_slice.id, 0)
-                if self.param.use_levels is not '0':
-                    dic_slice_dataset_levels = np.delete(np.asarray(dic_levels), dic_slice.id, 0)
-                    beta_dic_slice = self.compute_beta(projected_dic_slice_coord, target_levels=dic_slice.level, dataset_coord=coord_dic_slice_dataset, dataset_levels=dic_slice_dataset_levels, tau=tau)
-                else:
-                    beta_dic_slice = self.compute_beta(projected_dic_slice_coord, target_levels=None, dataset_coord=coord_dic_slice_dataset, dataset_levels=None, tau=tau)
-                kj = self.select_k_slices(beta_dic_slice)
-                if self.param.weight_label_fusion:
-                    est_segm_j = self.label_fusion(dic_slice, kj, beta=beta_dic_slice)[0]
-                else:
-                    # default case
-                    est_segm_j = self.label_fusion(dic_slice, kj)[0]
+            # similarities of all dictionary slices at once, each slice being excluded from its own dataset
+            beta_dic = self.compute_beta_from_distances(distance_dic, level_diff_dic, tau=float(tau), excluded=excluded)
+            # the excluded slice has a null similarity, so it is never selected: rows can be used as is
+            kj = beta_dic > self.epsilon
+            if self.param.weight_label_fusion:
+                est_segm = self.fuse_segmentations(kj, beta=beta_dic)[0]
+            else:
+                # default case
+                est_segm = self.fuse_segmentations(kj)[0]
 
-                sum_norm += l0_norm(compute_majority_vote_mean_seg(dic_slice.wm_seg_M), est_segm_j.data)
+            for i_slice in range(len(self.dictionary.slices)):
+                sum_norm += l0_norm(ref_segm[i_slice], est_segm[i_slice])
 
             return sum_norm
 
         dic_levels = [dic_slice.level for dic_slice in self.dictionary.slices]
+        # distances between the projected dictionary slices and the dataset do not depend on tau: computed once
+        projected_dic_coord = [self.pca.project_array(dic_slice.im_M_flat) for dic_slice in self.dictionary.slices]
+        distance_dic, level_diff_dic = self.compute_distances(projected_dic_coord, dic_levels if self.param.use_levels != '0' else None, self.pca.dataset_coord.T, dic_levels)
+        excluded = np.zeros(distance_dic.shape, dtype=bool)
+        excluded[range(len(self.dictionary.slices)), [dic_slice.id for dic_slice in self.dictionary.slices]] = True
+        # the reference segmentation of each dictionary slice does not depend on tau either
+        ref_segm = [compute_majority_vote_mean_seg(dic_slice.wm_seg_M) for dic_slice in self.dictionary.slices]
 
         est_tau = minimize(to_minimize, 0.001, method='Nelder-Mead', options={'xtol': 0.0005})
         sct.printv('Estimated tau : ' + str(est_tau.x[0]))
@@ -691,6 +786,63 @@ class Model:
 
         return np.asarray(kept_slice_index)
 
+    # ------------------------------------------------------------------------------------------------------------------
+    def build_seg_tensor(self):
+        """
+        Stack the WM and GM segmentations of the dictionary slices in preallocated arrays (nb dictionary slices x N x N),
+        summed across raters, together with the number of segmentations of each slice, so that the label fusion of
+        all the target slices is done with one matrix product
+
+        :return:
+        """
+        slices = self.dictionary.slices
+        seg_shape = np.asarray(slices[0].wm_seg_M[0]).shape
+        self.wm_seg_sum = np.zeros((len(slices),) + seg_shape)
+        self.gm_seg_sum = np.zeros((len(slices),) + seg_shape)
+        self.nb_wm_seg = np.zeros(len(slices))
+        self.nb_gm_seg = np.zeros(len(slices))
+        for j, dic_slice in enumerate(slices):
+            self.wm_seg_sum[j] = np.sum(dic_slice.wm_seg_M, axis=0)
+            self.gm_seg_sum[j] = np.sum(dic_slice.gm_seg_M, axis=0)
+            self.nb_wm_seg[j] = len(dic_slice.wm_seg_M)
+            self.nb_gm_seg[j] = len(dic_slice.gm_seg_M)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def fuse_segmentations(self, selected_index, beta=None, type='binary'):
+        """
+        Label fusion of the segmentations of the selected dictionary slices, for all the target slices at once
+
+        Without beta, all the segmentations of the selected slices have the same weight (majority vote). With beta,
+        each selected slice is weighted by its normalized similarity, shared between the segmentations of this slice.
+
+        :param selected_index: boolean array (nb target slices x nb dictionary slices) of the selected dictionary slices
+        :param beta: similarities (same shape as selected_index), or None
+
+        :return res_wm, res_gm, any_selected: WM and GM segmentations (nb target slices x N x N), and boolean array of
+        the target slices with at least one selected dictionary slice (other rows are meaningless)
+        """
+        selected = np.asarray(selected_index, dtype=np.float64)
+        any_selected = selected.any(axis=1)
+        nb_slices, seg_shape = self.wm_seg_sum.shape[0], self.wm_seg_sum.shape[1:]
+
+        res = []
+        for seg_sum, nb_seg, threshold in [(self.wm_seg_sum, self.nb_wm_seg, 0.50001), (self.gm_seg_sum, self.nb_gm_seg, 0.5)]:
+            if beta is None:
+                # every segmentation of the selected slices counts for one vote: sum of the votes / number of votes
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    average = np.dot(selected, seg_sum.reshape(nb_slices, -1)) / np.dot(selected, nb_seg)[:, np.newaxis]
+            else:
+                weights = np.asarray(beta) * selected
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    weights /= weights.sum(axis=1)[:, np.newaxis]
+                average = np.dot(weights / nb_seg, seg_sum.reshape(nb_slices, -1))
+            average = np.nan_to_num(average).reshape((-1,) + seg_shape)
+            if type == 'binary':
+                res.append((average >= threshold).astype(int))
+            else:
+                res.append(average.astype(float))
+        return res[0], res[1], any_selected
+
     # ------------------------------------------------------------------------------------------------------------------
     def label_fusion(self, target, selected_index, beta=None, type='binary'):
 
@@ -698,83 +850,33 @@ class Model:
         Compute the resulting segmentation by label fusion of the segmentation of the selected dictionary slices
 
         :param selected_index: array of indexes (as a boolean array) of the selected dictionary slices
+        :param beta: similarities of the target with the dictionary slices, used to weight the label fusion if not None
 
         :return res_seg_model_space: Image of the resulting segmentation for the target image (in the model space)
         """
-        wm_segmentation_slices = np.asarray([dic_slice.wm_seg_M for dic_slice in self.dictionary.slices])
-        gm_segmentation_slices = np.asarray([dic_slice.gm_seg_M for dic_slice in self.dictionary.slices])
-
-        res_wm_seg_model_space = []
-        res_gm_seg_model_space = []
-
-        if isinstance(selected_index[0], (list, np.ndarray)):
+        selected_index = np.asarray(selected_index)
+        if selected_index.ndim == 2:
             # 3D image
-            for i, selected_ind_by_slice in enumerate(selected_index):  # selected_slices:
-                # did not adapted the WEIGHTED LABEL FUSION to multiple segmentations per slice
-                '''
-                if beta is None:
-                    n_selected_dic_slices = wm_segmentation_slices[selected_ind_by_slice].shape[0]
-                    if n_selected_dic_slices > 0:
-                        weights = [1.0/n_selected_dic_slices] * n_selected_dic_slices
-                    else:
-                        weights = None
-                else:
-                    weights = beta[i][selected_ind_by_slice]
-                    weights = [w/sum(weights) for w in weights]
-                '''
-                # if slices from teh dictionary were selected:
-                if np.any(selected_ind_by_slice):
-                    weights = None
-
-                    #list_selected_slices_wm = np.array(wm_segmentation_slices[selected_ind_by_slice])
-                    selected_slices_wmseg = []
-                    for seg_by_slice in wm_segmentation_slices[selected_ind_by_slice]:
-                        for seg in seg_by_slice:
-                            selected_slices_wmseg.append(seg)
-
-                    wm_slice_seg = compute_majority_vote_mean_seg(selected_slices_wmseg, weights=weights, type=type, threshold=0.50001)
-                    res_wm_seg_model_space.append(wm_slice_seg)
-                    target[i].set(list_wm_seg_m=[wm_slice_seg])
-
-                    # list_selected_slices_gm = gm_segmentation_slices[selected_ind_by_slice]
-                    selected_slices_gmseg = []
-                    for seg_by_slice in gm_segmentation_slices[selected_ind_by_slice]:
-                        for seg in seg_by_slice:
-                            selected_slices_gmseg.append(seg)
-                    gm_slice_seg = compute_majority_vote_mean_seg(selected_slices_gmseg, weights=weights, type=type)
-                    res_gm_seg_model_space.append(gm_slice_seg)
-                    target[i].set(list_gm_seg_m=[gm_slice_seg])
+            res_wm, res_gm, any_selected = self.fuse_segmentations(selected_index, beta=beta, type=type)
+
+            res_wm_seg_model_space = []
+            res_gm_seg_model_space = []
+            for i, is_selected in enumerate(any_selected):
+                # if slices from the dictionary were selected:
+                if is_selected:
+                    res_wm_seg_model_space.append(res_wm[i])
+                    target[i].set(list_wm_seg_m=[res_wm[i]])
+                    res_gm_seg_model_space.append(res_gm[i])
+                    target[i].set(list_gm_seg_m=[res_gm[i]])
                 else:
                     # no selected dictionary slices
                     target[i].set(list_wm_seg_m=[self.dictionary.mean_wmseg])
                     target[i].set(list_gm_seg_m=[self.dictionary.mean_gmseg])
-
-
         else:
             # 2D image
-            # did not adapted the WEIGHTED LABEL FUSION to multiple segmentations per slice
-            '''
-            if beta is None:
-                n_selected_dic_slices = wm_segmentation_slices[selected_index].shape[0]
-                weights = [1.0/n_selected_dic_slices] * n_selected_dic_slices
-            else:
-                weights = beta[selected_index]
-                weights = [w/sum(weights) for w in weights]
-            '''
-            weights = None
-
-            selected_slices_wmseg = []
-            for seg_by_slice in wm_segmentation_slices[selected_index]:
-                for seg in seg_by_slice:
-                    selected_slices_wmseg.append(seg)
-
-            selected_slices_gmseg = []
-            for seg_by_slice in gm_segmentation_slices[selected_index]:
-                for seg in seg_by_slice:
-                    selected_slices_gmseg.append(seg)
-
-            res_wm_seg_model_space = compute_majority_vote_mean_seg(np.array(selected_slices_wmseg), weights=weights, type=type, threshold=0.50001)
-            res_gm_seg_model_space = compute_majority_vote_mean_seg(np.array(selected_slices_gmseg), weights=weights, type=type)
+            res_wm, res_gm, any_selected = self.fuse_segmentations(selected_index[np.newaxis, :], beta=None if beta is None else np.asarray(beta)[np.newaxis, :], type=type)
+            res_wm_seg_model_space = res_wm[0]
+            res_gm_seg_model_space = res_gm[0]
 
         res_wm_seg_model_space = np.asarray(res_wm_seg_model_space)
         res_gm_seg_model_space = np.asarray(res_gm_seg_model_space)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# In-process image operations. These functions replace sct.run() calls to sct_convert, sct_resample, sct_image,
+# sct_crop_image, sct_maths, sct_apply_transfo and sct_concat_transfo when used inside another SCT script: they take
+# and return msct_image.Image objects, so that no Python interpreter is started and no intermediate file is written
+# unless explicitly requested (fname_out).
+#
+# Example:
+#   from msct_pipeline import load, resample, set_orientation, save
+#   im = load('t2.nii.gz')
+#   im = set_orientation(resample(im, '1.0x1.0x1.0', 'mm'), 'RPI')
+#   save(im, 't2_1mm_rpi.nii.gz')
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2016 Polytechnique Montreal <www.neuro.polymtl.ca>
+# Authors: Julien Cohen-Adad, Benjamin De Leener
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import numpy as np
+import sct_utils as sct
+from msct_image import Image
+
+
+def load(fname, verbose=1):
+    """
+    Load image from file.
+    :param fname: file name
+    :return: Image
+    """
+    return Image(fname, verbose=verbose)
+
+
+def save(im, fname_out, type='', squeeze_data=True, verbose=1):
+    """
+    Write image on disk. Equivalent to: sct_convert -i im -o fname_out
+    :param im: Image
+    :param fname_out: output file name. Extension defines the format (.nii or .nii.gz)
+    :param type: output type (see Image.save())
+    :return: fname_out
+    """
+    im.setFileName(fname_out)
+    im.save(type=type, squeeze_data=squeeze_data, verbose=verbose)
+    return fname_out
+
+
+def update_dim(im):
+    """
+    Update Image.dim from the shape of the data and the voxel size of the header.
+    :param im: Image
+    :return: Image (modified in place)
+    """
+    shape = list(im.data.shape)
+    zooms = list(im.hdr.get_zooms())
+    dim = [1, 1, 1, 1, 1, 1, 1, 1]
+    for i in range(min(len(shape), 4)):
+        dim[i] = shape[i]
+    for i in range(min(len(zooms), 4)):
+        dim[i+4] = zooms[i]
+    im.dim = tuple(dim)
+    return im
+
+
+def _set_affine(im, affine):
+    """
+    Set qform and sform of an image header, keeping the existing codes.
+    """
+    im.hdr.set_qform(affine)
+    im.hdr.set_sform(affine)
+    im.compute_transform_matrix()
+
+
+def _new_image(im, data, suffix):
+    """
+    Create an image that shares the header information of im, without copying the data of im.
+    """
+    from copy import deepcopy
+    im_out = Image(data, hdr=deepcopy(im.hdr), orientation=im.orientation, absolutepath=im.absolutepath, dim=im.dim,
+                   verbose=im.verbose)
+    im_out.setFileName(sct.add_suffix(im.absolutepath, suffix))
+    return im_out
+
+
+def _output(im, fname_out, verbose):
+    if fname_out:
+        save(im, fname_out, squeeze_data=False, verbose=verbose)
+    return im
+
+
+def convert(im, fname_out='', type=None, verbose=1):
+    """
+    Copy image, and optionally change its type. Equivalent to: sct_convert
+    :param im: Image or file name
+    :param fname_out: if specified, output is written on disk
+    :param type: new data type (e.g. 'float32')
+    :return: Image
+    """
+    if isinstance(im, str):
+        im = load(im, verbose=verbose)
+    im_out = _new_image(im, im.data.copy(), '')
+    if type is not None:
+        im_out.changeType(type=type)
+    return _output(im_out, fname_out, verbose)
+
+
+def resample(im, new_size, new_size_type='mm', interpolation='linear', fname_out='', verbose=1):
+    """
+    Resample 3D or 4D image. Equivalent to: sct_resample (same output grid and same sampling as nipy's resample used
+    by sct_resample).
+    :param im: Image
+    :param new_size: string, e.g. '1.0x1.0x1.0' or '1x1x0.25'
+    :param new_size_type: 'mm' | 'factor' | 'vox'
+    :param interpolation: 'nn' | 'linear' | 'spline'
+    :return: Image
+    """
+    from scipy.ndimage import affine_transform
+    x_to_order = {'nn': 0, 'linear': 1, 'spline': 2}
+    data = im.data
+    n = data.shape
+    p = im.hdr.get_zooms()
+    # parse new size (spatial dimensions only)
+    new_size = new_size.split('x')
+    if len(new_size) == 1:
+        new_size = [new_size[0] for i in range(3)]
+    if new_size_type == 'vox':
+        n_r = [int(new_size[i]) for i in range(3)]
+    elif new_size_type == 'factor':
+        n_r = [int(round(n[i] * float(new_size[i]))) for i in range(3)]
+    elif new_size_type == 'mm':
+        n_r = [int(round(n[i] * float(p[i]) / float(new_size[i]))) for i in range(3)]
+    else:
+        sct.printv('ERROR: new_size_type is not recognized: '+str(new_size_type), 1, 'error')
+    sct.printv('  new shape: '+str(tuple(n_r + list(n[3:]))), verbose)
+    # transformation from output voxel to input voxel. The translation accounts for voxel size (otherwise resulting
+    # image would be shifted by half a voxel), as done in sct_resample.
+    scale = np.array([n[i] / float(n_r[i]) for i in range(3)])
+    offset = (scale - 1) / 2
+    order = x_to_order[interpolation]
+    data_in = data.astype(np.float64)
+    if len(n) == 3:
+        data_r = affine_transform(data_in, np.diag(scale), offset=offset, output_shape=tuple(n_r), order=order, mode='nearest')
+    else:
+        data_r = np.zeros(tuple(n_r) + tuple(n[3:]), dtype=np.float64)
+        for it in range(n[3]):
+            data_r[:, :, :, it] = affine_transform(data_in[:, :, :, it], np.diag(scale), offset=offset, output_shape=tuple(n_r), order=order, mode='nearest')
+    # build output image
+    im_out = _new_image(im, data_r, '_r')
+    im_out.hdr.set_data_dtype(np.float64)
+    affine_r = np.dot(im.hdr.get_best_affine(), np.diag(list(scale) + [1]))
+    _set_affine(im_out, affine_r)
+    update_dim(im_out)
+    return _output(im_out, fname_out, verbose)
+
+
+def set_orientation(im, orientation, fname_out='', verbose=1):
+    """
+    Change orientation of image data and header. Equivalent to: sct_image -setorient
+    :param im: Image (3D, 4D or 5D)
+    :param orientation: string, e.g. 'RPI'
+    :return: Image (data is a view of im.data)
+    """
+    from sct_image import reorient
+    im_out = reorient(im, orientation)
+    return _output(im_out, fname_out, verbose)
+
+
+def get_bounding_slices(im, dim=2):
+    """
+    Find min and max index of non-null voxels along a dimension. Equivalent to the output of: sct_crop_image -bmax
+    :param im: Image
+    :param dim: dimension: 0, 1, 2
+    :return: index_min, index_max
+    """
+    axes = tuple([i for i in range(len(im.data.shape)) if i != dim])
+    ind = np.nonzero(np.any(im.data != 0, axis=axes))[0]
+    if ind.size == 0:
+        return 0, im.data.shape[dim] - 1
+    return int(ind[0]), int(ind[-1])
+
+
+def crop(im, dim, start, end, fname_out='', verbose=1):
+    """
+    Crop image along one dimension, and update the origin. Equivalent to: sct_crop_image -dim -start -end
+    :param im: Image
+    :param dim: dimension: 0, 1, 2
+    :param start: first slice to keep
+    :param end: last slice to keep (included)
+    :return: Image
+    """
+    start, end = int(start), int(end)
+    sct.printv('  Dimension '+str(dim)+': '+str(start)+' '+str(end), verbose)
+    slices = [slice(None)] * len(im.data.shape)
+    slices[dim] = slice(start, end + 1)
+    im_out = _new_image(im, im.data[tuple(slices)], '_crop')
+    # adapt the origin in the qform and sform matrices
+    shift = [0, 0, 0, 1]
+    shift[dim] = start
+    affine = im.hdr.get_best_affine()
+    affine_out = affine.copy()
+    affine_out[:, 3] = np.dot(affine, shift)
+    _set_affine(im_out, affine_out)
+    update_dim(im_out)
+    return _output(im_out, fname_out, verbose)
+
+
+def crop_to_content(im, dim=2, fname_out='', verbose=1):
+    """
+    Crop image along one dimension to the extent of non-null voxels. Equivalent to: sct_crop_image -dim 2 -bzmax
+    :return: Image, index_min, index_max
+    """
+    ind_min, ind_max = get_bounding_slices(im, dim)
+    return crop(im, dim, ind_min, ind_max, fname_out=fname_out, verbose=verbose), ind_min, ind_max
+
+
+def binarize(im, threshold=0, fname_out='', verbose=1):
+    """
+    Binarize image. Equivalent to: sct_maths -bin
+    :return: Image
+    """
+    from sct_maths import binarise
+    im_out = _new_image(im, binarise(im.data, bin_thr=threshold).astype(im.hdr.get_data_dtype()), '_bin')
+    return _output(im_out, fname_out, verbose)
+
+
+def dilate(im, radius, fname_out='', verbose=1):
+    """
+    Dilate image. Equivalent to: sct_maths -dilate
+    :param radius: list of int (see sct_maths.dilate())
+    :return: Image
+    """
+    from sct_maths import dilate as dilate_data
+    if not isinstance(radius, list):
+        radius = [radius]
+    im_out = _new_image(im, dilate_data(im.data, radius), '_dilate')
+    return _output(im_out, fname_out, verbose)
+
+
+def apply_transfo(fname_src, fname_dest, fname_warp_list, fname_out, interp='spline', crop=0, verbose=1):
+    """
+    Apply transformations. Equivalent to: sct_apply_transfo (ANTs still works on files, but no Python interpreter is
+    started).
+    :param fname_src: source image (Image objects are written on disk beforehand)
+    :param fname_dest: destination image
+    :param fname_warp_list: list of warping fields (prefix with '-' to use inverse)
+    :return: Image
+    """
+    from sct_apply_transfo import Transform
+    if isinstance(fname_src, Image):
+        fname_src = _write(fname_src, verbose)
+    if isinstance(fname_dest, Image):
+        fname_dest = _write(fname_dest, verbose)
+    if isinstance(fname_warp_list, str):
+        fname_warp_list = fname_warp_list.split(',')
+    # Transform.apply() modifies the list of warping fields
+    Transform(input_filename=fname_src, warp=list(fname_warp_list), fname_dest=fname_dest, output_filename=fname_out,
+              interp=interp, crop=crop, verbose=verbose).apply()
+    return load(fname_out, verbose=verbose)
+
+
+def concat_transfo(fname_warp_list, fname_dest, fname_out, verbose=1):
+    """
+    Concatenate transformations. Equivalent to: sct_concat_transfo
+    :return: fname_out
+    """
+    from sct_concat_transfo import concat_transfo as concat
+    if isinstance(fname_warp_list, str):
+        fname_warp_list = fname_warp_list.split(',')
+    if isinstance(fname_dest, Image):
+        fname_dest = _write(fname_dest, verbose)
+    return concat(list(fname_warp_list), fname_dest, fname_out, verbose=verbose)
+
+
+def _write(im, verbose):
+    """
+    Write in-memory image on disk under its current file name (binaries such as ANTs need files).
+    """
+    im.save(squeeze_data=False, verbose=verbose)
+    return im.path+im.file_name+im.ext
@@ -19,6 +19,7 @@ import os
 import getopt
 import commands
 import time
+import numpy as np
 from msct_parser import Parser
 import sct_utils as sct
 from sct_crop_image import ImageCropper
@@ -74,6 +75,15 @@ def get_parser():
                       mandatory=False,
                       default_value='spline',
                       example=['nn','linear','spline'])
+    parser.add_option(name="-native",
+                      type_value="multiple_choice",
+                      description="Apply warping fields and affine transformations (ITK format, as output by ANTs) in Python "
+                                  "instead of isct_antsApplyTransforms: faster for 4D data, but the output is float32 and "
+                                  "interpolated with scipy (results differ slightly from ANTs). Other transformations are "
+                                  "applied with ANTs.",
+                      mandatory=False,
+                      default_value='0',
+                      example=['0', '1'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -90,6 +100,170 @@ def get_parser():
     return parser
 
 
+# NATIVE ENGINE
+# ==========================================================================================
+# Transformations are applied in Python (same conventions as isct_antsApplyTransforms): warping fields and affine
+# matrices are composed once to compute the sampling coordinates in the source image, then each volume is interpolated
+# with scipy.ndimage.map_coordinates. Points are expressed in ITK physical space (LPS), whereas NIfTI affines are RAS.
+RAS2LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+INTERP_ORDER = {'nn': 0, 'linear': 1, 'spline': 3}
+
+
+class UnsupportedTransform(Exception):
+    """
+    Transformation that cannot be applied by apply_native(): isct_antsApplyTransforms is used instead.
+    """
+    pass
+
+
+def read_affine(fname, inverse=False):
+    """
+    Read ITK affine transformation (ANTs .txt or .mat file).
+    :param inverse: if True, return the inverse transformation
+    :return: 4x4 matrix (LPS physical space)
+    """
+    parameters, fixed = None, None
+    if fname.endswith('.mat'):
+        from scipy.io import loadmat
+        mat = loadmat(fname)
+        for key in mat:
+            if key.startswith('AffineTransform') or key.startswith('MatrixOffsetTransformBase'):
+                parameters = mat[key].ravel()
+            elif key == 'fixed':
+                fixed = mat[key].ravel()
+    else:
+        for line in open(fname).readlines():
+            if line.startswith('Transform:') and not ('AffineTransform' in line or 'MatrixOffsetTransformBase' in line):
+                raise UnsupportedTransform('transformation not supported: '+line.strip())
+            elif line.startswith('Parameters:'):
+                parameters = np.array(line.split(':')[1].split(), dtype=float)
+            elif line.startswith('FixedParameters:'):
+                fixed = np.array(line.split(':')[1].split(), dtype=float)
+    if parameters is None or len(parameters) != 12:
+        raise UnsupportedTransform('transformation not supported: '+fname)
+    if fixed is None:
+        fixed = np.zeros(3)
+    matrix = parameters[:9].reshape(3, 3)
+    center = fixed[:3]
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = parameters[9:12] + center - np.dot(matrix, center)
+    if inverse:
+        affine = np.linalg.inv(affine)
+    return affine
+
+
+def read_warp(fname):
+    """
+    Read ITK displacement field (vectors in LPS physical space).
+    :return: data (nx, ny, nz, 3), affine (voxel to LPS)
+    """
+    import nibabel
+    im_warp = nibabel.load(fname)
+    data = im_warp.get_data()
+    if data.shape[-1] != 3 or data.ndim not in [4, 5]:
+        raise UnsupportedTransform('warping field not supported: '+fname)
+    data = data.reshape(data.shape[:3] + (3, ))
+    return data, np.dot(RAS2LPS, im_warp.header.get_best_affine())
+
+
+def interpolate(data, coord, order, prefiltered=False):
+    """
+    Interpolate 3D data at voxel coordinates. As in ITK, points that are more than half a voxel outside the image are
+    set to zero.
+    :param coord: array (3, N) of voxel coordinates
+    """
+    from scipy.ndimage import map_coordinates
+    values = map_coordinates(data, coord, order=order, mode='nearest', prefilter=(order > 1 and not prefiltered))
+    outside = np.zeros(coord.shape[1], dtype=bool)
+    for i in range(3):
+        outside |= (coord[i] < -0.5) | (coord[i] > data.shape[i] - 0.5)
+    values[outside] = 0
+    return values
+
+
+def transform_points(points, list_transfo):
+    """
+    Apply a list of transformations to points.
+    :param points: array (3, N) in LPS physical space
+    :param list_transfo: list of ('affine', matrix) or ('warp', (data, affine)), in the order they are applied
+    :return: array (3, N)
+    """
+    for type_transfo, transfo in list_transfo:
+        if type_transfo == 'affine':
+            points = np.dot(transfo[:3, :3], points) + transfo[:3, 3:4]
+        else:
+            data_warp, affine_warp = transfo
+            affine_inv = np.linalg.inv(affine_warp)
+            coord = np.dot(affine_inv[:3, :3], points) + affine_inv[:3, 3:4]
+            points = points + np.array([interpolate(data_warp[..., i], coord, 1) for i in range(3)])
+    return points
+
+
+def apply_native(fname_src, fname_dest, fname_warp_list, use_inverse, fname_out, interp='spline', verbose=1):
+    """
+    Apply transformations to a 3D or 4D image without calling isct_antsApplyTransforms. Sampling coordinates are
+    computed once (by slabs of slices), then every volume is interpolated.
+    :param fname_warp_list: list of transformations, in the order of the input list of sct_apply_transfo
+    :param use_inverse: list of bool (only affine transformations can be inverted)
+    :return: fname_out
+    """
+    import nibabel
+    from msct_image import Image
+    # read transformations. N.B. points of the destination space go through the last transformation first.
+    list_transfo = []
+    for fname_warp, inverse in reversed(zip(fname_warp_list, use_inverse)):
+        if sct.extract_fname(fname_warp)[2] in ['.txt', '.mat']:
+            list_transfo.append(('affine', read_affine(fname_warp, inverse)))
+        elif inverse:
+            raise UnsupportedTransform('inverse of warping field is not supported: '+fname_warp)
+        else:
+            list_transfo.append(('warp', read_warp(fname_warp)))
+
+    # compute sampling coordinates (voxel coordinates in the source image)
+    sct.printv('\nCompute sampling coordinates...', verbose)
+    im_dest = nibabel.load(fname_dest)
+    nx, ny, nz = im_dest.shape[:3]
+    affine_dest = np.dot(RAS2LPS, im_dest.header.get_best_affine())
+    im_src = Image(fname_src, lazy=True)
+    affine_src_inv = np.linalg.inv(np.dot(RAS2LPS, im_src.hdr.get_best_affine()))
+    coord = np.zeros((3, nx, ny, nz))
+    slab_size = max(1, int(1e6 / (nx * ny)))
+    for z_start in range(0, nz, slab_size):
+        z_end = min(z_start + slab_size, nz)
+        indexes = np.mgrid[0:nx, 0:ny, z_start:z_end].reshape(3, -1)
+        points = transform_points(np.dot(affine_dest[:3, :3], indexes) + affine_dest[:3, 3:4], list_transfo)
+        coord[:, :, :, z_start:z_end] = (np.dot(affine_src_inv[:3, :3], points) + affine_src_inv[:3, 3:4]).reshape(3, nx, ny, z_end - z_start)
+    coord = coord.reshape(3, -1)
+
+    # interpolate each volume
+    sct.printv('\nApply transformation...', verbose)
+    from scipy.ndimage import spline_filter
+    order = INTERP_ORDER[interp]
+    data_src = im_src.data
+    if data_src.ndim == 3:
+        data_src = data_src[..., np.newaxis]
+    nt = data_src.shape[3]
+    data_out = np.zeros((nx, ny, nz, nt), dtype=np.float32)
+    for it in range(nt):
+        data = data_src[..., it].astype(np.float64)
+        if order > 1:
+            data = spline_filter(data, order=order)
+        data_out[..., it] = interpolate(data, coord, order, prefiltered=True).reshape(nx, ny, nz)
+
+    # write output in the space of the destination image
+    hdr_out = im_dest.header.copy()
+    hdr_out.set_data_dtype(np.float32)
+    if nt == 1:
+        data_out = data_out[..., 0]
+    else:
+        hdr_out.set_data_shape(data_out.shape)
+        hdr_out.set_zooms(im_dest.header.get_zooms()[:3] + (im_src.dim[7], ))
+    im_out = Image(data_out, hdr=hdr_out, absolutepath=fname_out, verbose=verbose)
+    im_out.save(squeeze_data=False, verbose=verbose)
+    return fname_out
+
+
 class Transform:
     def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0):
         self.input_filename = input_filename
@@ -104,6 +278,7 @@ class Transform:
         self.verbose = verbose
         self.remove_temp_files = remove_temp_files
         self.debug = debug
+        self.native = False  # if True, transformations are applied in Python when possible (see apply_native())
 
     def apply(self):
         # Initialization
@@ -160,12 +335,25 @@ class Transform:
         # Get dimensions of data
         sct.printv('\nGet dimensions of data...', verbose)
         from msct_image import Image
-        nx, ny, nz, nt, px, py, pz, pt = Image(fname_src).dim
+        nx, ny, nz, nt, px, py, pz, pt = Image(fname_src, lazy=True).dim
         # nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_src)
         sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz)+ ' x ' + str(nt), verbose)
 
+        # apply transformations in Python (fall back to ANTs for unsupported transformations)
+        applied = False
+        if self.native:
+            try:
+                apply_native(fname_src, fname_dest, fname_warp_list, [inv != '' for inv in use_inverse], fname_out,
+                             interp=self.interp, verbose=verbose)
+                applied = True
+            except UnsupportedTransform, e:
+                sct.printv('WARNING: '+str(e)+'. Using isct_antsApplyTransforms.', verbose, 'warning')
+
+        if applied:
+            sct.printv('\nTransformations applied with the Python engine.', verbose)
+
         # if 3d
-        if nt == 1:
+        elif nt == 1:
             # Apply transformation
             sct.printv('\nApply transformation...', verbose)
             # print 'HOLA1'
@@ -265,6 +453,8 @@ def main(args=None):
         transform.output_filename = arguments["-o"]
     if "-x" in arguments:
         transform.interp = arguments["-x"]
+    if "-native" in arguments:
+        transform.native = bool(int(arguments["-native"]))
     if "-r" in arguments:
         transform.remove_temp_files = int(arguments["-r"])
     if "-v" in arguments:
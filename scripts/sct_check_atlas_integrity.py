@@ -25,6 +25,7 @@ import sct_utils as sct
 from msct_parser import Parser
 import nibabel as nib
 import numpy as np
+from msct_atlas import SparseAtlas
 
 
 # DEFAULT PARAMETERS
@@ -74,13 +75,10 @@ def main():
 
     # Extract atlas info
     atlas_id, atlas_name, atlas_file = read_label_file(path_atlas)
-    nb_tracts_total = len(atlas_id)
 
     # Load atlas
     sct.printv('\nLoad atlas...', param.verbose)
-    atlas = np.empty([nb_tracts_total], dtype=object)  # labels(nb_labels_total, x, y, z)
-    for i_atlas in range(0, nb_tracts_total):
-        atlas[i_atlas] = nib.load(path_atlas+atlas_file[i_atlas]).get_data()
+    atlas = SparseAtlas.load([path_atlas+fname for fname in atlas_file], verbose=param.verbose)
 
     # Check integrity
     sct.printv('\nCheck atlas integrity...', param.verbose)
@@ -145,32 +143,36 @@ def read_label_file(path_info_label):
 # Check integrity of the atlas
 #=======================================================================================================================
 def check_integrity(atlas, atlas_id, atlas_name, method='wath'):
+    """
+    :param atlas: SparseAtlas
+    """
 
     nb_tracts = len(atlas) # number of tracts
 
     # Get dimensions of the atlas
     sct.printv('\nGet dimensions of atlas...', param.verbose)
-    nx_atlas, ny_atlas, nz_atlas = atlas[0].shape
+    nx_atlas, ny_atlas, nz_atlas = atlas.shape
     sct.printv('.. '+str(nx_atlas)+' x '+str(ny_atlas)+' x '+str(nz_atlas)+' x '+str(nb_tracts), param.verbose)
 
 
     # if user asks for binary regions, binarize atlas
     if method == 'bin':
-        for i in range(0, nb_tracts):
-            atlas[i][atlas[i] < param.threshold_atlas] = 0
-            atlas[i][atlas[i] >= param.threshold_atlas] = 1
+        atlas = atlas.binarize(param.threshold_atlas)
 
     # if user asks for thresholded weighted-average, threshold atlas
     if method == 'wath':
-        for i in range(0, nb_tracts):
-            atlas[i][atlas[i] < param.threshold_atlas] = 0
+        atlas = atlas.threshold(param.threshold_atlas)
+
+    # positive weights of the atlas (nb_tracts x nb_vox)
+    weights_positive = atlas.weights.copy()
+    weights_positive.data[weights_positive.data < ALMOST_ZERO] = 0
+    sum_tract_positive = np.asarray(weights_positive.sum(axis=1)).ravel()
 
     # Does all the tracts are present?
     tracts_are_present = True
     sct.printv('\nDoes all the tracts are present in the atlas?',param.verbose)
-    sum_tract = []
+    sum_tract = atlas.get_sum()
     for i_atlas in range(0, nb_tracts):
-        sum_tract.append(np.sum(atlas[i_atlas]))
         if sum_tract[i_atlas] < ALMOST_ZERO:
             sct.printv('The tract #'+str(atlas_id[i_atlas])+atlas_name[i_atlas]+' is non-existent',param.verbose)
             tracts_are_present = False
@@ -194,17 +196,15 @@ def check_integrity(atlas, atlas_id, atlas_name, method='wath'):
         total_outside = 0
         total_sum_tracts = 0
         sct.printv('\nDoes any tract gets out the spinal cord?',param.verbose)
-        ind_seg_outside_cord = segmentation<=ALMOST_ZERO
+        ind_seg_outside_cord = atlas.sample(segmentation)<=ALMOST_ZERO
+        sum_tract_outside_SC = weights_positive.dot(ind_seg_outside_cord.astype(float))
         for i_atlas in range(0, nb_tracts):
-            ind_atlas_positive = atlas[i_atlas]>=ALMOST_ZERO
-            sum_tract_outside_SC = np.sum(atlas[i_atlas][ind_atlas_positive & ind_seg_outside_cord])
-            sum_tract = np.sum(atlas[i_atlas][ind_atlas_positive])
-            if sum_tract_outside_SC > ALMOST_ZERO:
-                percentage_out = float(sum_tract_outside_SC/sum_tract)
+            if sum_tract_outside_SC[i_atlas] > ALMOST_ZERO:
+                percentage_out = float(sum_tract_outside_SC[i_atlas]/sum_tract_positive[i_atlas])
                 sct.printv('The tract #'+str(atlas_id[i_atlas])+atlas_name[i_atlas]+' gets out the spinal cord of '+str(round(percentage_out*100,2))+'%',param.verbose)
                 tracts_are_inside_SC = False
-                total_outside += sum_tract_outside_SC
-            total_sum_tracts += sum_tract
+                total_outside += sum_tract_outside_SC[i_atlas]
+            total_sum_tracts += sum_tract_positive[i_atlas]
         if tracts_are_inside_SC:
             sct.printv('All the tracts are inside the spinal cord.',param.verbose)
             sct.printv('\nTotal percentage of present tracts outside the spinal cord: 0%', param.verbose)
@@ -230,17 +230,15 @@ def check_integrity(atlas, atlas_id, atlas_name, method='wath'):
         total_overlaps = 0
         total_sum_tracts = 0
         sct.printv('\nDoes any tract overlaps the spinal cord gray matter?',param.verbose)
-        ind_GM = graymatter>=param.threshold_GM
+        ind_GM = atlas.sample(graymatter)>=param.threshold_GM
+        sum_tract_overlap_GM = weights_positive.dot(ind_GM.astype(float))
         for i_atlas in range(0, nb_tracts):
-            ind_atlas_positive = atlas[i_atlas]>=ALMOST_ZERO
-            sum_tract_overlap_GM = np.sum(atlas[i_atlas][ind_atlas_positive & ind_GM])
-            sum_tract = np.sum(atlas[i_atlas])
-            if sum_tract_overlap_GM > ALMOST_ZERO:
-                percentage_overlap = float(sum_tract_overlap_GM/sum_tract)
+            if sum_tract_overlap_GM[i_atlas] > ALMOST_ZERO:
+                percentage_overlap = float(sum_tract_overlap_GM[i_atlas]/sum_tract[i_atlas])
                 sct.printv('The tract #'+str(atlas_id[i_atlas])+atlas_name[i_atlas]+' overlaps the spinal cord gray matter of '+str(round(percentage_overlap*100,2))+'%',param.verbose)
                 tracts_overlap_GM = True
-                total_overlaps += sum_tract_overlap_GM
-            total_sum_tracts += sum_tract
+                total_overlaps += sum_tract_overlap_GM[i_atlas]
+            total_sum_tracts += sum_tract[i_atlas]
         if not tracts_overlap_GM:
             sct.printv('No tract overlaps the spinal cord gray matter.',param.verbose)
             sct.printv('\nTotal percentage of present tracts overlapping gray matter: 0%', param.verbose)
@@ -58,7 +58,17 @@ def main():
             fname_warp_final = arguments['-o']
         verbose = int(arguments['-v'])
 
+    concat_transfo(fname_warp_list, fname_dest, fname_warp_final, verbose=verbose)
 
+
+def concat_transfo(fname_warp_list, fname_dest, fname_warp_final='', verbose=1):
+    """
+    Concatenate transformations. Can be called in-process by other scripts.
+    :param fname_warp_list: list of affine matrices or warping fields (prefix with '-' to use inverse)
+    :param fname_dest: destination image
+    :param fname_warp_final: output warping field
+    :return: output file name
+    """
     # Parse list of warping fields
     sct.printv('\nParse list of transformations...', verbose)
     use_inverse = []
@@ -81,7 +91,7 @@ def main():
 
     # Get output folder and file name
     if fname_warp_final == '':
-        path_out, file_out, ext_out = sct.extract_fname(param.fname_warp_final)
+        path_out, file_out, ext_out = sct.extract_fname(Param().fname_warp_final)
     else:
         path_out, file_out, ext_out = sct.extract_fname(fname_warp_final)
 
@@ -99,9 +109,11 @@ def main():
 
     # Generate output files
     sct.printv('\nGenerate output files...', verbose)
-    sct.generate_output_file('warp_final.nii.gz', path_out+file_out+ext_out)
+    sct.generate_output_file('warp_final.nii.gz', path_out+file_out+ext_out, verbose)
 
-    print ''
+    if verbose:
+        print ''
+    return path_out+file_out+ext_out
 
 
 # ==========================================================================================
@@ -27,7 +27,7 @@ import sct_utils as sct
 from sct_image import get_orientation_3d
 from sct_convert import convert
 from msct_image import Image
-from sct_image import copy_header, concat_data
+from sct_image import copy_header, concat_data, set_orientation
 from msct_parser import Parser
 
 
@@ -136,11 +136,11 @@ def create_mask():
     # reorient to RPI
     sct.printv('\nReorient to RPI...', param.verbose)
     # if not orientation_input == 'RPI':
-    sct.run('sct_image -i data.nii -o data_RPI.nii -setorient RPI -v 0', verbose=False)
+    set_orientation('data.nii', 'RPI', filename=True, fname_out='data_RPI.nii')
     if method_type == 'centerline':
-        sct.run('sct_image -i centerline.nii.gz -o centerline_RPI.nii.gz -setorient RPI -v 0', verbose=False)
+        set_orientation('centerline.nii.gz', 'RPI', filename=True, fname_out='centerline_RPI.nii.gz')
     if method_type == 'point':
-        sct.run('sct_image -i point.nii.gz -o point_RPI.nii.gz -setorient RPI -v 0', verbose=False)
+        set_orientation('point.nii.gz', 'RPI', filename=True, fname_out='point_RPI.nii.gz')
     #
     # if method_type == 'centerline':
     #     orientation_centerline = get_orientation_3d(method_val, filename=True)
@@ -151,7 +151,7 @@ def create_mask():
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image('data_RPI.nii').dim
+    nx, ny, nz, nt, px, py, pz, pt = Image('data_RPI.nii', lazy=True).dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz)+ ' x ' + str(nt), param.verbose)
     # in case user input 4d data
     if nt != 1:
@@ -244,7 +244,7 @@ def create_mask():
 
     # reorient if necessary
     # if not orientation_input == 'RPI':
-    sct.run('sct_image -i mask_RPI.nii.gz -o mask.nii.gz -setorient ' + orientation_input, param.verbose)
+    set_orientation(im_out, orientation_input, fname_out='mask.nii.gz')
 
     # copy header input --> mask
     im_dat = Image('data.nii')
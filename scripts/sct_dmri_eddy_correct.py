@@ -153,7 +153,7 @@ def eddy_correct(param):
 
     # Get size of data
     sct.printv('\nGet dimensions data...',verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_data).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_data, lazy=True).dim
     sct.printv('.. '+str(nx)+' x '+str(ny)+' x '+str(nz)+' x '+str(nt),verbose)
 
     # split along T dimension
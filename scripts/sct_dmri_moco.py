@@ -40,11 +40,11 @@ import numpy as np
 from sct_dmri_eddy_correct import eddy_correct
 import sct_utils as sct
 import msct_moco as moco
-from sct_dmri_separate_b0_and_dwi import identify_b0
+from sct_dmri_separate_b0_and_dwi import identify_b0, separate_b0_and_dwi, average_groups, save_volumes
 import importlib
 from sct_convert import convert
 from msct_image import Image
-from sct_image import copy_header, split_data, concat_data
+from sct_image import copy_header
 from msct_parser import Parser
 
 
@@ -76,6 +76,8 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.cpu_number = 1  # number of volumes registered in parallel. 0 or 1: no multiprocessing
+        self.fname_params = ''  # motion parameters estimated by a previous run
 
 
 #=======================================================================================================================
@@ -98,7 +100,10 @@ def main():
     arguments = parser.parse(sys.argv[1:])
 
     param.fname_data = arguments['-i']
-    param.fname_bvecs = arguments['-bvec']
+    if '-bvec' in arguments:
+        param.fname_bvecs = arguments['-bvec']
+    elif '-mat' not in arguments:
+        sct.printv('\nERROR in '+os.path.basename(__file__)+': flag -bvec is mandatory (unless motion parameters are applied with -mat).\n', 1, 'error')
 
     if '-bval' in arguments:
         param.fname_bvals = arguments['-bval']
@@ -120,10 +125,15 @@ def main():
         param.remove_tmp_files = int(arguments['-r'])
     if '-v' in arguments:
         param.verbose = int(arguments['-v'])
+    if '-mat' in arguments:
+        param.fname_params = arguments['-mat']
+    if '-cpu-nb' in arguments:
+        param.cpu_number = int(arguments['-cpu-nb'])
 
     # Get full path
     param.fname_data = os.path.abspath(param.fname_data)
-    param.fname_bvecs = os.path.abspath(param.fname_bvecs)
+    if param.fname_bvecs != '':
+        param.fname_bvecs = os.path.abspath(param.fname_bvecs)
     if param.fname_bvals != '':
         param.fname_bvals = os.path.abspath(param.fname_bvals)
     if param.fname_mask != '':
@@ -133,6 +143,14 @@ def main():
     path_data, file_data, ext_data = sct.extract_fname(param.fname_data)
     path_mask, file_mask, ext_mask = sct.extract_fname(param.fname_mask)
 
+    # apply motion parameters estimated by a previous run (no estimation)
+    if param.fname_params != '':
+        path_out = sct.slash_at_the_end(path_out, 1)
+        sct.create_folder(path_out)
+        moco.apply_motion_parameters(param.fname_data, os.path.abspath(param.fname_params), path_out+file_data+param.suffix+ext_data, param.interp, param.verbose)
+        sct.printv('\nFinished! Elapsed time: '+str(int(round(time.time() - start_time)))+'s', param.verbose)
+        return
+
     # create temporary folder
     sct.printv('\nCreate temporary folder...', param.verbose)
     path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
@@ -175,6 +193,7 @@ def main():
     sct.generate_output_file(path_tmp+dmri_name+param.suffix+ext, path_out+file_data+param.suffix+ext_data, param.verbose)
     sct.generate_output_file(path_tmp+'b0_mean.nii', path_out+'b0'+param.suffix+'_mean'+ext_data, param.verbose)
     sct.generate_output_file(path_tmp+'dwi_mean.nii', path_out+'dwi'+param.suffix+'_mean'+ext_data, param.verbose)
+    sct.generate_output_file(path_tmp+'mat_final/'+moco.FILE_PARAMS, path_out+file_data+param.suffix+'_params.npz', param.verbose)
 
     # Delete temporary files
     if param.remove_tmp_files == 1:
@@ -202,7 +221,6 @@ def dmri_moco(param):
     mat_final = 'mat_final/'
     file_dwi_group = 'dwi_averaged_groups'  # no extension
     fsloutput = 'export FSLOUTPUTTYPE=NIFTI; '  # for faster processing, all outputs are in NIFTI
-    ext_mat = 'Warp.nii.gz'  # warping field
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
@@ -221,33 +239,24 @@ def dmri_moco(param):
 
     # Prepare NIFTI (mean/groups...)
     #===================================================================================================================
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', param.verbose)
-    im_data_split_list = split_data(im_data, 3)
-    for im in im_data_split_list:
-        im.save()
+    # Volumes are selected and averaged in memory (see sct_dmri_separate_b0_and_dwi)
+    data = im_data.data
 
     # Merge b=0 images
     sct.printv('\nMerge b=0...', param.verbose)
-    # cmd = fsloutput + 'fslmerge -t ' + file_b0
-    # for it in range(nb_b0):
-    #     cmd = cmd + ' ' + file_data + '_T' + str(index_b0[it]).zfill(4)
-    im_b0_list = []
-    for it in range(nb_b0):
-        im_b0_list.append(im_data_split_list[index_b0[it]])
-    im_b0_out = concat_data(im_b0_list, 3)
-    im_b0_out.setFileName(file_b0 + ext_data)
-    im_b0_out.save()
+    save_volumes(im_data, data[..., index_b0], file_b0 + ext_data, param.verbose)
     sct.printv(('  File created: ' + file_b0), param.verbose)
 
-    # Average b=0 images
-    sct.printv('\nAverage b=0...', param.verbose)
-    file_b0_mean = file_b0+'_mean'
-    sct.run('sct_maths -i '+file_b0+ext_data+' -o '+file_b0_mean+ext_data+' -mean t', param.verbose)
-    # if not average_data_across_dimension(file_b0+'.nii', file_b0_mean+'.nii', 3):
-    #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-    # cmd = fsloutput + 'fslmaths ' + file_b0 + ' -Tmean ' + file_b0_mean
-    # status, output = sct.run(cmd, param.verbose)
+    # Target for registration of b=0 images
+    if index_dwi[0] != 0:
+        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
+        # select it as the target image for registration of all b=0
+        index_target_b0 = index_b0[index_dwi[0]-1]
+    else:
+        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
+        index_target_b0 = index_b0[0]
+    file_target_b0 = file_data + '_T' + str(index_target_b0).zfill(4)
+    save_volumes(im_data, data[..., index_target_b0], file_target_b0 + ext_data, param.verbose)
 
     # Number of DWI groups
     nb_groups = int(math.floor(nb_dwi/param.group_size))
@@ -263,49 +272,13 @@ def dmri_moco(param):
         nb_groups += 1
         group_indexes.append(index_dwi[len(index_dwi)-nb_remaining:len(index_dwi)])
 
-    # DWI groups
-    file_dwi_mean = []
-    for iGroup in range(nb_groups):
-        sct.printv('\nDWI group: ' +str((iGroup+1))+'/'+str(nb_groups), param.verbose)
-
-        # get index
-        index_dwi_i = group_indexes[iGroup]
-        nb_dwi_i = len(index_dwi_i)
-
-        # Merge DW Images
-        sct.printv('Merge DW images...', param.verbose)
-        file_dwi_merge_i = file_dwi + '_' + str(iGroup)
-
-        im_dwi_list = []
-        for it in range(nb_dwi_i):
-            im_dwi_list.append(im_data_split_list[index_dwi_i[it]])
-        im_dwi_out = concat_data(im_dwi_list, 3)
-        im_dwi_out.setFileName(file_dwi_merge_i + ext_data)
-        im_dwi_out.save()
-
-        # Average DW Images
-        sct.printv('Average DW images...', param.verbose)
-        file_dwi_mean.append(file_dwi + '_mean_' + str(iGroup))
-        sct.run('sct_maths -i '+file_dwi_merge_i+ext_data+' -o '+file_dwi_mean[iGroup]+ext_data+' -mean t', param.verbose)
-
-    # Merge DWI groups means
-    sct.printv('\nMerging DW files...', param.verbose)
-    # file_dwi_groups_means_merge = 'dwi_averaged_groups'
-    im_dw_list = []
-    for iGroup in range(nb_groups):
-        im_dw_list.append(Image(file_dwi_mean[iGroup] + ext_data))
-    im_dw_out = concat_data(im_dw_list, 3)
-    im_dw_out.setFileName(file_dwi_group + ext_data)
-    im_dw_out.save()
-    # cmd = fsloutput + 'fslmerge -t ' + file_dwi_group
-    # for iGroup in range(nb_groups):
-    #     cmd = cmd + ' ' + file_dwi + '_mean_' + str(iGroup)
-
-    # Average DW Images
-    # TODO: USEFULL ???
-    sct.printv('\nAveraging all DW images...', param.verbose)
-    fname_dwi_mean = file_dwi+'_mean'
-    sct.run('sct_maths -i '+file_dwi_group+ext_data+' -o '+file_dwi_group+'_mean'+ext_data+' -mean t', param.verbose)
+    # Average DWI groups and merge group means
+    sct.printv('\nAverage DWI groups ('+str(nb_groups)+')...', param.verbose)
+    data_dwi_groups = average_groups(data, group_indexes)
+    save_volumes(im_data, data_dwi_groups, file_dwi_group + ext_data, param.verbose)
+    # mean of first group: reference for reslicing
+    file_dwi_mean_0 = file_dwi + '_mean_0'
+    save_volumes(im_data, data_dwi_groups[..., 0], file_dwi_mean_0 + ext_data, param.verbose)
 
     # segment dwi images using otsu algorithm
     if param.otsu:
@@ -339,13 +312,7 @@ def dmri_moco(param):
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco = param
     param_moco.file_data = 'b0'
-    if index_dwi[0] != 0:
-        # If first DWI is not the first volume (most common), then there is a least one b=0 image before. In that case
-        # select it as the target image for registration of all b=0
-        param_moco.file_target = file_data + '_T' + str(index_b0[index_dwi[0]-1]).zfill(4)
-    else:
-        # If first DWI is the first volume, then the target b=0 is the first b=0 from the index_b0.
-        param_moco.file_target = file_data + '_T' + str(index_b0[0]).zfill(4)
+    param_moco.file_target = file_target_b0
     param_moco.path_out = ''
     param_moco.todo = 'estimate'
     param_moco.mat_moco = 'mat_b0groups'
@@ -366,17 +333,17 @@ def dmri_moco(param):
     # create final mat folder
     sct.create_folder(mat_final)
 
-    # Copy b=0 registration matrices
-    sct.printv('\nCopy b=0 registration matrices...', param.verbose)
-
-    for it in range(nb_b0):
-        sct.run('cp '+'mat_b0groups/'+'mat.T'+str(it)+ext_mat+' '+mat_final+'mat.T'+str(index_b0[it])+ext_mat, param.verbose)
-
-    # Copy DWI registration matrices
-    sct.printv('\nCopy DWI registration matrices...', param.verbose)
+    # Gather motion parameters of b=0 and DWI groups
+    sct.printv('\nGather motion parameters...', param.verbose)
+    params_b0 = moco.MotionParameters.load('mat_b0groups/'+moco.FILE_PARAMS)
+    params_dwi = moco.MotionParameters.load('mat_dwigroups/'+moco.FILE_PARAMS)
+    params_final = moco.MotionParameters(nt, nz, params_dwi.header)
+    params_final.translations[index_b0] = params_b0.translations
+    params_final.failed[index_b0] = params_b0.failed
     for iGroup in range(nb_groups):
-        for dwi in range(len(group_indexes[iGroup])):
-            sct.run('cp '+'mat_dwigroups/'+'mat.T'+str(iGroup)+ext_mat+' '+mat_final+'mat.T'+str(group_indexes[iGroup][dwi])+ext_mat, param.verbose)
+        params_final.translations[group_indexes[iGroup]] = params_dwi.translations[iGroup]
+        params_final.failed[group_indexes[iGroup]] = params_dwi.failed[iGroup]
+    params_final.save(mat_final+moco.FILE_PARAMS)
 
     # Spline Regularization along T
     if param.spline_fitting:
@@ -393,7 +360,7 @@ def dmri_moco(param):
     sct.printv('  Apply moco', param.verbose)
     sct.printv('-------------------------------------------------------------------------------', param.verbose)
     param_moco.file_data = file_data
-    param_moco.file_target = file_dwi+'_mean_'+str(0)  # reference for reslicing into proper coordinate system
+    param_moco.file_target = file_dwi_mean_0  # reference for reslicing into proper coordinate system
     param_moco.path_out = ''
     param_moco.mat_moco = mat_final
     param_moco.todo = 'apply'
@@ -408,10 +375,7 @@ def dmri_moco(param):
 
 
     # generate b0_moco_mean and dwi_moco_mean
-    cmd = 'sct_dmri_separate_b0_and_dwi -i '+file_data+param.suffix+ext_data+' -bvec bvecs.txt -a 1'
-    if not param.fname_bvals == '':
-        cmd = cmd+' -m '+param.fname_bvals
-    sct.run(cmd, param.verbose)
+    separate_b0_and_dwi(im_dmri_moco, index_b0, index_dwi, average=1, ext=ext_data, verbose=param.verbose)
 
 
 def get_parser():
@@ -436,8 +400,8 @@ def get_parser():
                       example='dmri.nii.gz')
     parser.add_option(name='-bvec',
                       type_value='file',
-                      description='Bvecs file',
-                      mandatory=True,
+                      description='Bvecs file. Mandatory, except with -mat.',
+                      mandatory=False,
                       example='bvecs.nii.gz')
     parser.add_option(name='-b',
                       type_value=None,
@@ -492,6 +456,11 @@ def get_parser():
                                   '4) metric: {MI,MeanSquares}. If you find very large deformations, switching to MeanSquares can help.',
                       mandatory=False,
                       deprecated_by='-param')
+    parser.add_option(name='-mat',
+                      type_value='file',
+                      description='Motion parameters estimated by a previous run (file *_moco_params.npz of the output folder). Motion correction is applied to input data, which must have the same geometry and number of volumes, without estimation.',
+                      mandatory=False,
+                      example='dmri_moco_params.npz')
     parser.add_option(name='-thr',
                       type_value='float',
                       description='Segment DW data using OTSU algorithm. Value corresponds to OTSU threshold. For no segmentation set to 0.',
@@ -520,6 +489,11 @@ def get_parser():
                       description='Output folder.',
                       mandatory=False,
                       deprecated_by='-o')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for motion correction. 0 or 1: no multiprocessing.",
+                      mandatory=False,
+                      example="8")
     parser.usage.addSection('MISC')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
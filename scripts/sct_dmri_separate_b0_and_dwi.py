@@ -19,9 +19,9 @@ import time
 
 import os
 import commands
+import numpy as np
 import sct_utils as sct
 from msct_image import Image
-from sct_image import split_data
 from msct_parser import Parser
 
 
@@ -71,93 +71,17 @@ def main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose, remov
     # Extract path, file and extension
     path_data, file_data, ext_data = sct.extract_fname(fname_data)
 
-    # # get output folder
-    # if path_out == '':
-    #     path_out = ''
-
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', verbose)
-    path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
-    sct.run('mkdir '+path_tmp, verbose)
-
-    # copy files into tmp folder and convert to nifti
-    sct.printv('\nCopy files into temporary folder...', verbose)
-    ext = '.nii'
-    dmri_name = 'dmri'
-    b0_name = 'b0'
-    b0_mean_name = b0_name+'_mean'
-    dwi_name = 'dwi'
-    dwi_mean_name = dwi_name+'_mean'
-
-    from sct_convert import convert
-    if not convert(fname_data, path_tmp+dmri_name+ext):
-        sct.printv('ERROR in convert.', 1, 'error')
-    sct.run('cp '+fname_bvecs+' '+path_tmp+'bvecs', verbose)
-
-    # go to tmp folder
-    os.chdir(path_tmp)
-
     # Get size of data
-    im_dmri = Image(dmri_name+ext)
+    im_dmri = Image(fname_data)
     sct.printv('\nGet dimensions data...', verbose)
     nx, ny, nz, nt, px, py, pz, pt = im_dmri.dim
     sct.printv('.. '+str(nx)+' x '+str(ny)+' x '+str(nz)+' x '+str(nt), verbose)
 
     # Identify b=0 and DWI images
-    print fname_bvals
     index_b0, index_dwi, nb_b0, nb_dwi = identify_b0(fname_bvecs, fname_bvals, param.bval_min, verbose)
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', verbose)
-    im_dmri_split_list = split_data(im_dmri, 3)
-    for im_d in im_dmri_split_list:
-        im_d.save()
-
-    # Merge b=0 images
-    sct.printv('\nMerge b=0...', verbose)
-    cmd = 'sct_image -concat t -o '+b0_name+ext+' -i '
-    for it in range(nb_b0):
-        cmd = cmd+dmri_name+'_T' + str(index_b0[it]).zfill(4)+ext+','
-    cmd = cmd[:-1]  # remove ',' at the end of the string
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue
-    status, output = sct.run(cmd, param.verbose)
-
-    # Average b=0 images
-    if average:
-        sct.printv('\nAverage b=0...', verbose)
-        sct.run('sct_maths -i '+b0_name+ext+' -o '+b0_mean_name+ext+' -mean t', verbose)
-
-    # Merge DWI
-    cmd = 'sct_image -concat t -o '+dwi_name+ext+' -i '
-    for it in range(nb_dwi):
-        cmd = cmd+dmri_name+'_T' + str(index_dwi[it]).zfill(4) + ext+ ','
-    cmd = cmd[:-1]  # remove ',' at the end of the string
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue
-    status, output = sct.run(cmd, param.verbose)
-
-    # Average DWI images
-    if average:
-        sct.printv('\nAverage DWI...', verbose)
-        sct.run('sct_maths -i '+dwi_name+ext+' -o '+dwi_mean_name+ext+' -mean t', verbose)
-        # if not average_data_across_dimension('dwi.nii', 'dwi_mean.nii', 3):
-        #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-        # sct.run(fsloutput + 'fslmaths dwi -Tmean dwi_mean', verbose)
-
-    # come back to parent folder
-    os.chdir('..')
-
-    # Generate output files
-    sct.printv('\nGenerate output files...', verbose)
-    sct.generate_output_file(path_tmp+b0_name+ext, path_out+b0_name+ext_data, verbose)
-    sct.generate_output_file(path_tmp+dwi_name+ext, path_out+dwi_name+ext_data, verbose)
-    if average:
-        sct.generate_output_file(path_tmp+b0_mean_name+ext, path_out+b0_mean_name+ext_data, verbose)
-        sct.generate_output_file(path_tmp+dwi_mean_name+ext, path_out+dwi_mean_name+ext_data, verbose)
-
-    # Remove temporary files
-    if remove_tmp_files == 1:
-        sct.printv('\nRemove temporary files...', verbose)
-        sct.run('rm -rf '+path_tmp, verbose)
+    # Separate (and average) b=0 and DWI images
+    separate_b0_and_dwi(im_dmri, index_b0, index_dwi, average, path_out, ext_data, verbose)
 
     # display elapsed time
     elapsed_time = time.time() - start_time
@@ -171,6 +95,57 @@ def main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose, remov
         sct.printv('fslview b0 dwi &\n', verbose)
 
 
+# ==========================================================================================
+# separate b=0 and DW images
+# ==========================================================================================
+def separate_b0_and_dwi(im_dmri, index_b0, index_dwi, average=1, path_out='', ext='.nii', verbose=1):
+    """
+    Write b=0 and DW images of 4D data in path_out (b0, dwi, and if average: b0_mean, dwi_mean). Volumes are selected
+    and averaged in memory.
+    :param im_dmri: Image (4D)
+    :param index_b0, index_dwi: indexes of volumes (see identify_b0())
+    :return: list of output file names
+    """
+    data = im_dmri.data
+    list_fname = [path_out+'b0'+ext, path_out+'dwi'+ext]
+    sct.printv('\nMerge b=0...', verbose)
+    save_volumes(im_dmri, data[..., index_b0], list_fname[0], verbose)
+    sct.printv('\nMerge DWI...', verbose)
+    save_volumes(im_dmri, data[..., index_dwi], list_fname[1], verbose)
+    if average:
+        sct.printv('\nAverage b=0...', verbose)
+        list_fname.append(save_volumes(im_dmri, average_groups(data, [index_b0])[..., 0], path_out+'b0_mean'+ext, verbose))
+        sct.printv('\nAverage DWI...', verbose)
+        list_fname.append(save_volumes(im_dmri, average_groups(data, [index_dwi])[..., 0], path_out+'dwi_mean'+ext, verbose))
+    return list_fname
+
+
+def average_groups(data, group_indexes):
+    """
+    Average groups of volumes of 4D data (equivalent to: sct_maths -mean t on each group).
+    :param data: 4D array
+    :param group_indexes: list of lists of volume indexes
+    :return: 4D array of float (one volume per group)
+    """
+    data_mean = np.zeros(data.shape[:3] + (len(group_indexes), ))
+    for i_group, index in enumerate(group_indexes):
+        data_mean[..., i_group] = np.mean(data[..., index], axis=3)
+    return data_mean
+
+
+def save_volumes(im, data, fname, verbose=1):
+    """
+    Write data (volumes of image im, or their average) with the header of im. Data type of im is kept.
+    :return: fname
+    """
+    from copy import deepcopy
+    from msct_pipeline import update_dim
+    im_out = Image(data, hdr=deepcopy(im.hdr), orientation=im.orientation, absolutepath=fname, verbose=verbose)
+    update_dim(im_out)
+    im_out.save(verbose=verbose)
+    return fname
+
+
 # ==========================================================================================
 # identify b=0 and DW images
 # ==========================================================================================
@@ -368,7 +343,7 @@ if __name__ == "__main__":
     if '-bvalmin' in arguments:
         param.bval_min = arguments['-bvalmin']
     if '-a' in arguments:
-        average = arguments['-a']
+        average = int(arguments['-a'])
     if '-ofolder' in arguments:
         path_out = arguments['-ofolder']
     if '-v' in arguments:
@@ -25,10 +25,12 @@ from glob import glob
 import time
 import nibabel as nib
 import numpy as np
+from scipy import sparse
 import sct_utils as sct
 from sct_image import get_orientation_3d, set_orientation
 from msct_image import Image
 from msct_parser import Parser
+from msct_atlas import SparseAtlas
 
 # get path of the script and the toolbox
 path_script = os.path.dirname(__file__)
@@ -60,8 +62,8 @@ def get_parser():
     parser = Parser(__file__)
     parser.usage.set_description("""This program extracts metrics (e.g., DTI or MTR) within labels. The labels are generated with 'sct_warp_template'. The label folder contains a file (info_label.txt) that describes all labels. The labels should be in the same space coordinates as the input image.""")
     parser.add_option(name='-i',
-                      type_value='image_nifti',
-                      description='File to extract metrics from.',
+                      type_value=[[','], 'image_nifti'],
+                      description='File to extract metrics from. Several metrics (e.g., FA,MD,RD,AD) can be separated with ",": labels are loaded and the estimation is factorized once for all metrics, and results of all metrics are written in the same output file.',
                       mandatory=True,
                       example='FA.nii.gz')
     parser.add_option(name='-f',
@@ -132,6 +134,12 @@ bin: binarize mask (threshold=0.5)""",
                       mandatory=False,
                       example='2:5',
                       default_value=param_default.vertebral_levels)
+    parser.add_option(name='-perlevel',
+                      type_value='multiple_choice',
+                      description='1: estimate the metric within each vertebral level separately (all levels, or levels selected with flag -vert), and write results of all levels in the output file (.txt or .pickle).',
+                      mandatory=False,
+                      example=['0', '1'],
+                      default_value='0')
     parser.add_option(name='-v',
                       type_value='str',
                       description='Vertebral levels to estimate the metric across. Example: 2:9 for C2 to T2.',
@@ -183,8 +191,11 @@ To compute FA within labels 0, 2 and 3 within vertebral levels C2 to C7 using bi
     return parser
 
 
-def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, adv_param_user):
-    """Main."""
+def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, adv_param_user, per_level=0):
+    """Main.
+    :fname_data: metric file, or list of metric files (in the same space) to extract all metrics at once
+    :per_level: if 1, extract metrics within each vertebral level (levels selected by vertebral_levels, or all levels)
+    """
 
     # Initialization
     # fname_vertebral_labeling = param.fname_vertebral_labeling
@@ -211,7 +222,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
         ml_clusters = '0:29,30:35,36'
 
     # Find path to the vertebral labeling file if vertebral levels were specified by the user
-    if vertebral_levels:
+    if vertebral_levels or per_level:
         if slices_of_interest:  # impossible to select BOTH specific slices and specific vertebral levels
             sct.printv(parser.usage.generate(error='ERROR: You cannot select BOTH vertebral levels AND slice numbers.'))
         else:
@@ -234,7 +245,8 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
 
     # print parameters
     print '\nChecked parameters:'
-    print '  data ...................... '+fname_data
+    list_fname_data = fname_data if isinstance(fname_data, list) else [fname_data]
+    print '  data ...................... '+', '.join(list_fname_data)
     print '  folder label .............. '+path_label
     print '  estimation method ......... '+method
     print '  slices of interest ........ '+slices_of_interest
@@ -248,11 +260,9 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     # check syntax of labels asked by user
     labels_id_user = check_labels(indiv_labels_ids+combined_labels_ids, labels_user)
 
-    nb_labels = len(indiv_labels_files)
-
     # Load data
     # Check if the orientation of the data is RPI
-    input_im = Image(fname_data)
+    input_im = Image(list_fname_data[0])
     orientation_data = get_orientation_3d(input_im)
 
     if orientation_data != 'RPI':
@@ -261,19 +271,13 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
         path_tmp = sct.tmp_create()
         # metric
         sct.printv('\nChange metric image orientation and load it...', verbose)
-        im_orient = set_orientation(input_im, 'RPI', fname_out=path_tmp+'metric_RPI.nii')
-        data = im_orient.data
-        # labels
+        data = [set_orientation(Image(fname), 'RPI', fname_out=path_tmp+'metric_'+str(i_metric)+'_RPI.nii').data for i_metric, fname in enumerate(list_fname_data)]
+        # labels (reoriented in memory and stored as a sparse atlas)
         sct.printv('\nChange labels orientation and load them...', verbose)
-        labels = np.empty([nb_labels], dtype=object)
-        for i_label in range(0, nb_labels):
-            im_label = set_orientation(Image(path_label+indiv_labels_files[i_label]), 'RPI', fname_out=path_tmp+'label_'+str(i_label)+'_RPI.nii')
-            labels[i_label] = im_label.data
+        labels = SparseAtlas.load([path_label+fname for fname in indiv_labels_files], orientation='RPI', verbose=verbose)
         if fname_normalizing_label:  # if the "normalization" option is wanted,
-            normalizing_label = np.empty([1], dtype=object)  # choose this kind of structure so as to keep easily the compatibility with the rest of the code (dimensions: (1, x, y, z))
-            im_normalizing_label = set_orientation(Image(fname_normalizing_label), 'RPI', fname_out=path_tmp+'normalizing_label_RPI.nii')
-            normalizing_label[0] = im_normalizing_label.data
-        if vertebral_levels:  # if vertebral levels were selected,
+            normalizing_label = SparseAtlas.load([fname_normalizing_label], orientation='RPI', verbose=verbose)
+        if fname_vertebral_labeling:  # if vertebral levels were selected,
             im_vertebral_labeling = set_orientation(Image(fname_vertebral_labeling), 'RPI', fname_out=path_tmp+'vertebral_labeling_RPI.nii')
             data_vertebral_labeling = im_vertebral_labeling.data
         # Remove the temporary folder used to change the NIFTI files orientation into RPI
@@ -282,37 +286,57 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     else:
         # Load image
         sct.printv('\nLoad metric image...', verbose)
-        data = nib.load(fname_data).get_data()
+        data = [nib.load(fname).get_data() for fname in list_fname_data]
         sct.printv('\tDone.', verbose)
         # Load labels
         sct.printv('\nLoad labels...', verbose)
-        labels = np.empty([nb_labels], dtype=object)
-        for i_label in range(0, nb_labels):
-            labels[i_label] = nib.load(path_label+indiv_labels_files[i_label]).get_data()
+        labels = SparseAtlas.load([path_label+fname for fname in indiv_labels_files], verbose=verbose)
         if fname_normalizing_label:  # if the "normalization" option is wanted,
-            normalizing_label = np.empty([1], dtype=object)  # choose this kind of structure so as to keep easily the compatibility with the rest of the code (dimensions: (1, x, y, z))
-            normalizing_label[0] = nib.load(fname_normalizing_label).get_data()  # load the data of the normalizing label
-        if vertebral_levels:  # if vertebral levels were selected,
+            normalizing_label = SparseAtlas.load([fname_normalizing_label], verbose=verbose)
+        if fname_vertebral_labeling:  # if vertebral levels were selected,
             data_vertebral_labeling = nib.load(fname_vertebral_labeling).get_data()
         sct.printv('\tDone.', verbose)
 
 
-    # Change metric data type into floats for future manipulations (normalization)
-    data = np.float64(data)
+    # Check dimensions consistency between metrics
+    if len(set([data_metric.shape for data_metric in data])) != 1:
+        print '\nERROR: Metric data DO NOT HAVE SAME DIMENSIONS.'
+        sys.exit(2)
+
+    # Change metric data type into floats for future manipulations (normalization). Several metrics are stacked along
+    # the first dimension: (nb_metrics, nx, ny, nz)
+    if len(data) == 1:
+        data = np.float64(data[0])
+    else:
+        data = np.array(data, dtype=np.float64)
     data[np.isneginf(data)] = 0.0
     data[data < 0.0] = 0.0
     data[np.isnan(data)] = 0.0
     data[np.isposinf(data)] = np.nanmax(data)
 
     # Get dimensions of data and labels
-    nx, ny, nz = data.shape
-    nx_atlas, ny_atlas, nz_atlas = labels[0].shape
+    nx, ny, nz = data.shape[-3:]
+    nx_atlas, ny_atlas, nz_atlas = labels.shape
 
     # Check dimensions consistency between atlas and data
     if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
         print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
         sys.exit(2)
 
+    # Extract metric within each vertebral level
+    if per_level:
+        # index of slices of each vertebral level, computed once
+        slices_per_level = get_slices_per_level(data_vertebral_labeling)
+        list_levels = sorted(slices_per_level.keys())
+        if vertebral_levels:
+            vert_levels_list = [int(x) for x in vertebral_levels.split(':')]
+            list_levels = [level for level in list_levels if vert_levels_list[0] <= level <= vert_levels_list[-1]]
+        if not list_levels:
+            sct.printv('ERROR: No vertebral level '+vertebral_levels+' found in '+fname_vertebral_labeling, 1, 'error')
+        results_per_level = extract_metric_per_level(method, data, labels, slices_per_level, list_levels, indiv_labels_ids, combined_labels_id_groups, ml_clusters, adv_param, normalizing_label, normalization_method, verbose)
+        save_metrics_per_level(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, list_levels, slices_per_level, results_per_level, fname_output, fname_data, method, fname_normalizing_label)
+        return
+
     # Update the flag "slices_of_interest" according to the vertebral levels selected by user (if it's the case)
     if vertebral_levels:
         slices_of_interest, actual_vert_levels, warning_vert_levels = get_slices_matching_with_vertebral_levels(data, vertebral_levels, data_vertebral_labeling, verbose)
@@ -320,17 +344,16 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     # select slice of interest by cropping data and labels
     if slices_of_interest:
         data = remove_slices(data, slices_of_interest)
-        for i_label in range(0, nb_labels):
-            labels[i_label] = remove_slices(labels[i_label], slices_of_interest)
+        labels = labels.select_slices(get_slices_list(slices_of_interest))
         if fname_normalizing_label:  # if the "normalization" option was selected,
-            normalizing_label[0] = remove_slices(normalizing_label[0], slices_of_interest)
+            normalizing_label = normalizing_label.select_slices(get_slices_list(slices_of_interest))
 
     # Extract metric in the labels specified by the file info_label.txt from the atlas folder given in input
     # individual labels
     indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = extract_metric(method, data, labels, indiv_labels_ids, ml_clusters, adv_param, normalizing_label, normalization_method)
     # combined labels
-    combined_labels_value = np.zeros(len(combined_labels_id_groups), dtype=float)
-    combined_labels_std = np.zeros(len(combined_labels_id_groups), dtype=float)
+    combined_labels_value = np.empty(len(combined_labels_id_groups), dtype=object)
+    combined_labels_std = np.empty(len(combined_labels_id_groups), dtype=object)
     combined_labels_fract_vol = np.zeros(len(combined_labels_id_groups), dtype=float)
     for i_combined_labels in range(0, len(combined_labels_id_groups)):
         combined_labels_value[i_combined_labels], combined_labels_std[i_combined_labels], combined_labels_fract_vol[i_combined_labels] = extract_metric(method, data, labels, indiv_labels_ids, ml_clusters, adv_param, normalizing_label, normalization_method, combined_labels_id_groups[i_combined_labels])
@@ -373,43 +396,33 @@ def extract_metric(method, data, labels, indiv_labels_ids, ml_clusters='', adv_p
     # Initialization to default values
     clustered_labels, matching_cluster_labels = [], []
 
-    nb_labels_total = len(indiv_labels_ids)
-
     # check consistency of label input parameter (* LOI=Labels of Interest)
     list_ids_LOI = check_labels(indiv_labels_ids, combined_labels_id_group)  # If 'labels_of_interest' is empty, then label_id_user' contains the index of all labels in the file info_label.txt
 
+    # binarize or threshold atlas, depending on the method
+    labels = threshold_atlas(labels, method)
+
     if method == 'map':
         # get clustered labels
         clustered_labels, matching_cluster_labels = get_clustered_labels(ml_clusters, labels, list_ids_LOI, combined_labels_id_group, verbose)
 
     # if user wants to get unique value across labels, then combine all labels together
     if combined_labels_id_group:
-        sum_combined_labels = np.sum(labels[list_ids_LOI])  # sum the labels selected by user
-        if method == 'ml' or method == 'map':  # in case the maximum likelihood and the average across different labels are wanted
-            # merge labels
-            labels_tmp = np.empty([nb_labels_total - len(list_ids_LOI) + 1], dtype=object)
-            labels = np.delete(labels, list_ids_LOI)  # remove the labels selected by user
-            labels_tmp[0] = sum_combined_labels  # put the sum of the labels selected by user in first position of the tmp variable
-            for i_label in range(1, len(labels_tmp)):
-                labels_tmp[i_label] = labels[i_label-1]  # fill the temporary array with the values of the non-selected labels
-            labels = labels_tmp  # replace the initial labels value by the updated ones (with the summed labels)
-            del labels_tmp  # delete the temporary labels
-
-        else:  # in other cases than the maximum likelihood, we can remove other labels (not needed for estimation)
-            labels = np.empty(1, dtype=object)
-            labels[0] = sum_combined_labels  # we create a new label array that includes only the summed labels
+        # in case the maximum likelihood and the average across different labels are wanted, the sum of the labels
+        # selected by user is put in first position, followed by the non-selected labels. In other cases, we can remove
+        # other labels (not needed for estimation).
+        labels = threshold_atlas(labels.combine(list_ids_LOI, keep_other_tracts=method in ['ml', 'map']), method)
 
     if normalizing_label:  # if the "normalization" option is wanted
         sct.printv('\nExtract normalization values...', verbose)
         if normalization_method == 'sbs':  # case: the user wants to normalize slice-by-slice
             for z in range(0, data.shape[-1]):
-                normalizing_label_slice = np.empty([1], dtype=object)  # in order to keep compatibility with the function
-                # 'extract_metric_within_tract', define a new array for the slice z of the normalizing labels
-                normalizing_label_slice[0] = normalizing_label[0][..., z]
-                metric_normalizing_label = estimate_metric_within_tract(data[..., z], normalizing_label_slice, method, 0)
                 # estimate the metric mean in the normalizing label for the slice z
-                if metric_normalizing_label[0][0] != 0:
-                    data[..., z] = data[..., z]/metric_normalizing_label[0][0]  # divide all the slice z by this value
+                metric_normalizing_label = estimate_metric_within_tract(data[..., [z]], normalizing_label.select_slices([z]), method, 0)
+                # divide all the slice z by this value (for each metric)
+                value_normalizing_label = np.array(metric_normalizing_label[0][0], dtype=float)
+                value_normalizing_label[value_normalizing_label == 0] = 1
+                data[..., z] = data[..., z]/value_normalizing_label.reshape(value_normalizing_label.shape + (1, 1))
 
         elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
             metric_norm_label, metric_std_norm_label = estimate_metric_within_tract(data, normalizing_label, method, param.verbose)  # mean and std are lists
@@ -425,14 +438,77 @@ def extract_metric(method, data, labels, indiv_labels_ids, ml_clusters='', adv_p
         metric_in_labels = metric_in_labels[0]
         metric_std_in_labels = metric_std_in_labels[0]
 
-    # compute fractional volume for each label
-    fract_vol_per_label = np.zeros(metric_in_labels.size, dtype=float)
-    for i_label in range(0, metric_in_labels.size):
-        fract_vol_per_label[i_label] = np.sum(labels[i_label])
+    # compute fractional volume for each label (only the combined label in first position, if labels were combined)
+    fract_vol_per_label = labels.get_sum()
+    if combined_labels_id_group:
+        fract_vol_per_label = fract_vol_per_label[:1]
 
     return metric_in_labels, metric_std_in_labels, fract_vol_per_label
 
 
+def extract_metric_per_level(method, data, labels, slices_per_level, list_levels, indiv_labels_ids, combined_labels_id_groups, ml_clusters='', adv_param='', normalizing_label=[], normalization_method='', verbose=0):
+    """Extract metric in individual and combined labels, within each vertebral level.
+    For methods 'wa', 'bin' and 'wath' (without normalization), all levels are estimated in one pass: weighted sums of the
+    metric within each label are computed once per slice, then accumulated across the slices of each level. For other
+    methods, metrics are estimated for each level (the estimation depends on all voxels of the level).
+    :slices_per_level: index of slices of each level (see get_slices_per_level())
+    :list_levels: list of vertebral levels
+    :return: list (one item per level) of: indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol,
+    combined_labels_value, combined_labels_std, combined_labels_fract_vol
+    """
+    nb_indiv_labels, nb_combined_labels = len(indiv_labels_ids), len(combined_labels_id_groups)
+    results = []
+
+    if method in ['wa', 'bin', 'wath'] and not normalizing_label:
+        sct.printv('\nEstimate metric within labels for all vertebral levels...', verbose)
+        # weights of individual labels, followed by combined labels
+        labels = threshold_atlas(labels, method)
+        list_weights = [labels.weights] + [threshold_atlas(labels.combine(check_labels(indiv_labels_ids, group)), method).weights for group in combined_labels_id_groups]
+        weights = sparse.vstack(list_weights).tocsr()  # [nb_labels x nb_vox]
+        # metric values in the voxels of the atlas, and slice of each voxel
+        data2d = labels.sample(data).reshape(-1, len(labels.index))  # [nb_metrics x nb_vox]
+        nz = labels.shape[-1]
+        slice_vox = sparse.csr_matrix((np.ones(len(labels.index)), (np.arange(len(labels.index)), labels.index % nz)), shape=(len(labels.index), nz))
+        # sums of weights, weighted metric and weighted squared metric, in each slice, cumulated along z: [.. x nz+1]
+        def cumsum_slices(w):
+            sum_slices = w.dot(slice_vox).toarray()
+            return np.concatenate([np.zeros([sum_slices.shape[0], 1]), np.cumsum(sum_slices, axis=1)], axis=1)
+        cum_w = cumsum_slices(weights)  # [nb_labels x nz+1]
+        cum_wy = np.array([cumsum_slices(weights.multiply(data2d[i_metric])) for i_metric in range(data2d.shape[0])])  # [nb_metrics x nb_labels x nz+1]
+        cum_wy2 = np.array([cumsum_slices(weights.multiply(data2d[i_metric]**2)) for i_metric in range(data2d.shape[0])])
+        for level in list_levels:
+            slice_min, slice_max = slices_per_level[level]
+            sum_w = cum_w[:, slice_max+1] - cum_w[:, slice_min]
+            sum_wy = (cum_wy[:, :, slice_max+1] - cum_wy[:, :, slice_min]).T  # [nb_labels x nb_metrics]
+            sum_wy2 = (cum_wy2[:, :, slice_max+1] - cum_wy2[:, :, slice_min]).T
+            ind_labels = sum_w > ALMOST_ZERO
+            mean = np.zeros(sum_wy.shape)
+            std = np.zeros(sum_wy.shape)
+            mean[ind_labels] = sum_wy[ind_labels] / sum_w[ind_labels, np.newaxis]
+            std[ind_labels] = np.sqrt(np.maximum(sum_wy2[ind_labels] / sum_w[ind_labels, np.newaxis] - mean[ind_labels]**2, 0))
+            if data2d.shape[0] == 1 and data.ndim == len(labels.shape):
+                mean, std = mean[:, 0], std[:, 0]
+            results.append((list(mean[:nb_indiv_labels]), list(std[:nb_indiv_labels]), sum_w[:nb_indiv_labels],
+                            list(mean[nb_indiv_labels:]), list(std[nb_indiv_labels:]), sum_w[nb_indiv_labels:]))
+        return results
+
+    for level in list_levels:
+        slice_min, slice_max = slices_per_level[level]
+        sct.printv('\nVertebral level '+str(level)+' (slices '+str(slice_min)+':'+str(slice_max)+')...', verbose)
+        slices_list = range(slice_min, slice_max+1)
+        data_level = data[..., slices_list]
+        labels_level = labels.select_slices(slices_list)
+        normalizing_label_level = normalizing_label.select_slices(slices_list) if normalizing_label else []
+        indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = extract_metric(method, data_level, labels_level, indiv_labels_ids, ml_clusters, adv_param, normalizing_label_level, normalization_method)
+        combined_labels_value = np.empty(nb_combined_labels, dtype=object)
+        combined_labels_std = np.empty(nb_combined_labels, dtype=object)
+        combined_labels_fract_vol = np.zeros(nb_combined_labels, dtype=float)
+        for i_combined_labels in range(0, nb_combined_labels):
+            combined_labels_value[i_combined_labels], combined_labels_std[i_combined_labels], combined_labels_fract_vol[i_combined_labels] = extract_metric(method, data_level, labels_level, indiv_labels_ids, ml_clusters, adv_param, normalizing_label_level, normalization_method, combined_labels_id_groups[i_combined_labels])
+        results.append((indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol))
+    return results
+
+
 def read_label_file(path_info_label, file_info_label):
     """Read label.txt file which is located inside label folder."""
 
@@ -490,8 +566,33 @@ def read_label_file(path_info_label, file_info_label):
         return indiv_labels_ids, indiv_labels_names, indiv_labels_files, combined_labels_ids, combined_labels_names, combined_labels_id_groups
 
 
-def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, data_vertebral_labeling, verbose=1):
-    """Return the slices of the input image corresponding to the vertebral levels given as argument."""
+def get_slices_per_level(data_vertebral_labeling):
+    """Build the index of the slices of each vertebral level, in one pass over the vertebral labeling volume.
+    As in the comparison with the requested levels, voxels are matched on their exact value: non-integer values do not
+    belong to any level.
+    :data_vertebral_labeling: (nx,ny,nz) numpy array (value of each voxel: vertebral level)
+    :return: dict {level: (first slice, last slice)}
+    """
+    nz = data_vertebral_labeling.shape[2]
+    levels = data_vertebral_labeling.astype(int)
+    ind_positive = (levels > 0) & (levels == data_vertebral_labeling)
+    levels_positive = levels[ind_positive]
+    if levels_positive.size == 0:
+        return {}
+    z = np.nonzero(ind_positive)[2]
+    # presence of each level in each slice
+    presence = np.bincount(levels_positive * nz + z, minlength=(levels_positive.max() + 1) * nz).reshape(-1, nz) > 0
+    slices_per_level = {}
+    for level in np.flatnonzero(presence.any(axis=1)):
+        slices_level = np.flatnonzero(presence[level])
+        slices_per_level[int(level)] = (int(slices_level[0]), int(slices_level[-1]))
+    return slices_per_level
+
+
+def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, data_vertebral_labeling, verbose=1, slices_per_level=None):
+    """Return the slices of the input image corresponding to the vertebral levels given as argument.
+    :slices_per_level: index of slices of each level (see get_slices_per_level()). Computed if not provided.
+    """
 
     sct.printv('\nFind slices corresponding to vertebral levels...', verbose)
 
@@ -508,7 +609,9 @@ def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, dat
         sys.exit(2)
 
     # Extract the vertebral levels available in the metric image
-    vertebral_levels_available = np.array(list(set(data_vertebral_labeling[data_vertebral_labeling > 0])))
+    if slices_per_level is None:
+        slices_per_level = get_slices_per_level(data_vertebral_labeling)
+    vertebral_levels_available = np.array(sorted(slices_per_level.keys()))
 
     # Check if the vertebral levels selected are available
     warning=[]  # list of strings gathering the potential following warning(s) to be written in the output .txt file
@@ -552,7 +655,7 @@ def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, dat
         sct.printv('WARNING: the top vertebral level you selected is not available \n--> Selected the nearest superior level available: ' + str(int(vert_levels_list[1])), type='warning')
 
     # Extract metric data size X, Y, Z
-    [mx, my, mz] = metric_data.shape
+    [mx, my, mz] = metric_data.shape[-3:]
     # Extract vertebral labeling data size X, Y, Z
     [vx, vy, vz] = data_vertebral_labeling.shape
 
@@ -582,17 +685,11 @@ def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, dat
         print '    OK!'
 
     sct.printv('  Find slices corresponding to vertebral levels...', verbose)
-    # Extract the X, Y, Z positions of voxels belonging to the first vertebral level
-    X_bottom_level, Y_bottom_level, Z_bottom_level = (data_vertebral_labeling == vert_levels_list[0]).nonzero()
-    # Record the bottom and top slices of this level
-    slice_min_bottom = min(Z_bottom_level)
-    slice_max_bottom = max(Z_bottom_level)
-
-    # Extract the X, Y, Z positions of voxels belonging to the last vertebral level
-    X_top_level, Y_top_level, Z_top_level = (data_vertebral_labeling == vert_levels_list[1]).nonzero()
-    # Record the bottom and top slices of this level
-    slice_min_top = min(Z_top_level)
-    slice_max_top = max(Z_top_level)
+    # Record the bottom and top slices of the first vertebral level
+    slice_min_bottom, slice_max_bottom = slices_per_level[int(vert_levels_list[0])]
+
+    # Record the bottom and top slices of the last vertebral level
+    slice_min_top, slice_max_top = slices_per_level[int(vert_levels_list[1])]
 
     # Take into account the case where the ordering of the slice is reversed compared to the ordering of the vertebral
     # levels (usually the case) and if several slices include two different vertebral levels
@@ -611,8 +708,8 @@ def get_slices_matching_with_vertebral_levels(metric_data, vertebral_levels, dat
     return str(slice_min)+':'+str(slice_max), vert_levels_list, warning
 
 
-def remove_slices(data_to_crop, slices_of_interest):
-    """Crop data to only keep the slices asked by user."""
+def get_slices_list(slices_of_interest):
+    """Get the list of slices from the slices asked by user (e.g. '2:5' or '2,3,4')."""
 
     # check if user selected specific slices using delimitor ','
     if not slices_of_interest.find(',') == -1:
@@ -624,6 +721,14 @@ def remove_slices(data_to_crop, slices_of_interest):
             slices_range = [slices_range[0], slices_range[0]]
         slices_list = [i for i in range(slices_range[0], slices_range[1]+1)]
 
+    return slices_list
+
+
+def remove_slices(data_to_crop, slices_of_interest):
+    """Crop data to only keep the slices asked by user."""
+
+    slices_list = get_slices_list(slices_of_interest)
+
     # Remove slices that are not wanted (+1 is to include the last selected slice as Python "includes -1"
     data_cropped = data_to_crop[..., slices_list]
 
@@ -631,10 +736,16 @@ def remove_slices(data_to_crop, slices_of_interest):
 
 
 def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert=None, warning_vert_levels=None):
-    """Save results in the output type selected by user."""
+    """Save results in the output type selected by user.
+    If fname_data is a list of metric files, values and stds of each label are arrays with one value per metric."""
 
     sct.printv('\nSaving results in: '+fname_output+' ...')
 
+    # list of metric files, and results of each label as arrays (one value per metric)
+    list_fname_data = fname_data if isinstance(fname_data, list) else [fname_data]
+    nb_metrics = len(list_fname_data)
+    indiv_labels_value, indiv_labels_std, combined_labels_value, combined_labels_std = [[np.atleast_1d(np.array(value, dtype=float)) for value in list_values] for list_values in [indiv_labels_value, indiv_labels_std, combined_labels_value, combined_labels_std]]
+
     # define vertebral levels and slices fields
     if actual_vert:
         vertebral_levels_field = str(int(actual_vert[0])) + ' to ' + str(int(actual_vert[1]))
@@ -665,7 +776,7 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         # Write date and time
         fid_metric.write('# Date - Time: '+ time.strftime('%Y/%m/%d - %H:%M:%S'))
         # Write metric data file path
-        fid_metric.write('\n'+'# Metric file: '+ os.path.abspath(fname_data))
+        fid_metric.write('\n'+'# Metric file: '+ ', '.join([os.path.abspath(fname) for fname in list_fname_data]))
         # If it's the case, write the label used to normalize the metric estimation:
         if fname_normalizing_label:
             fid_metric.write('\n'+'# Label used to normalize the metric estimation slice-by-slice: '+fname_normalizing_label)
@@ -679,7 +790,11 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         fid_metric.write('\n'+'# Slices (z): '+slices_of_interest_field)
 
         # label headers
-        fid_metric.write('%s' % ('\n'+'# ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n'))
+        if nb_metrics == 1:
+            fid_metric.write('%s' % ('\n'+'# ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n'))
+        else:
+            fid_metric.write('%s' % ('\n'+'# ID, label name, total fractional volume of the label (in number of voxels), '+', '.join(['metric value ('+sct.extract_fname(fname)[1]+'), metric stdev within label ('+sct.extract_fname(fname)[1]+')' for fname in list_fname_data])+'\n\n'))
+        format_values = ', %f, %f' * nb_metrics + '\n'
 
         # WRITE RESULTS
         labels_id_user.sort()
@@ -697,10 +812,10 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
             # display result for this label
             if section == '\n# White matter atlas\n':
                 index = indiv_labels_ids.index(i_label_user)
-                fid_metric.write('%i, %s, %f, %f, %f\n' % (indiv_labels_ids[index], indiv_labels_names[index], indiv_labels_fract_vol[index], indiv_labels_value[index], indiv_labels_std[index]))
+                fid_metric.write('%i, %s, %f' % (indiv_labels_ids[index], indiv_labels_names[index], indiv_labels_fract_vol[index]) + format_values % tuple(np.ravel(zip(indiv_labels_value[index], indiv_labels_std[index]))))
             elif section == '\n# Combined labels\n':
                 index = combined_labels_ids.index(i_label_user)
-                fid_metric.write('%i, %s, %f, %f, %f\n' % (combined_labels_ids[index], combined_labels_names[index], combined_labels_fract_vol[index], combined_labels_value[index], combined_labels_std[index]))
+                fid_metric.write('%i, %s, %f' % (combined_labels_ids[index], combined_labels_names[index], combined_labels_fract_vol[index]) + format_values % tuple(np.ravel(zip(combined_labels_value[index], combined_labels_std[index]))))
 
         # Close file .txt
         fid_metric.close()
@@ -747,33 +862,34 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
 
             row_index = 1
 
-        # iterate on user's labels
+        # iterate on user's labels (and metrics)
         for i_label_user in labels_id_user:
-            sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
-            sh.write(row_index, 1, os.path.abspath(fname_data))
-            sh.write(row_index, 2, method)
-            sh.write(row_index, 3, vertebral_levels_field)
-            sh.write(row_index, 4, slices_of_interest_field)
-            if fname_normalizing_label:
-                sh.write(row_index, 10, fname_normalizing_label)
-
-            # display result for this label
-            if i_label_user <= max(indiv_labels_ids):
-                index = indiv_labels_ids.index(i_label_user)
-                sh.write(row_index, 5, indiv_labels_ids[index])
-                sh.write(row_index, 6, indiv_labels_names[index])
-                sh.write(row_index, 7, indiv_labels_fract_vol[index])
-                sh.write(row_index, 8, indiv_labels_value[index])
-                sh.write(row_index, 9, indiv_labels_std[index])
-            elif i_label_user > max(indiv_labels_ids):
-                index = combined_labels_ids.index(i_label_user)
-                sh.write(row_index, 5, combined_labels_ids[index])
-                sh.write(row_index, 6, combined_labels_names[index])
-                sh.write(row_index, 7, combined_labels_fract_vol[index])
-                sh.write(row_index, 8, combined_labels_value[index])
-                sh.write(row_index, 9, combined_labels_std[index])
-
-            row_index += 1
+            for i_metric in range(0, nb_metrics):
+                sh.write(row_index, 0, time.strftime('%Y/%m/%d - %H:%M:%S'))
+                sh.write(row_index, 1, os.path.abspath(list_fname_data[i_metric]))
+                sh.write(row_index, 2, method)
+                sh.write(row_index, 3, vertebral_levels_field)
+                sh.write(row_index, 4, slices_of_interest_field)
+                if fname_normalizing_label:
+                    sh.write(row_index, 10, fname_normalizing_label)
+
+                # display result for this label
+                if i_label_user <= max(indiv_labels_ids):
+                    index = indiv_labels_ids.index(i_label_user)
+                    sh.write(row_index, 5, indiv_labels_ids[index])
+                    sh.write(row_index, 6, indiv_labels_names[index])
+                    sh.write(row_index, 7, indiv_labels_fract_vol[index])
+                    sh.write(row_index, 8, indiv_labels_value[index][i_metric])
+                    sh.write(row_index, 9, indiv_labels_std[index][i_metric])
+                elif i_label_user > max(indiv_labels_ids):
+                    index = combined_labels_ids.index(i_label_user)
+                    sh.write(row_index, 5, combined_labels_ids[index])
+                    sh.write(row_index, 6, combined_labels_names[index])
+                    sh.write(row_index, 7, combined_labels_fract_vol[index])
+                    sh.write(row_index, 8, combined_labels_value[index][i_metric])
+                    sh.write(row_index, 9, combined_labels_std[index][i_metric])
+
+                row_index += 1
 
         book.save(fname_output)
 
@@ -784,7 +900,7 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         metric_extraction_results = {}
 
         metric_extraction_results['Date - Time'] = time.strftime('%Y/%m/%d - %H:%M:%S')
-        metric_extraction_results['Metric file'] = os.path.abspath(fname_data)
+        metric_extraction_results['Metric file'] = os.path.abspath(fname_data) if nb_metrics == 1 else [os.path.abspath(fname) for fname in list_fname_data]
         metric_extraction_results['Extraction method'] = method
         metric_extraction_results['Vertebral levels'] = vertebral_levels_field
         metric_extraction_results['Slices (z)'] = slices_of_interest_field
@@ -818,8 +934,9 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
         metric_extraction_results['ID'] = np.array(ID_field)
         metric_extraction_results['Label name'] = np.array(Label_names_field)
         metric_extraction_results['Total fractional volume of the label (in number of voxels)'] = np.array(Fract_vol_field)
-        metric_extraction_results['Metric value'] = np.array(Metric_value_field)
-        metric_extraction_results['Metric STDEV within label'] = np.array(Metric_std_field)
+        # one column per metric if several metrics were extracted
+        metric_extraction_results['Metric value'] = np.array(Metric_value_field) if nb_metrics > 1 else np.array(Metric_value_field)[:, 0]
+        metric_extraction_results['Metric STDEV within label'] = np.array(Metric_std_field) if nb_metrics > 1 else np.array(Metric_std_field)[:, 0]
 
         # save results into a pickle file
         import pickle
@@ -830,6 +947,72 @@ def save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_la
     sct.printv('\tDone.')
 
 
+def save_metrics_per_level(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, list_levels, slices_per_level, results_per_level, fname_output, fname_data, method, fname_normalizing_label):
+    """Save results of all vertebral levels (see extract_metric_per_level()) in one file (.txt or .pickle)."""
+
+    sct.printv('\nSaving results in: '+fname_output+' ...')
+
+    list_fname_data = fname_data if isinstance(fname_data, list) else [fname_data]
+    nb_metrics = len(list_fname_data)
+
+    # one row per level and per label selected by user
+    rows = []
+    for level, results in zip(list_levels, results_per_level):
+        indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol = results
+        slices_field = str(slices_per_level[level][0])+':'+str(slices_per_level[level][1])
+        for i_label_user in sorted(labels_id_user):
+            if i_label_user <= max(indiv_labels_ids):
+                index = indiv_labels_ids.index(i_label_user)
+                row = [level, slices_field, indiv_labels_ids[index], indiv_labels_names[index], float(indiv_labels_fract_vol[index]), indiv_labels_value[index], indiv_labels_std[index]]
+            else:
+                index = combined_labels_ids.index(i_label_user)
+                row = [level, slices_field, combined_labels_ids[index], combined_labels_names[index], float(combined_labels_fract_vol[index]), combined_labels_value[index], combined_labels_std[index]]
+            row[5:] = [np.atleast_1d(np.array(value, dtype=float)) for value in row[5:]]
+            rows.append(row)
+
+    output_type = sct.extract_fname(fname_output)[2]
+    if output_type == '.txt':
+        fid_metric = open(fname_output, 'w')
+        fid_metric.write('# Date - Time: '+ time.strftime('%Y/%m/%d - %H:%M:%S'))
+        fid_metric.write('\n'+'# Metric file: '+ ', '.join([os.path.abspath(fname) for fname in list_fname_data]))
+        if fname_normalizing_label:
+            fid_metric.write('\n'+'# Label used to normalize the metric estimation slice-by-slice: '+fname_normalizing_label)
+        fid_metric.write('\n'+'# Extraction method: '+method)
+        if nb_metrics == 1:
+            fid_metric.write('\n'+'# Vertebral level, slices (z), ID, label name, total fractional volume of the label (in number of voxels), metric value, metric stdev within label\n\n')
+        else:
+            fid_metric.write('\n'+'# Vertebral level, slices (z), ID, label name, total fractional volume of the label (in number of voxels), '+', '.join(['metric value ('+sct.extract_fname(fname)[1]+'), metric stdev within label ('+sct.extract_fname(fname)[1]+')' for fname in list_fname_data])+'\n\n')
+        format_values = ', %f, %f' * nb_metrics + '\n'
+        for row in rows:
+            fid_metric.write('%i, %s, %i, %s, %f' % tuple(row[:5]) + format_values % tuple(np.ravel(zip(row[5], row[6]))))
+        fid_metric.close()
+
+    elif output_type == '.pickle':
+        metric_extraction_results = {}
+        metric_extraction_results['Date - Time'] = time.strftime('%Y/%m/%d - %H:%M:%S')
+        metric_extraction_results['Metric file'] = os.path.abspath(fname_data) if nb_metrics == 1 else [os.path.abspath(fname) for fname in list_fname_data]
+        metric_extraction_results['Extraction method'] = method
+        if fname_normalizing_label:
+            metric_extraction_results['Label used to normalize the metric estimation slice-by-slice'] = fname_normalizing_label
+        metric_extraction_results['Vertebral level'] = np.array([row[0] for row in rows])
+        metric_extraction_results['Slices (z)'] = np.array([row[1] for row in rows])
+        metric_extraction_results['ID'] = np.array([row[2] for row in rows])
+        metric_extraction_results['Label name'] = np.array([row[3] for row in rows])
+        metric_extraction_results['Total fractional volume of the label (in number of voxels)'] = np.array([row[4] for row in rows])
+        # one column per metric if several metrics were extracted
+        metric_extraction_results['Metric value'] = np.array([row[5] for row in rows]) if nb_metrics > 1 else np.array([row[5][0] for row in rows])
+        metric_extraction_results['Metric STDEV within label'] = np.array([row[6] for row in rows]) if nb_metrics > 1 else np.array([row[6][0] for row in rows])
+        import pickle
+        output_file = open(fname_output, 'wb')
+        pickle.dump(metric_extraction_results, output_file)
+        output_file.close()
+
+    else:
+        sct.printv('ERROR: Results per vertebral level can only be saved as .txt or .pickle files.', 1, 'error')
+
+    sct.printv('\tDone.')
+
+
 def check_method(method, fname_normalizing_label, normalization_method):
     """Check the consistency of the methods asked by the user."""
 
@@ -880,43 +1063,40 @@ def check_labels(indiv_labels_ids, selected_labels):
     return list_ids_of_labels_of_interest
 
 
+def threshold_atlas(labels, method):
+    """Binarize atlas if user asks for binary regions ('bin'), threshold atlas if user asks for thresholded weighted-average ('wath').
+    :labels: SparseAtlas
+    :return: SparseAtlas
+    """
+    if method == 'bin':
+        return labels.binarize(0.5)
+    if method == 'wath':
+        return labels.threshold(0.5)
+    return labels
+
+
 def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels=[], matching_cluster_labels=[], adv_param=[]):
     """Extract metric within labels.
-    :data: (nx,ny,nz) numpy array
-    :labels: nlabel tuple of (nx,ny,nz) array
+    :data: (nx,ny,nz) numpy array, or (nb_metrics,nx,ny,nz) to estimate several metrics at once (the label matrix and its
+    factorization are computed once for all metrics). In this case, metric_mean and metric_std contain arrays of size nb_metrics.
+    :labels: SparseAtlas of nlabel tracts of size (nx,ny,nz)
+    :clustered_labels: SparseAtlas of the clustered labels (for method 'map'), defined over the same voxels as labels
     """
 
-
     nb_labels = len(labels)  # number of labels
 
-    # if user asks for binary regions, binarize atlas
-    if method == 'bin':
-        for i in range(0, nb_labels):
-            labels[i][labels[i] < 0.5] = 0
-            labels[i][labels[i] >= 0.5] = 1
-
-    # if user asks for thresholded weighted-average, threshold atlas
-    if method == 'wath':
-        for i in range(0, nb_labels):
-            labels[i][labels[i] < 0.5] = 0
+    # binarize or threshold atlas, depending on the method
+    labels = threshold_atlas(labels, method)
 
     #  Select non-zero values in the union of all labels
-    labels_sum = np.sum(labels)
-    ind_positive_labels = labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
-    # ind_positive_data = data > -9999999999  # data > 0
-    ind_positive = ind_positive_labels  # & ind_positive_data
-    data1d = data[ind_positive]
-    nb_vox = len(data1d)
-    labels2d = np.empty([nb_labels, nb_vox], dtype=float)
-    for i in range(0, nb_labels):
-        labels2d[i] = labels[i][ind_positive]
-
-    # # display labels
-    # import matplotlib.pyplot as plt
-    # plt.imshow(labels_sum[:,:,3])
-    # plt.show()
-    # plt.imshow(data[:,:,3])
-    # plt.show()
+    labels_sum = np.asarray(labels.weights.sum(axis=0)).ravel()
+    ind_positive = labels_sum > ALMOST_ZERO
+    data1d = labels.sample(data)[..., ind_positive]  # [nb_vox] or [nb_metrics x nb_vox]
+    nb_vox = data1d.shape[-1]
+    labels2d = labels.weights[:, np.flatnonzero(ind_positive)].toarray()  # [nb_labels x nb_vox]
+    # metrics as columns
+    single_metric = data1d.ndim == 1
+    data2d = data1d.reshape(-1, nb_vox).T  # [nb_vox x nb_metrics]
 
     # Display number of non-zero values
     sct.printv('  Number of non-null voxels: '+str(nb_vox), verbose=verbose)
@@ -932,14 +1112,12 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         nb_clusters = len(clustered_labels)
 
         #  Select non-zero values in the union of the clustered labels
-        clustered_labels_sum = np.sum(clustered_labels)
-        ind_positive_clustered_labels = clustered_labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
+        clustered_labels_sum = np.asarray(clustered_labels.weights.sum(axis=0)).ravel()
+        ind_positive_clustered_labels = np.flatnonzero(clustered_labels_sum > ALMOST_ZERO)
 
-        y = data[ind_positive_clustered_labels]  # [nb_vox x 1]
+        y = clustered_labels.sample(data)[..., ind_positive_clustered_labels].reshape(-1, len(ind_positive_clustered_labels)).T  # [nb_vox x nb_metrics]
         # create matrix X to use ML and estimate beta_0
-        x = np.zeros([len(y), nb_clusters])
-        for i_cluster in range(0, nb_clusters):
-            x[:, i_cluster] = clustered_labels[i_cluster][ind_positive_clustered_labels]
+        x = clustered_labels.weights[:, ind_positive_clustered_labels].toarray().T  # [nb_vox x nb_clusters]
 
         # estimate values using ML for each cluster
         beta = np.dot( np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y) )  # beta = (Xt . X)-1 . Xt . y
@@ -951,29 +1129,32 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
 
     # Estimation with weighted average (also works for binary)
     if method == 'wa' or method == 'bin' or method == 'wath':
+        sum_labels = labels2d.sum(axis=1)
+        for i_label in np.flatnonzero(sum_labels == 0):
+            print 'WARNING: labels #'+str(i_label)+' contains only null voxels. Mean and std are set to 0.'
+        ind_labels = sum_labels != 0
+        mean = np.zeros([nb_labels, data2d.shape[1]])
+        std = np.zeros([nb_labels, data2d.shape[1]])
+        # estimate the weighted average
+        mean[ind_labels] = np.dot(labels2d[ind_labels], data2d) / sum_labels[ind_labels, np.newaxis]
+        # estimate the biased weighted standard deviation
+        for i_metric in range(0, data2d.shape[1]):
+            std[ind_labels, i_metric] = np.sqrt(np.sum(labels2d[ind_labels] * (data2d[:, i_metric] - mean[ind_labels, i_metric, np.newaxis])**2, axis=1) / sum_labels[ind_labels])
         for i_label in range(0, nb_labels):
-            # check if all labels are equal to zero
-            if sum(labels2d[i_label, :]) == 0:
-                print 'WARNING: labels #'+str(i_label)+' contains only null voxels. Mean and std are set to 0.'
-                metric_mean[i_label] = 0
-                metric_std[i_label] = 0
-            else:
-                # estimate the weighted average
-                metric_mean[i_label] = sum(data1d * labels2d[i_label, :]) / sum(labels2d[i_label, :])
-                # estimate the biased weighted standard deviation
-                metric_std[i_label] = np.sqrt(sum(labels2d[i_label, :] * (data1d - metric_mean[i_label])**2 ) / sum(labels2d[i_label, :]))
+            metric_mean[i_label] = mean[i_label, 0] if single_metric else mean[i_label]
+            metric_std[i_label] = std[i_label, 0] if single_metric else std[i_label]
 
     # Estimation with maximum likelihood
     if method == 'ml':
-        y = data1d  # [nb_vox x 1]
+        y = data2d  # [nb_vox x nb_metrics]
         x = labels2d.T  # [nb_vox x nb_labels]
-        beta = np.dot( np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y) )  # beta = (Xt . X)-1 . Xt . y
+        beta = np.dot( np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y) )  # beta = (Xt . X)-1 . Xt . y, for all metrics at once
         #beta, residuals, rank, singular_value = np.linalg.lstsq(np.dot(x.T, x), np.dot(x.T, y), rcond=-1)
         #beta, residuals, rank, singular_value = np.linalg.lstsq(x, y)
         #print beta, residuals, rank, singular_value
         for i_label in range(0, nb_labels):
-            metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
+            metric_mean[i_label] = beta[i_label, 0] if single_metric else beta[i_label]
+            metric_std[i_label] = 0 if single_metric else np.zeros(data2d.shape[1])  # need to assign a value for writing output file
 
     # Estimation with maximum a posteriori (map)
     if method == 'map':
@@ -981,10 +1162,10 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         var_label = int(adv_param[0]) ^ 2  # variance within label
         var_noise = int(adv_param[1]) ^ 2  # variance of the noise (assumed Gaussian)
 
-        y = data1d  # [nb_vox x 1]
+        y = data2d  # [nb_vox x nb_metrics]
         x = labels2d.T  # [nb_vox x nb_labels]
         # construct beta0
-        beta0 = np.zeros(nb_labels)
+        beta0 = np.zeros([nb_labels, data2d.shape[1]])
         for i_cluster in range(nb_clusters):
             beta0[np.where(np.asarray(matching_cluster_labels) == i_cluster)[0]] = beta[i_cluster]
         # construct covariance matrix (variance between tracts). For simplicity, we set it to be the identity.
@@ -1001,8 +1182,8 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         C = y - np.dot(x, beta0)
         beta = beta0 + np.dot(A, np.dot(B, C))
         for i_label in range(0, nb_labels):
-            metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
+            metric_mean[i_label] = beta[i_label, 0] if single_metric else beta[i_label]
+            metric_std[i_label] = 0 if single_metric else np.zeros(data2d.shape[1])  # need to assign a value for writing output file
 
     return metric_mean, metric_std
 
@@ -1011,10 +1192,10 @@ def get_clustered_labels(ml_clusters, labels, labels_user, averaging_flag, verbo
     """
     Cluster labels according to selected options (labels and averaging).
     :ml_clusters: clusters in form: '0:29,30,31'
-    :labels: all labels data
+    :labels: all labels data (SparseAtlas)
     :labels_user: label IDs selected by the user
     :averaging_flag: flag -a (0 or 1)
-    :return: clustered_labels: labels summed by clustered
+    :return: clustered_labels: labels summed by clustered (SparseAtlas)
     """
 
     # get the label IDs included in each cluster
@@ -1045,9 +1226,7 @@ def get_clustered_labels(ml_clusters, labels, labels_user, averaging_flag, verbo
     sct.printv('  Number of clusters: '+str(nb_clusters), verbose=verbose)
 
     # sum labels within each cluster
-    clustered_labels = np.empty([nb_clusters], dtype=object)  # labels(nb_labels_total, x, y, z)
-    for i_cluster in range(0, nb_clusters):
-        clustered_labels[i_cluster] = np.sum(labels[clusters_all_labels[i_cluster]])
+    clustered_labels = SparseAtlas(sparse.vstack([sparse.csr_matrix(labels.weights[clusters_all_labels[i_cluster]].sum(axis=0)) for i_cluster in range(0, nb_clusters)]), labels.index, labels.shape)
 
     # find matching between labels and clusters in the whole label id list
     matching_cluster_label_id = np.zeros(len(labels), dtype=int)
@@ -1078,6 +1257,8 @@ if __name__ == "__main__":
     vertebral_levels = ''
 
     fname_data = arguments['-i']
+    if len(fname_data) == 1:
+        fname_data = fname_data[0]
     path_label = sct.slash_at_the_end(arguments['-f'], 1)
     method = arguments['-method']
     labels_user = ''
@@ -1101,6 +1282,7 @@ if __name__ == "__main__":
     normalization_method = ''
     if '-norm-method' in arguments:
         normalization_method = arguments['-norm-method']
+    per_level = int(arguments['-perlevel'])
 
     # call main function
-    main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, adv_param_user)
+    main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, adv_param_user, per_level)
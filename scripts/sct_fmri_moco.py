@@ -47,6 +47,8 @@ class Param:
         self.interp = 'spline'  # nn, linear, spline
         self.min_norm = 0.001
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.cpu_number = 1  # number of volumes registered in parallel. 0 or 1: no multiprocessing
+        self.fname_params = ''  # motion parameters estimated by a previous run
 
 
 #=======================================================================================================================
@@ -84,6 +86,14 @@ def main(path_out, param_user):
     # Extract path, file and extension
     path_data, file_data, ext_data = sct.extract_fname(param.fname_data)
 
+    # apply motion parameters estimated by a previous run (no estimation)
+    if param.fname_params != '':
+        path_out = sct.slash_at_the_end(path_out, 1)
+        sct.create_folder(path_out)
+        moco.apply_motion_parameters(param.fname_data, os.path.abspath(param.fname_params), path_out+file_data+param.suffix+ext_data, param.interp, param.verbose)
+        sct.printv('\nFinished! Elapsed time: '+str(int(round(time.time() - start_time)))+'s', param.verbose)
+        return
+
     # create temporary folder
     sct.printv('\nCreate temporary folder...', param.verbose)
     path_tmp = sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
@@ -115,6 +125,7 @@ def main(path_out, param_user):
         print path_out+file_data+param.suffix+ext_data
     sct.generate_output_file(path_tmp+'fmri'+param.suffix+'.nii', path_out+file_data+param.suffix+ext_data, param.verbose)
     sct.generate_output_file(path_tmp+'fmri'+param.suffix+'_mean.nii', path_out+file_data+param.suffix+'_mean'+ext_data, param.verbose)
+    sct.generate_output_file(path_tmp+'mat_final/'+moco.FILE_PARAMS, path_out+file_data+param.suffix+'_params.npz', param.verbose)
 
     # Delete temporary files
     if param.remove_tmp_files == 1:
@@ -139,11 +150,10 @@ def fmri_moco(param):
     ext_data = '.nii'
     mat_final = 'mat_final/'
     fsloutput = 'export FSLOUTPUTTYPE=NIFTI; '  # for faster processing, all outputs are in NIFTI
-    ext_mat = 'Warp.nii.gz'  # warping field
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(file_data+'.nii').dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(file_data+'.nii', lazy=True).dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), param.verbose)
 
     # Split into T dimension
@@ -230,15 +240,14 @@ def fmri_moco(param):
     # create final mat folder
     sct.create_folder(mat_final)
 
-    # Copy registration matrices
-    sct.printv('\nCopy transformations...', param.verbose)
+    # Gather motion parameters of groups
+    sct.printv('\nGather motion parameters...', param.verbose)
+    params_groups = moco.MotionParameters.load('mat_groups/'+moco.FILE_PARAMS)
+    params_final = moco.MotionParameters(nt, nz, params_groups.header)
     for iGroup in range(nb_groups):
-        for data in range(len(group_indexes[iGroup])):
-            # if param.slicewise:
-            #     for iz in range(nz):
-            #         sct.run('cp '+'mat_dwigroups/'+'mat.T'+str(iGroup)+'_Z'+str(iz)+ext_mat+' '+mat_final+'mat.T'+str(group_indexes[iGroup][dwi])+'_Z'+str(iz)+ext_mat, param.verbose)
-            # else:
-            sct.run('cp '+'mat_groups/'+'mat.T'+str(iGroup)+ext_mat+' '+mat_final+'mat.T'+str(group_indexes[iGroup][data])+ext_mat, param.verbose)
+        params_final.translations[group_indexes[iGroup]] = params_groups.translations[iGroup]
+        params_final.failed[group_indexes[iGroup]] = params_groups.failed[iGroup]
+    params_final.save(mat_final+moco.FILE_PARAMS)
 
     # Apply moco on all fmri data
     sct.printv('\n-------------------------------------------------------------------------------', param.verbose)
@@ -312,6 +321,11 @@ def get_parser():
    If you find very large deformations, switching to MeanSquares can help.""",
                       mandatory=False,
                       deprecated_by='-param')
+    parser.add_option(name='-mat',
+                      type_value='file',
+                      description='Motion parameters estimated by a previous run (file *_moco_params.npz of the output folder). Motion correction is applied to input data, which must have the same geometry and number of volumes, without estimation.',
+                      mandatory=False,
+                      example='fmri_moco_params.npz')
     parser.add_option(name='-ofolder',
                       type_value='folder_creation',
                       description='Output path.',
@@ -329,6 +343,11 @@ def get_parser():
                       mandatory=False,
                       default_value='linear',
                       example=['nn', 'linear', 'spline'])
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for motion correction. 0 or 1: no multiprocessing.",
+                      mandatory=False,
+                      example="8")
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -366,5 +385,9 @@ if __name__ == "__main__":
     param.interp = arguments['-x']
     param.remove_tmp_files = arguments['-r']
     param.verbose = arguments['-v']
+    if '-mat' in arguments:
+        param.fname_params = arguments['-mat']
+    if '-cpu-nb' in arguments:
+        param.cpu_number = int(arguments['-cpu-nb'])
 
     main(path_out, param_user)
@@ -122,7 +122,7 @@ def get_centerline_from_point(input_image, point_file, gap=4, gaussian_kernel=4,
 
     # Get image dimensions
     print '\nGet image dimensions...'
-    nx, ny, nz, nt, px, py, pz, pt = Image('tmp.anat_orient.nii').dim
+    nx, ny, nz, nt, px, py, pz, pt = Image('tmp.anat_orient.nii', lazy=True).dim
     print '.. matrix size: '+str(nx)+' x '+str(ny)+' x '+str(nz)
     print '.. voxel size:  '+str(px)+'mm x '+str(py)+'mm x '+str(pz)+'mm'
 
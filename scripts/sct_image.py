@@ -13,7 +13,7 @@
 import sys
 from numpy import concatenate, shape, newaxis
 from msct_parser import Parser
-from msct_image import Image, get_dimension
+from msct_image import Image, ImageMetadata, get_dimension
 from sct_utils import printv, add_suffix, extract_fname, run, tmp_create
 
 
@@ -175,8 +175,8 @@ def main(args = None):
         im_out = [im_in]  #TODO: adapt to fname_in
 
     elif "-getorient" in arguments:
-        im_in = Image(fname_in[0])
-        orient = orientation(im_in, get=True, verbose=verbose)
+        # only the header is needed
+        orient = get_orientation(ImageMetadata(fname_in[0]))
         im_out = None
 
     elif "-setorient" in arguments:
@@ -299,11 +299,13 @@ def copy_header(im_src, im_dest):
 
 def split_data(im_in, dim):
     """
-    Split data
+    Split data. The data of the output images are views of the input data (no copy): modifying them in place also
+    modifies im_in.
     :param im_in: input image.
     :param dim: dimension: 0, 1, 2, 3.
     :return: list of split images
     """
+    from copy import deepcopy
     from numpy import array_split
     dim_list = ['x', 'y', 'z', 't']
     # Parse file name
@@ -313,64 +315,90 @@ def split_data(im_in, dim):
         data = data[..., newaxis]
     # Split data into list
     data_split = array_split(data, data.shape[dim], dim)
+    # dimensions of each split image
+    dim_split = list(im_in.dim)
+    dim_split[dim] = 1
     # Write each file
     im_out_list = []
     for i, dat in enumerate(data_split):
-        im_out = im_in.copy()
-        im_out.data = dat
+        im_out = Image(dat, hdr=deepcopy(im_in.hdr), orientation=im_in.orientation, absolutepath=im_in.absolutepath,
+                       dim=tuple(dim_split), verbose=im_in.verbose)
         im_out.setFileName(im_out.file_name+'_'+dim_list[dim].upper()+str(i).zfill(4)+im_out.ext)
         im_out_list.append(im_out)
 
     return im_out_list
 
 
-def concat_data(fname_in_list, dim):
+def _get_data_dtype(hdr):
+    """
+    Get the type of the data array that nibabel returns for a header (float64 if intensities are scaled).
+    """
+    from numpy import float64
+    slope, inter = hdr.get_slope_inter()
+    if slope in [None, 1] and inter in [None, 0]:
+        return hdr.get_data_dtype()
+    return float64
+
+
+def concat_data(fname_in_list, dim, memmap=False):
     """
-    Concatenate data
-    :param im_in_list: list of images.
+    Concatenate data. The output array is allocated once and filled image by image, so that only one input image is
+    in memory at a time.
+    :param fname_in_list: list of file names or Image objects.
     :param dim: dimension: 0, 1, 2, 3.
+    :param memmap: if True, output data are memory-mapped to a temporary file instead of being held in memory.
     :return im_out: concatenated image
     """
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue (results are different with both options)
-    from numpy import concatenate, expand_dims, squeeze
-
-    dat_list = []
-    data_concat_list = []
+    from copy import deepcopy
+    from numpy import empty, result_type
+    from numpy import memmap as np_memmap
+    from tempfile import TemporaryFile
+
+    # get shape and type of each input from the header only
+    list_shape, list_dtype = [], []
+    for im in fname_in_list:
+        if isinstance(im, Image):
+            list_shape.append(im.data.shape)
+            list_dtype.append(im.data.dtype)
+        else:
+            hdr = ImageMetadata(im).hdr
+            list_shape.append(hdr.get_data_shape())
+            list_dtype.append(_get_data_dtype(hdr))
 
     # check if shape of first image is smaller than asked dim to concatenate along
-    data0 = Image(fname_in_list[0]).data
-    if len(data0.shape) <= dim:
-        expand_dim = True
-    else:
-        expand_dim = False
-
-    for i, fname in enumerate(fname_in_list):
-        # if there is more than 100 images to concatenate, then it does it iteratively to avoid memory issue.
-        if i != 0 and i % 100 == 0:
-            data_concat_list.append(concatenate(dat_list, axis=dim))
-            im = Image(fname)
-            dat = im.data
-            if expand_dim:
-                dat = expand_dims(dat, dim)
-            dat_list = [dat]
-            del im
-            del dat
-        else:
-            im = Image(fname)
-            dat = im.data
-            if expand_dim:
-                dat = expand_dims(dat, dim)
-            dat_list.append(dat)
-            del im
-            del dat
-    if data_concat_list:
-        data_concat_list.append(concatenate(dat_list, axis=dim))
-        data_concat = concatenate(data_concat_list, axis=dim)
+    expand_dim = len(list_shape[0]) <= dim
+    if expand_dim:
+        list_shape = [tuple(s) + (1,) * (dim + 1 - len(s)) for s in list_shape]
+    shape_out = list(list_shape[0])
+    shape_out[dim] = sum([s[dim] for s in list_shape])
+    dtype_out = result_type(*list_dtype)
+
+    # allocate output
+    if memmap:
+        data_concat = np_memmap(TemporaryFile(), dtype=dtype_out, mode='w+', shape=tuple(shape_out))
     else:
-        data_concat = concatenate(dat_list, axis=dim)
-    # write file
-    im_out = Image(fname_in_list[0]).copy()
-    im_out.data = data_concat
+        data_concat = empty(tuple(shape_out), dtype=dtype_out)
+
+    # fill output
+    slices = [slice(None)] * len(shape_out)
+    i_start = 0
+    for i, im in enumerate(fname_in_list):
+        if not isinstance(im, Image):
+            im = Image(im, lazy=True)
+        dat = im.data
+        if expand_dim:
+            dat = dat.reshape(list_shape[i])
+        slices[dim] = slice(i_start, i_start + list_shape[i][dim])
+        data_concat[tuple(slices)] = dat
+        i_start += list_shape[i][dim]
+        del im, dat
+
+    # header of output is the header of the first image
+    im_0 = fname_in_list[0] if isinstance(fname_in_list[0], Image) else Image(fname_in_list[0], lazy=True)
+    im_out = Image(data_concat, hdr=deepcopy(im_0.hdr), orientation=im_0.orientation, absolutepath=im_0.absolutepath,
+                   verbose=im_0.verbose)
+    im_out.hdr.set_data_shape(data_concat.shape)
+    im_out.dim = get_dimension(im_out) if len(shape_out) <= 4 else im_0.dim
     im_out.setFileName(im_out.file_name+'_concat'+im_out.ext)
 
     return im_out
@@ -483,92 +511,41 @@ def multicomponent_merge(fname_list):
 
 def orientation(im, ori=None, set=False, get=False, set_data=False, verbose=1, fname_out=''):
     verbose = 0 if get else verbose
+    if get:
+        # orientation only depends on the header, whatever the number of dimensions
+        return get_orientation(im)
     printv('\nGet dimensions of data...', verbose)
     nx, ny, nz, nt, px, py, pz, pt = get_dimension(im)
-
-    printv(str(nx) + ' x ' + str(ny) + ' x ' + str(nz)+ ' x ' + str(nt), verbose)
-
-    # if data are 2d or 3d, get orientation from header using fslhd
-
-    if (nz == 1 or nt==1) and len(im.data.shape)<5:
-        if get:
-            try:
-                printv('\nGet orientation...', verbose)
-                im_out = None
-                ori = get_orientation(im)
-            except Exception, e:
-                printv('ERROR: an error occurred: \n'+str(e), verbose,'error')
-            return ori
-        elif set:
-            # set orientation
-            printv('\nChange orientation...', verbose)
-            im_out = set_orientation(im, ori)
-        elif set_data:
-            im_out = set_orientation(im, ori, True)
-        else:
-            im_out = None
-
-    else:
-        from os import chdir
-        # 4D data: split along T dimension
-        # or 5D data: split along 5th dimension
-        # Create a temporary directory and go in it
-        tmp_folder = tmp_create(verbose)
-        chdir(tmp_folder)
-        if len(im.data.shape) == 5 and im.data.shape[-1] not in [0, 1]:
-            # 5D data
-            printv('\nSplit along 5th dimension...', verbose)
-            im_split_list = multicomponent_split(im)
-            dim = 5
-        else:
-            # 4D data
-            printv('\nSplit along T dimension...', verbose)
-            im_split_list = split_data(im, 3)
-            dim = 4
-        for im_s in im_split_list:
-            im_s.save(verbose=verbose)
-
-        if get:
-            # get orientation
-            printv('\nGet orientation...', verbose)
-            im_out=None
-            ori = get_orientation(im_split_list[0])
-            chdir('..')
-            run('rm -rf '+tmp_folder, error_exit='warning')
-            return ori
-        elif set:
-            # set orientation
-            printv('\nChange orientation...', verbose)
-            im_changed_ori_list = []
-            for im_s in im_split_list:
-                im_set = set_orientation(im_s, ori)
-                im_changed_ori_list.append(im_set)
-            printv('\nMerge file back...', verbose)
-            if dim == 4:
-                im_out = concat_data(im_changed_ori_list, 3)
-            elif dim == 5:
-                fname_changed_ori_list = [im_ch_ori.absolutepath for im_ch_ori in im_changed_ori_list]
-                im_out = multicomponent_merge(fname_changed_ori_list)
-        elif set_data:
+    printv(str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
+
+    if set:
+        # set orientation. 4D and 5D data are reoriented at once (the first three axes are permuted/flipped).
+        printv('\nChange orientation...', verbose)
+        im_out = reorient(im, ori)
+    elif set_data:
+        if len(im.data.shape) > 3 and nt > 1:
             printv('\nSet orientation of the data only is not compatible with 4D data...', verbose, 'error')
-        else:
-            im_out = None
-
-        # Go back to previous directory:
-        chdir('..')
-        run('rm -rf '+tmp_folder, error_exit='warning')
-
-    if fname_out:
-        im_out.setFileName(fname_out)
-        if fname_out != im.file_name+'_'+ori+im.ext:
-            run('rm -f ' + im.file_name + '_' + ori + im.ext)
+        im_out = set_orientation(im, ori, True)
     else:
-        im_out.setFileName(im.file_name + '_' + ori + im.ext)
+        im_out = None
+
+    if im_out is not None:
+        if fname_out:
+            im_out.setFileName(fname_out)
+        else:
+            im_out.setFileName(im.file_name + '_' + ori + im.ext)
     return im_out
 
 
 def get_orientation(im):
+    """
+    Get orientation from the header (voxel data are not used).
+    :param im: Image, ImageMetadata or file name
+    :return: orientation string, e.g. 'RPI'
+    """
     from nibabel import orientations
+    if isinstance(im, str):
+        im = ImageMetadata(im)
     orientation_dic = {
         (0, 1): 'L',
         (0, -1): 'R',
@@ -588,30 +565,22 @@ def get_orientation(im):
 # ==========================================================================================
 def get_orientation_3d(im, filename=False):
     """
-    Get orientation from 3D data
-    :param im:
+    Get orientation from 3D data, using the header of the file (no need to run isct_orientation3d).
+    :param im: Image object or file name (then set filename=True)
     :return:
     """
-    from sct_utils import run
-    string_out = 'Input image orientation : '
-    # get orientation
     if filename:
-        status, output = run('isct_orientation3d -i '+im+' -get ', 0)
+        return ImageMetadata(im).orientation
     else:
-        status, output = run('isct_orientation3d -i '+im.absolutepath+' -get ', 0)
-    # check status
-    if status != 0:
-        printv('ERROR in get_orientation.', 1, 'error')
-    orientation = output[output.index(string_out)+len(string_out):]
-    # orientation = output[26:]
-    return orientation
+        return ImageMetadata(im.absolutepath).orientation
 
 
 # set_orientation
 # ==========================================================================================
 def set_orientation(im, orientation, data_inversion=False, filename=False, fname_out=''):
     """
-    Set orientation on image
+    Set orientation on image. The output image is written on disk (in the current folder if fname_out is not
+    specified). Use reorient() to stay in memory.
     :param im: either Image object or file name. Carefully set param filename.
     :param orientation:
     :param data_inversion:
@@ -628,13 +597,15 @@ def set_orientation(im, orientation, data_inversion=False, filename=False, fname
         fname_out = im.file_name+'_'+orientation+im.ext
 
     if not data_inversion:
-        from sct_utils import run
         if filename:
-            run('isct_orientation3d -i '+im+' -orientation '+orientation+' -o '+fname_out, 0)
+            im_out = reorient(Image(im), orientation)
+            im_out.setFileName(fname_out)
+            im_out.save(squeeze_data=False, verbose=0)
             im_out = fname_out
         else:
-            run('isct_orientation3d -i '+im.absolutepath+' -orientation '+orientation+' -o '+fname_out, 0)
-            im_out = Image(fname_out)
+            im_out = reorient(im, orientation)
+            im_out.setFileName(fname_out)
+            im_out.save(squeeze_data=False, verbose=0)
     else:
         im_out = im.copy()
         im_out.change_orientation(orientation, True)
@@ -642,6 +613,74 @@ def set_orientation(im, orientation, data_inversion=False, filename=False, fname
     return im_out
 
 
+# reorient
+# ==========================================================================================
+def get_orientation_transform(affine, orientation):
+    """
+    Get the axis permutation and flips that bring data from the orientation of affine to a new orientation.
+    :param affine: 4x4 voxel to world matrix
+    :param orientation: string, e.g. 'RPI'
+    :return: transform (nibabel orientation array: new axis and flip for each input axis)
+    """
+    from numpy import array
+    from nibabel import orientations
+    # SCT orientation labels give the direction where each axis comes FROM, while nibabel gives where it goes TO
+    axis_flip = {'L': (0, 1), 'R': (0, -1), 'P': (1, 1), 'A': (1, -1), 'I': (2, 1), 'S': (2, -1)}
+    if sorted([axis_flip[c][0] for c in orientation]) != [0, 1, 2]:
+        printv('ERROR: wrong orientation: '+orientation, 1, 'error')
+    ornt_out = array([axis_flip[c] for c in orientation], dtype=float)
+    return orientations.ornt_transform(orientations.io_orientation(affine), ornt_out)
+
+
+def reorient_data(data, affine, orientation):
+    """
+    Reorient 3D, 4D or 5D data (e.g., time series, warping fields) by permuting and flipping the first three axes.
+    Other dimensions are left untouched (vectors of warping fields are expressed in world coordinates, hence they do
+    not depend on orientation).
+    :param data: numpy array
+    :param affine: 4x4 voxel to world matrix
+    :param orientation: string, e.g. 'RPI'
+    :return: data_out (view of data), affine_out
+    """
+    from numpy import argsort, dot
+    from nibabel.orientations import inv_ornt_aff
+    transform = get_orientation_transform(affine, orientation)
+    # flip
+    slices = [slice(None, None, -1) if transform[i, 1] == -1 else slice(None) for i in range(3)]
+    data_out = data[tuple(slices)]
+    # permute: output axis j comes from input axis perm[j]
+    perm = list(argsort(transform[:, 0])) + range(3, data.ndim)
+    data_out = data_out.transpose(perm)
+    affine_out = dot(affine, inv_ornt_aff(transform, data.shape[:3]))
+    return data_out, affine_out
+
+
+def reorient(im, orientation):
+    """
+    Change orientation of image data and header, in memory. The data of the output image is a view of the input data
+    whenever possible (no copy).
+    :param im: Image (3D, 4D or 5D)
+    :param orientation: string, e.g. 'RPI'
+    :return: Image
+    """
+    from copy import deepcopy
+    from numpy import argsort
+    affine = im.hdr.get_best_affine()
+    data_out, affine_out = reorient_data(im.data, affine, orientation)
+    hdr_out = deepcopy(im.hdr)
+    hdr_out.set_data_shape(data_out.shape)
+    hdr_out.set_qform(affine_out)
+    hdr_out.set_sform(affine_out)
+    im_out = Image(data_out, hdr=hdr_out, orientation=orientation, absolutepath=im.absolutepath, verbose=im.verbose)
+    # dimensions: first three axes are permuted
+    perm = list(argsort(get_orientation_transform(affine, orientation)[:, 0]))
+    dim = list(im.dim)
+    im_out.dim = tuple([im.dim[i] for i in perm] + [dim[3]] + [im.dim[i+4] for i in perm] + [dim[7]])
+    im_out.compute_transform_matrix()
+    im_out.setFileName(add_suffix(im.absolutepath, '_'+orientation))
+    return im_out
+
+
 def visualize_warp(fname_warp, fname_grid=None, step=3, rm_tmp=True):
     if fname_grid is None:
         from numpy import zeros
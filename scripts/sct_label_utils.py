@@ -130,11 +130,8 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         # image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[coord.x, coord.y, coord.z] = image_output.data[coord.x, coord.y, coord.z] + float(value)
+        coord = self.image_input.getNonZeroCoordinatesArray()
+        image_output.data[coord.x, coord.y, coord.z] = image_output.data[coord.x, coord.y, coord.z] + float(value)
         return image_output
 
 
@@ -170,7 +167,7 @@ class ProcessLabels(object):
         :return:
         """
         output_image = Image(self.image_input, self.verbose)
-        nx, ny, nz, nt, px, py, pz, pt = Image(self.image_input.absolutepath).dim
+        nx, ny, nz, nt, px, py, pz, pt = self.image_input.dim
 
         coordinates_input = self.image_input.getNonZeroCoordinates()
         d = self.cross_radius  # cross radius in pixel
@@ -316,20 +313,11 @@ class ProcessLabels(object):
         output_image = self.image_input.copy()
         output_image.data *= 0
 
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.image_input.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
+        # 1. Compute the center of mass of each group of voxels that have the same value
+        coordinates = self.image_input.getCoordinatesAveragedByValue()
 
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        for value, list_coord in groups.iteritems():
-            center_of_mass = sum(list_coord)/float(len(list_coord))
+        # 2. Write them into the output image
+        for center_of_mass in coordinates:
             sct.printv("Value = " + str(center_of_mass.value) + " : ("+str(center_of_mass.x) + ", "+str(center_of_mass.y) + ", " + str(center_of_mass.z) + ") --> ( "+ str(round(center_of_mass.x)) + ", " + str(round(center_of_mass.y)) + ", " + str(round(center_of_mass.z)) + ")", verbose=self.verbose)
             output_image.data[round(center_of_mass.x), round(center_of_mass.y), round(center_of_mass.z)] = center_of_mass.value
 
@@ -343,11 +331,8 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[coord.x, coord.y, coord.z] = i + 1
+        coord = self.image_input.getNonZeroCoordinatesArray(sorting='z', reverse_coord=True)
+        image_output.data[coord.x, coord.y, coord.z] = np.arange(1, len(coord) + 1)
 
         return image_output
 
@@ -361,14 +346,13 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-        coordinates_ref = self.image_ref.getNonZeroCoordinates(sorting='value')
+        coord = self.image_input.getNonZeroCoordinatesArray()
+        coordinates_ref = self.image_ref.getNonZeroCoordinatesArray(sorting='value')
 
         # for all points in input, find the value that has to be set up, depending on the vertebral level
-        for i, coord in enumerate(coordinates_input):
-            for j in range(0, len(coordinates_ref)-1):
-                if coordinates_ref[j+1].z < coord.z <= coordinates_ref[j].z:
-                    image_output.data[coord.x, coord.y, coord.z] = coordinates_ref[j].value
+        for j in range(0, len(coordinates_ref)-1):
+            ind = (coordinates_ref[j+1].z < coord.z) & (coord.z <= coordinates_ref[j].z)
+            image_output.data[coord.x[ind], coord.y[ind], coord.z[ind]] = coordinates_ref[j].value
 
         return image_output
 
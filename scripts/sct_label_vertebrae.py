@@ -35,6 +35,12 @@ path_script = os.path.dirname(__file__)
 path_sct = os.path.dirname(path_script)
 
 
+# templates already loaded by the process (see load_template())
+template_cache = {}
+# version of the template cache on disk. Change it if the cached data change.
+TEMPLATE_CACHE_VERSION = 'label_vertebrae_1'
+
+
 # PARAMETERS
 class Param:
     ## The constructor
@@ -50,6 +56,10 @@ class Param:
         self.size_IS = 19  # window size in IS direction (=z) (in voxel)
         self.shift_AP_visu = 15#0#15  # shift AP for displaying disc values
         self.smooth_factor = [7, 1, 1]  # [3, 1, 1]
+        self.thr_corr = 0.2  # disc correlation threshold. Below this value, use template distance.
+        self.dp_search_range = 10  # global search: tolerance on the distance between adjacent discs (in voxel)
+        self.dp_scales = np.arange(0.7, 1.31, 0.05)  # global search: subject to template distance factors tested
+        self.dp_distance_weight = 1  # global search: penalty on the deviation from the adjusted template distance (relative to dp_search_range, squared)
         self.fig_anat_straight = 50
 
 
@@ -58,9 +68,10 @@ class Param:
 def get_parser():
     # parser initialisation
     parser = Parser(__file__)
-    parser.usage.set_description('''This function takes an anatomical image and its cord segmentation (binary file), and outputs the cord segmentation labeled with vertebral level. The algorithm requires an initialization (first disc) and then performs a disc search in the superior, then inferior direction, using template disc matching based on mutual information score.
+    parser.usage.set_description('''This function takes an anatomical image and its cord segmentation (binary file), and outputs the cord segmentation labeled with vertebral level. The algorithm requires an initialization (first disc) and then performs a disc search in the superior, then inferior direction, using template disc matching based on mutual information score (or a global search of all discs, see flag -method).
 Tips: To run the function with init txt file that includes flags -initz/-initcenter:
 sct_label_vertebrae -i t2.nii.gz -s t2_seg_manual.nii.gz  "$(< init_label_vertebrae.txt)"
+To avoid decompressing the template at each run, set the environment variable SCT_TEMPLATE_CACHE to a folder: template data are then cached on disk and memory-mapped. The size of this cache is limited by the environment variable SCT_TEMPLATE_CACHE_SIZE (in MB, default: 2000), least recently used entries are removed first.
 ''')
     parser.add_option(name="-i",
                       type_value="file",
@@ -122,6 +133,12 @@ sct_label_vertebrae -i t2.nii.gz -s t2_seg_manual.nii.gz  "$(< init_label_verteb
                       mandatory=False,
                       default_value='0',
                       example=['0', '1'])
+    parser.add_option(name="-method",
+                      type_value="multiple_choice",
+                      description="Disc search. local: discs are searched one after the other, around the position predicted from the previous disc. global: correlation with each template disc is computed along the whole image, and the position of all discs is found jointly, constrained by the template distance between discs.",
+                      mandatory=False,
+                      default_value='local',
+                      example=['local', 'global'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="Remove temporary files.",
@@ -191,6 +208,7 @@ def main(args=None):
     remove_tmp_files = int(arguments['-r'])
     denoise = int(arguments['-denoise'])
     laplacian = int(arguments['-laplacian'])
+    method = arguments['-method']
 
     # if verbose, import matplotlib
     # if verbose == 2:
@@ -274,7 +292,7 @@ def main(args=None):
         run('sct_maths -i data_straightr.nii -laplacian 1 -o data_straightr.nii', verbose)
 
     # detect vertebral levels on straight spinal cord
-    vertebral_detection('data_straightr.nii', 'segmentation_straight.nii.gz', contrast, init_disc=init_disc, verbose=verbose, path_template=path_template, initc2=initc2)
+    vertebral_detection('data_straightr.nii', 'segmentation_straight.nii.gz', contrast, init_disc=init_disc, verbose=verbose, path_template=path_template, initc2=initc2, method=method)
 
     # un-straighten labeled spinal cord
     printv('\nUn-straighten labeling...', verbose)
@@ -313,7 +331,7 @@ def main(args=None):
 
 # Detect vertebral levels
 # ==========================================================================================
-def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, path_template='', initc2='auto'):
+def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, path_template='', initc2='auto', method='local'):
     """
     Find intervertebral discs in straightened image using template matching
     :param fname:
@@ -322,6 +340,7 @@ def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, pat
     :param init_disc:
     :param verbose:
     :param path_template:
+    :param method: 'local': search discs one after the other. 'global': find all discs jointly (see find_discs_global())
     :return:
     """
     # initializations
@@ -362,45 +381,34 @@ def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, pat
 
     # Open template and vertebral levels
     printv('\nOpen template and vertebral levels...', verbose)
-    data_template = Image(fname_template).data
-    data_disc_template = Image(fname_level).data
+    data_template, list_disc_value_template, list_disc_z_template, list_distance_template = load_template(fname_template, fname_level, verbose=verbose)
+    # get dimension of template
+    nxt, nyt, nzt = data_template.shape
+    # define xc and yc (centered in the field of view)
+    xct = int(round(nxt/2))  # direction RL
+    yct = int(round(nyt/2))  # direction AP
 
     # open anatomical volume
     im_input = Image(fname)
     data = im_input.data
 
-    # smooth data
-    from scipy.ndimage.filters import gaussian_filter
-    data = gaussian_filter(data, param.smooth_factor, output=None, mode="reflect")
-
     # get dimension of src
     nx, ny, nz = data.shape
     # define xc and yc (centered in the field of view)
     xc = int(round(nx/2))  # direction RL
     yc = int(round(ny/2))  # direction AP
-    # get dimension of template
-    nxt, nyt, nzt = data_template.shape
-    # define xc and yc (centered in the field of view)
-    xct = int(round(nxt/2))  # direction RL
-    yct = int(round(nyt/2))  # direction AP
 
-    # define mean distance (in voxel) between adjacent discs: [C1/C2 -> C2/C3], [C2/C3 -> C4/C5], ..., [L1/L2 -> L2/L3]
-    centerline_level = data_disc_template[xct, yct, :]
-    # attribute value to each disc. Starts from max level, then decrease.
-    min_level = centerline_level[centerline_level.nonzero()].min()
-    max_level = centerline_level[centerline_level.nonzero()].max()
-    list_disc_value_template = range(min_level, max_level)
-    # add disc above top one
-    list_disc_value_template.insert(int(0), min_level - 1)
+    # smooth data, only within the box read by the disc search (and displayed if verbose=2)
+    xlim = [xc - param.size_RL, xc + param.size_RL + 1]
+    if verbose == 2:
+        ylim = [0, ny]
+    else:
+        ylim = [min(yc + param.shift_AP - param.size_AP, yc + param.shift_AP_brainstem - param.size_AP_brainstem),
+                max(yc + param.shift_AP + param.size_AP, yc + param.shift_AP_brainstem + param.size_AP_brainstem) + 1]
+    data = smooth_roi(data, param.smooth_factor, xlim, ylim)
+
     printv('\nDisc values from template: ' + str(list_disc_value_template), verbose)
-    # get diff to find transitions (i.e., discs)
-    diff_centerline_level = np.diff(centerline_level)
-    # get disc z-values
-    list_disc_z_template = diff_centerline_level.nonzero()[0].tolist()
-    list_disc_z_template.reverse()
     printv('Z-values for each disc: ' + str(list_disc_z_template), verbose)
-    list_distance_template = (
-        np.diff(list_disc_z_template) * (-1)).tolist()  # multiplies by -1 to get positive distances
     printv('Distances between discs (in voxel): ' + str(list_distance_template), verbose)
 
 
@@ -409,7 +417,7 @@ def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, pat
         printv('\nDetect C2/C3 disk...', verbose)
         zrange = range(0, nz)
         ind_c2 = list_disc_value_template.index(2)
-        z_peak = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL, y=yc, yshift=param.shift_AP_brainstem, ysize=param.size_AP_brainstem, z=0, zshift=param.shift_IS_brainstem, zsize=param.size_IS_brainstem, xtarget=xct, ytarget=yct, ztarget=list_disc_z_template[ind_c2], zrange=zrange, verbose=verbose, save_suffix='_initC2', gaussian_weighting=True)
+        z_peak = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL, y=yc, yshift=param.shift_AP_brainstem, ysize=param.size_AP_brainstem, z=0, zshift=param.shift_IS_brainstem, zsize=param.size_IS_brainstem, xtarget=xct, ytarget=yct, ztarget=list_disc_z_template[ind_c2], zrange=zrange, verbose=verbose, save_suffix='_initC2', gaussian_weighting=True, thr_corr=param.thr_corr)
         init_disc = [z_peak, 2]
 
     # if manual mode, open viewer for user to click on C2/C3 disc
@@ -448,98 +456,116 @@ def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, pat
 
     # FIND DISCS
     # ===========================================================================
-    printv('\nDetect intervertebral discs...', verbose)
-    # assign initial z and disc
-    current_z = init_disc[0]
-    current_disc = init_disc[1]
-    # mean_distance = mean_distance * pz
-    # mean_distance_real = np.zeros(len(mean_distance))
-    # create list for z and disc
-    list_disc_z = []
-    list_disc_value = []
-    zrange = range(-10, 10)
-    direction = 'superior'
-    search_next_disc = True
-    while search_next_disc:
-        printv('Current disc: '+str(current_disc)+' (z='+str(current_z)+'). Direction: '+direction, verbose)
-        try:
-            # get z corresponding to current disc on template
-            current_z_template = list_disc_z_template[current_disc]
-        except:
-            # in case reached the bottom (see issue #849)
-            printv('WARNING: Reached the bottom of the template. Stop searching.', verbose, 'warning')
-            break
-        # find next disc
-        # N.B. Do not search for C1/C2 disc (because poorly visible), use template distance instead
-        if not current_disc in [1]:
-            current_z = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL, y=yc, yshift=param.shift_AP, ysize=param.size_AP, z=current_z, zshift=0, zsize=param.size_IS, xtarget=xct, ytarget=yct, ztarget=current_z_template, zrange=zrange, verbose=verbose, save_suffix='_disc'+str(current_disc), gaussian_weighting=False)
-
-        # display new disc
-        if verbose == 2:
-            plt.figure(param.fig_anat_straight), plt.scatter(yc+param.shift_AP_visu, current_z, c='yellow', s=50)
-            plt.text(yc + param.shift_AP_visu + 4, current_z, str(current_disc)+'/'+str(current_disc+1), verticalalignment='center', horizontalalignment='left', color='yellow', fontsize=15), plt.draw()
-
-        # append to main list
-        if direction == 'superior':
-            # append at the beginning
-            list_disc_z.insert(0, current_z)
-            list_disc_value.insert(0, current_disc)
-        elif direction == 'inferior':
-            # append at the end
-            list_disc_z.append(current_z)
-            list_disc_value.append(current_disc)
-
-        # adjust correcting factor based on already-identified discs
-        if len(list_disc_z) > 1:
-            # compute distance between already-identified discs
-            list_distance_current = (np.diff(list_disc_z) * (-1)).tolist()
-            # retrieve the template distance corresponding to the already-identified discs
-            index_disc_identified = [i for i, j in enumerate(list_disc_value_template) if j in list_disc_value[:-1]]
-            list_distance_template_identified = [list_distance_template[i] for i in index_disc_identified]
-            # divide subject and template distances for the identified discs
-            list_subject_to_template_distance = [float(list_distance_current[i]) / list_distance_template_identified[i] for i in range(len(list_distance_current))]
-            # average across identified discs to obtain an average correcting factor
-            correcting_factor = np.mean(list_subject_to_template_distance)
-            printv('.. correcting factor: '+str(correcting_factor), verbose)
-        else:
-            correcting_factor = 1
+    if method == 'global':
+        printv('\nDetect intervertebral discs (global search)...', verbose)
+        # discs below the top of C1 (disc above the top disc is added afterwards)
+        ind_first = list_disc_value_template.index(1)
+        corr_map = compute_corr_map(data, data_template, x=xc, xsize=param.size_RL, y=yc, yshift=param.shift_AP, ysize=param.size_AP, zsize=param.size_IS, xtarget=xct, ytarget=yct, list_ztarget=list_disc_z_template[ind_first:])
+        list_disc_z, list_disc_value, correcting_factor = find_discs_global(corr_map, list_disc_value_template[ind_first:], list_distance_template[ind_first:], init_disc, thr_corr=param.thr_corr, search_range=param.dp_search_range, scales=param.dp_scales, distance_weight=param.dp_distance_weight, verbose=verbose)
         # update list_distance specific for the subject
         list_distance = [int(round(list_distance_template[i] * correcting_factor)) for i in range(len(list_distance_template))]
-        # updated average_disc_distance (in case it is needed)
-        # average_disc_distance = int(round(np.mean(list_distance)))
-
-        # assign new current_z and disc value
-        if direction == 'superior':
-            try:
-                approx_distance_to_next_disc = list_distance[list_disc_value_template.index(current_disc-1)]
-            except ValueError:
-                printv('WARNING: Disc value not included in template. Using previously-calculated distance: '+str(approx_distance_to_next_disc))
-            # assign new current_z and disc value
-            current_z = current_z + approx_distance_to_next_disc
-            current_disc = current_disc - 1
-        elif direction == 'inferior':
+        # display discs
+        if verbose == 2:
+            for current_z, current_disc in zip(list_disc_z, list_disc_value):
+                plt.figure(param.fig_anat_straight), plt.scatter(yc+param.shift_AP_visu, current_z, c='yellow', s=50)
+                plt.text(yc + param.shift_AP_visu + 4, current_z, str(current_disc)+'/'+str(current_disc+1), verticalalignment='center', horizontalalignment='left', color='yellow', fontsize=15), plt.draw()
+        if not list_disc_value:
+            printv('WARNING: No disc found within the field of view with the global search. Using method local instead.', 1, 'warning')
+            method = 'local'
+
+    if method != 'global':
+        printv('\nDetect intervertebral discs...', verbose)
+        # assign initial z and disc
+        current_z = init_disc[0]
+        current_disc = init_disc[1]
+        # mean_distance = mean_distance * pz
+        # mean_distance_real = np.zeros(len(mean_distance))
+        # create list for z and disc
+        list_disc_z = []
+        list_disc_value = []
+        zrange = range(-10, 10)
+        direction = 'superior'
+        search_next_disc = True
+        while search_next_disc:
+            printv('Current disc: '+str(current_disc)+' (z='+str(current_z)+'). Direction: '+direction, verbose)
             try:
-                approx_distance_to_next_disc = list_distance[list_disc_value_template.index(current_disc)]
+                # get z corresponding to current disc on template
+                current_z_template = list_disc_z_template[current_disc]
             except:
-                printv('WARNING: Disc value not included in template. Using previously-calculated distance: '+str(approx_distance_to_next_disc))
+                # in case reached the bottom (see issue #849)
+                printv('WARNING: Reached the bottom of the template. Stop searching.', verbose, 'warning')
+                break
+            # find next disc
+            # N.B. Do not search for C1/C2 disc (because poorly visible), use template distance instead
+            if not current_disc in [1]:
+                current_z = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL, y=yc, yshift=param.shift_AP, ysize=param.size_AP, z=current_z, zshift=0, zsize=param.size_IS, xtarget=xct, ytarget=yct, ztarget=current_z_template, zrange=zrange, verbose=verbose, save_suffix='_disc'+str(current_disc), gaussian_weighting=False, thr_corr=param.thr_corr)
+
+            # display new disc
+            if verbose == 2:
+                plt.figure(param.fig_anat_straight), plt.scatter(yc+param.shift_AP_visu, current_z, c='yellow', s=50)
+                plt.text(yc + param.shift_AP_visu + 4, current_z, str(current_disc)+'/'+str(current_disc+1), verticalalignment='center', horizontalalignment='left', color='yellow', fontsize=15), plt.draw()
+
+            # append to main list
+            if direction == 'superior':
+                # append at the beginning
+                list_disc_z.insert(0, current_z)
+                list_disc_value.insert(0, current_disc)
+            elif direction == 'inferior':
+                # append at the end
+                list_disc_z.append(current_z)
+                list_disc_value.append(current_disc)
+
+            # adjust correcting factor based on already-identified discs
+            if len(list_disc_z) > 1:
+                # compute distance between already-identified discs
+                list_distance_current = (np.diff(list_disc_z) * (-1)).tolist()
+                # retrieve the template distance corresponding to the already-identified discs
+                index_disc_identified = [i for i, j in enumerate(list_disc_value_template) if j in list_disc_value[:-1]]
+                list_distance_template_identified = [list_distance_template[i] for i in index_disc_identified]
+                # divide subject and template distances for the identified discs
+                list_subject_to_template_distance = [float(list_distance_current[i]) / list_distance_template_identified[i] for i in range(len(list_distance_current))]
+                # average across identified discs to obtain an average correcting factor
+                correcting_factor = np.mean(list_subject_to_template_distance)
+                printv('.. correcting factor: '+str(correcting_factor), verbose)
+            else:
+                correcting_factor = 1
+            # update list_distance specific for the subject
+            list_distance = [int(round(list_distance_template[i] * correcting_factor)) for i in range(len(list_distance_template))]
+            # updated average_disc_distance (in case it is needed)
+            # average_disc_distance = int(round(np.mean(list_distance)))
+
             # assign new current_z and disc value
-            current_z = current_z - approx_distance_to_next_disc
-            current_disc = current_disc + 1
-
-        # if current_z is larger than searching zone, switch direction (and start from initial z minus approximate distance from updated template distance)
-        if current_z >= nz or current_disc == 0:
-            printv('.. Switching to inferior direction.', verbose)
-            direction = 'inferior'
-            current_disc = init_disc[1] + 1
-            current_z = init_disc[0] - list_distance[list_disc_value_template.index(current_disc)]
-        # if current_z is lower than searching zone, stop searching
-        if current_z <= 0:
-            search_next_disc = False
-
-        # if verbose == 2:
-        #     # close figures
-        #     plt.figure(fig_corr), plt.close()
-        #     plt.figure(fig_pattern), plt.close()
+            if direction == 'superior':
+                try:
+                    approx_distance_to_next_disc = list_distance[list_disc_value_template.index(current_disc-1)]
+                except ValueError:
+                    printv('WARNING: Disc value not included in template. Using previously-calculated distance: '+str(approx_distance_to_next_disc))
+                # assign new current_z and disc value
+                current_z = current_z + approx_distance_to_next_disc
+                current_disc = current_disc - 1
+            elif direction == 'inferior':
+                try:
+                    approx_distance_to_next_disc = list_distance[list_disc_value_template.index(current_disc)]
+                except:
+                    printv('WARNING: Disc value not included in template. Using previously-calculated distance: '+str(approx_distance_to_next_disc))
+                # assign new current_z and disc value
+                current_z = current_z - approx_distance_to_next_disc
+                current_disc = current_disc + 1
+
+            # if current_z is larger than searching zone, switch direction (and start from initial z minus approximate distance from updated template distance)
+            if current_z >= nz or current_disc == 0:
+                printv('.. Switching to inferior direction.', verbose)
+                direction = 'inferior'
+                current_disc = init_disc[1] + 1
+                current_z = init_disc[0] - list_distance[list_disc_value_template.index(current_disc)]
+            # if current_z is lower than searching zone, stop searching
+            if current_z <= 0:
+                search_next_disc = False
+
+            # if verbose == 2:
+            #     # close figures
+            #     plt.figure(fig_corr), plt.close()
+            #     plt.figure(fig_pattern), plt.close()
 
     # if upper disc is not 1, add disc above top disc based on mean_distance_adjusted
     upper_disc = min(list_disc_value)
@@ -565,6 +591,90 @@ def vertebral_detection(fname, fname_seg, contrast, init_disc=[], verbose=1, pat
         plt.close()
 
 
+def load_template(fname_template, fname_level, verbose=1):
+    """
+    Load template and disc positions along its centerline. Results are kept in memory for subsequent calls within the
+    process and, if the environment variable SCT_TEMPLATE_CACHE is set to a folder, on disk (template data are then
+    memory-mapped), so that the template is only decompressed once. The maximum size of the cache on disk (MB) is set by
+    SCT_TEMPLATE_CACHE_SIZE (default: 2000).
+    :param fname_template: template of the same contrast as the input image
+    :param fname_level: vertebral levels of the template
+    :return: data_template, list_disc_value_template, list_disc_z_template (from top to bottom), list_distance_template
+    """
+    # template files are identified by their path, size and time of last modification
+    key = []
+    for fname in [fname_template, fname_level]:
+        fname = os.path.abspath(fname)
+        key += [fname, os.path.getsize(fname), os.path.getmtime(fname)]
+    key = tuple(key)
+    if key in template_cache:
+        return template_cache[key]
+
+    list_fname_cache = ['template.npy', 'centerline_level.npy']
+    cache, key_cache, path_entry = None, '', ''
+    if os.environ.get('SCT_TEMPLATE_CACHE', ''):
+        from msct_cache import FileCache, get_max_size
+        cache = FileCache(os.environ['SCT_TEMPLATE_CACHE'], max_size=get_max_size('SCT_TEMPLATE_CACHE_SIZE'), verbose=verbose)
+        key_cache = cache.compute_key([TEMPLATE_CACHE_VERSION] + list(key))
+        path_entry = cache.get_path(key_cache, list_fname_cache)
+    if path_entry:
+        data_template = np.load(os.path.join(path_entry, 'template.npy'), mmap_mode='r')
+        centerline_level = np.load(os.path.join(path_entry, 'centerline_level.npy'))
+    else:
+        data_template = np.asarray(Image(fname_template).data)
+        # vertebral levels along the centerline of the template
+        nxt, nyt, nzt = data_template.shape
+        centerline_level = np.asarray(Image(fname_level).data[int(round(nxt/2)), int(round(nyt/2)), :])
+        if cache is not None:
+            path_tmp = tmp_create(verbose=0)
+            np.save(path_tmp+'template.npy', data_template)
+            np.save(path_tmp+'centerline_level.npy', centerline_level)
+            cache.put(key_cache, list_fname_cache, path_input=path_tmp)
+            shutil.rmtree(path_tmp, ignore_errors=True)
+
+    # attribute value to each disc. Starts from max level, then decrease.
+    min_level = centerline_level[centerline_level.nonzero()].min()
+    max_level = centerline_level[centerline_level.nonzero()].max()
+    list_disc_value_template = range(min_level, max_level)
+    # add disc above top one
+    list_disc_value_template.insert(int(0), min_level - 1)
+    # get diff to find transitions (i.e., discs)
+    diff_centerline_level = np.diff(centerline_level)
+    # get disc z-values
+    list_disc_z_template = diff_centerline_level.nonzero()[0].tolist()
+    list_disc_z_template.reverse()
+    list_distance_template = (
+        np.diff(list_disc_z_template) * (-1)).tolist()  # multiplies by -1 to get positive distances
+
+    template_cache[key] = data_template, list_disc_value_template, list_disc_z_template, list_distance_template
+    return template_cache[key]
+
+
+def smooth_roi(data, sigma, xlim, ylim):
+    """
+    Gaussian smoothing (reflect mode) of the data within a box along z. The box is extended by the radius of the
+    kernel before smoothing, so that the result within the box is the same as when smoothing the whole volume.
+    :param data: 3d array
+    :param sigma: standard deviation of the kernel, for each axis
+    :param xlim: [xmin, xmax] of the box (xmax excluded)
+    :param ylim: [ymin, ymax] of the box (ymax excluded)
+    :return: array of the same shape as data, null outside of the box
+    """
+    from scipy.ndimage.filters import gaussian_filter
+    nx, ny, nz = data.shape
+    # radius of the kernel (gaussian_filter truncates at 4 sigma)
+    radius = [int(4.0 * sigma_i + 0.5) for sigma_i in sigma]
+    x0, x1 = max(xlim[0], 0), min(xlim[1], nx)
+    y0, y1 = max(ylim[0], 0), min(ylim[1], ny)
+    xe0, xe1 = max(x0 - radius[0], 0), min(x1 + radius[0], nx)
+    ye0, ye1 = max(y0 - radius[1], 0), min(y1 + radius[1], ny)
+    data_smooth = np.zeros(data.shape, dtype=data.dtype)
+    if x1 > x0 and y1 > y0:
+        data_box = gaussian_filter(np.asarray(data[xe0:xe1, ye0:ye1, :]), sigma, output=None, mode="reflect")
+        data_smooth[x0:x1, y0:y1, :] = data_box[x0 - xe0:x1 - xe0, y0 - ye0:y1 - ye0, :]
+    return data_smooth
+
+
 # Create label
 # ==========================================================================================
 def create_label_z(fname_seg, z, value):
@@ -643,7 +753,7 @@ def clean_labeled_segmentation(fname_labeled_seg, fname_seg, fname_labeled_seg_n
     im_label.save()
 
 
-def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ysize=0, z=0, zshift=0, zsize=0, xtarget=0, ytarget=0, ztarget=0, zrange=[], verbose=1, save_suffix='', gaussian_weighting=True):
+def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ysize=0, z=0, zshift=0, zsize=0, xtarget=0, ytarget=0, ztarget=0, zrange=[], verbose=1, save_suffix='', gaussian_weighting=True, thr_corr=0.2):
     """
     Find z that maximizes correlation between src and target 3d data.
     :param src: 3d source data
@@ -663,10 +773,9 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
     :param zrange:
     :param verbose:
     :param save_suffix:
+    :param thr_corr: disc correlation threshold. Below this value, use template distance.
     :return:
     """
-    # parameters
-    thr_corr = 0.2  # disc correlation threshold. Below this value, use template distance.
     # get dimensions from src
     nx, ny, nz = src.shape
     # Get pattern from template
@@ -675,68 +784,13 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
               ytarget + yshift - ysize: ytarget + yshift + ysize + 1,
               ztarget + zshift - zsize: ztarget + zshift + zsize + 1]
     pattern1d = pattern.ravel()
-    # initializations
+    # subject patterns for all z shifts
+    data_chunk2d, ind_valid = get_data_chunks(src, x, xsize, y, yshift, ysize, z, zsize, zrange, pattern1d.size)
+    allzeros = len(ind_valid) < len(zrange)
+    # mutual information between the subject and the template patterns, for all z shifts
     I_corr = np.zeros(len(zrange))
-    allzeros = 0
-    # current_z = 0
-    ind_I = 0
-    # loop across range of z defined by src
-    for iz in zrange:
-        # if pattern extends towards the top part of the image, then crop and pad with zeros
-        if z + iz + zsize + 1 > nz:
-            # print 'iz='+str(iz)+': padding on top'
-            padding_size = z + iz + zsize + 1 - nz
-            data_chunk3d = src[
-                           x - xsize: x + xsize + 1,
-                           y + yshift - ysize: y + yshift + ysize + 1,
-                           z + iz - zsize: z + iz + zsize + 1 - padding_size]
-            data_chunk3d = np.pad(data_chunk3d, ((0, 0), (0, 0), (0, padding_size)), 'constant',
-                                  constant_values=0)
-        # if pattern extends towards bottom part of the image, then crop and pad with zeros
-        elif z + iz - zsize < 0:
-            # print 'iz='+str(iz)+': padding at bottom'
-            padding_size = abs(iz - zsize)
-            data_chunk3d = src[
-                           x - xsize: x + xsize + 1,
-                           y + yshift - ysize: y + yshift + ysize + 1,
-                           z + iz - zsize + padding_size: z + iz + zsize + 1]
-            data_chunk3d = np.pad(data_chunk3d, ((0, 0), (0, 0), (padding_size, 0)), 'constant',
-                                  constant_values=0)
-        else:
-            # print 'iz='+str(iz)+': no padding'
-            data_chunk3d = src[
-                           x - xsize: x + xsize + 1,
-                           y + yshift - ysize: y + yshift + ysize + 1,
-                           z + iz - zsize: z+ iz + zsize + 1]
-        # if verbose == 2 and iz in range(0, nz, 10):
-        #     # display template and subject patterns
-        #     plt.figure(11)
-        #     plt.subplot(131)
-        #     plt.imshow(np.flipud(np.mean(pattern[:, :, :], axis=0).transpose()), origin='upper',
-        #                cmap=plt.cm.gray,
-        #                interpolation='none')
-        #     plt.title('Template pattern')
-        #     plt.subplot(132)
-        #     plt.imshow(np.flipud(np.mean(data_chunk3d[:, :, :], axis=0).transpose()), origin='upper',
-        #                cmap=plt.cm.gray,
-        #                interpolation='none')
-        #     plt.title('Subject pattern at iz=0')
-        #     # save figure
-        #     plt.figure(11), plt.savefig('../fig_pattern'+save_suffix+'_z'+str(iz)+'.png'), plt.close()
-        # convert subject pattern to 1d
-        data_chunk1d = data_chunk3d.ravel()
-        # check if data_chunk1d contains at least one non-zero value
-        # if np.any(data_chunk1d): --> old code which created issue #794 (jcohenadad 2016-04-05)
-        if (data_chunk1d.size == pattern1d.size) and np.any(data_chunk1d):
-            #I_corr[ind_I] = np.corrcoef(data_chunk1d, pattern1d)[0, 1]
-            # data_chunk2d = np.mean(data_chunk3d, 1)
-            # pattern2d = np.mean(pattern, 1)
-            I_corr[ind_I] = calc_MI(data_chunk1d, pattern1d, nbins=16)
-        else:
-            allzeros = 1
-            # printv('.. WARNING: iz='+str(iz)+': Data only contains zero. Set correlation to 0.', verbose)
-        ind_I = ind_I + 1
-    # ind_y = ind_y + 1
+    if len(ind_valid):
+        I_corr[ind_valid] = calc_MI_batch(data_chunk2d, pattern1d, nbins=16)
     if allzeros:
         printv('.. WARNING: Data contained zero. We probably hit the edge of the image.', verbose)
 
@@ -751,7 +805,7 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
     # ind_peak = ind_peak[np.argmax(I_corr[ind_peak])]
     if np.any(I_corr):
         # if I_corr contains at least a non-zero value
-        ind_peak = [i for i in range(len(I_corr)) if I_corr[i] == max(I_corr)][0]  # index of max along z
+        ind_peak = np.argmax(I_corr)  # index of max along z
         # ind_peak[1] = np.where(I_corr == I_corr.max())[1]  # index of max along y
         printv('.. Peak found: z=' + str(zrange[ind_peak]) + ' (correlation = ' + str(I_corr[ind_peak]) + ')', verbose)
         # check if correlation is high enough
@@ -798,6 +852,144 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
     return z + zrange[ind_peak] - zshift
 
 
+def get_data_chunks(src, x, xsize, y, yshift, ysize, z, zsize, zrange, size):
+    """
+    Extract subject patterns around the centerline for each z shift (see compute_corr_3d()).
+    :param src: 3d source data
+    :param size: number of voxels of the template pattern. Subject patterns of a different size are discarded.
+    :return: data_chunk2d: array (nb_valid x size) of the subject patterns which have the right size and are not null
+             ind_valid: array of the index (in zrange) of each subject pattern
+    """
+    nz = src.shape[2]
+    # z-indexes of the chunk of src for each z shift (nz stands for zero padding). Chunks are cropped and padded
+    # with zeros when the pattern extends towards the top or the bottom part of the image.
+    zind = np.arange(nz)
+    list_zchunk = []
+    for iz in zrange:
+        # if pattern extends towards the top part of the image, then crop and pad with zeros
+        if z + iz + zsize + 1 > nz:
+            padding_size = z + iz + zsize + 1 - nz
+            zchunk = np.concatenate([zind[z + iz - zsize: z + iz + zsize + 1 - padding_size], np.ones(padding_size, dtype=int) * nz])
+        # if pattern extends towards bottom part of the image, then crop and pad with zeros
+        elif z + iz - zsize < 0:
+            padding_size = abs(iz - zsize)
+            zchunk = np.concatenate([np.ones(padding_size, dtype=int) * nz, zind[z + iz - zsize + padding_size: z + iz + zsize + 1]])
+        else:
+            zchunk = zind[z + iz - zsize: z + iz + zsize + 1]
+        list_zchunk.append(zchunk)
+    # source data around the centerline, with an additional null slice for padding
+    data_chunk_xy = src[
+                    x - xsize: x + xsize + 1,
+                    y + yshift - ysize: y + yshift + ysize + 1, :]
+    data_chunk_xy = np.concatenate([data_chunk_xy, np.zeros(data_chunk_xy.shape[:2] + (1,), dtype=src.dtype)], axis=2)
+    nxy = data_chunk_xy.shape[0] * data_chunk_xy.shape[1]
+    # only keep subject patterns which have the size of the template pattern
+    ind_valid = [ind_I for ind_I in range(len(zrange)) if nxy * len(list_zchunk[ind_I]) == size]
+    # subject patterns (nb_shifts x nb_voxels) for all z shifts at once
+    if ind_valid:
+        data_chunk2d = data_chunk_xy[:, :, np.array([list_zchunk[ind_I] for ind_I in ind_valid])].transpose(2, 0, 1, 3).reshape(len(ind_valid), -1)
+    else:
+        data_chunk2d = np.zeros((0, size))
+    # check if data_chunk contains at least one non-zero value (see issue #794)
+    ind_nonzero = np.any(data_chunk2d, axis=1)
+    return data_chunk2d[ind_nonzero], np.array(ind_valid, dtype=int)[ind_nonzero]
+
+
+def compute_corr_map(src, target, x=0, xsize=0, y=0, yshift=0, ysize=0, zsize=0, xtarget=0, ytarget=0, list_ztarget=[], nbins=16):
+    """
+    Correlation (mutual information) between the template pattern around each template disc and the subject pattern
+    at each z of the source data. Subject patterns are extracted and quantized once for all discs.
+    :param src: 3d source data
+    :param target: 3d template data
+    :param list_ztarget: z of each template disc
+    :return: array (len(list_ztarget) x nz)
+    """
+    nz = src.shape[2]
+    size = (2 * xsize + 1) * (2 * ysize + 1) * (2 * zsize + 1)
+    data_chunk2d, ind_valid = get_data_chunks(src, x, xsize, y, yshift, ysize, 0, zsize, range(nz), size)
+    bin_src = quantize_rows(data_chunk2d, nbins)
+    corr_map = np.zeros((len(list_ztarget), nz))
+    for i_disc, ztarget in enumerate(list_ztarget):
+        pattern1d = target[
+                    xtarget - xsize: xtarget + xsize + 1,
+                    ytarget + yshift - ysize: ytarget + yshift + ysize + 1,
+                    ztarget - zsize: ztarget + zsize + 1].ravel()
+        if pattern1d.size == size and len(ind_valid):
+            corr_map[i_disc, ind_valid] = calc_MI_batch(data_chunk2d, pattern1d, nbins=nbins, bin_x=bin_src)
+    return corr_map
+
+
+def find_discs_global(corr_map, list_disc_value_template, list_distance_template, init_disc, thr_corr=0.2, search_range=10, scales=np.arange(0.7, 1.31, 0.05), distance_weight=1, verbose=1):
+    """
+    Find the position of all discs jointly, using dynamic programming. Positions maximize the sum of the correlation
+    of each disc, under the constraint that the distance between adjacent discs is the template distance multiplied by
+    a correcting factor (common to all discs, see scales), +/- search_range voxels. Discs can be
+    outside of the FOV (null correlation), so that the FOV can contain any range of adjacent discs.
+    :param corr_map: array (nb_discs x nz): correlation between each template disc and the subject at each z
+    :param list_disc_value_template: value of each disc, from top to bottom
+    :param list_distance_template: distance (in voxel) between adjacent template discs, from top to bottom
+    :param init_disc: [z, disc value]. The initial disc is searched within +/- search_range voxels.
+    :param thr_corr: disc correlation threshold. Below this value, correlation is not used.
+    :param search_range: tolerance on the distance between adjacent discs (in voxel)
+    :param scales: subject to template distance factors tested
+    :param distance_weight: penalty on the deviation from the adjusted template distance (relative to search_range, squared)
+    :param verbose:
+    :return: list_disc_z, list_disc_value: discs within the FOV, from top to bottom
+             correcting_factor: subject to template distance factor
+    """
+    nb_discs, nz = corr_map.shape
+    # score of each position: correlation relative to the median correlation of the disc along z, so that wrong
+    # positions do not increase the score (otherwise, more discs would be squeezed into the FOV). Correlation below
+    # threshold is not trusted. C1/C2 disc is poorly visible: only use template distance.
+    score = np.where(corr_map >= thr_corr, corr_map - np.median(corr_map, axis=1)[:, np.newaxis], 0)
+    if 1 in list_disc_value_template:
+        score[list_disc_value_template.index(1)] = 0
+    # add positions outside of the FOV, with null correlation
+    margin = int(np.ceil(max(scales) * sum(list_distance_template[:nb_discs - 1]))) + search_range + 1
+    z_ext = np.arange(-margin, nz + margin)
+    score = np.concatenate([np.zeros((nb_discs, margin)), score, np.zeros((nb_discs, margin))], axis=1)
+    # initial disc: search around initial position (C1/C2 disc is not searched)
+    i_init = list_disc_value_template.index(init_disc[1])
+    if init_disc[1] == 1:
+        score[i_init, z_ext != init_disc[0]] = -np.inf
+    else:
+        score[i_init, np.abs(z_ext - init_disc[0]) > search_range] = -np.inf
+
+    best_score, list_ind_z, correcting_factor = -np.inf, [], 1
+    # start with factors closest to 1, which are kept in case of equal scores
+    for scale in sorted(scales, key=lambda scale: abs(scale - 1)):
+        list_distance = [int(round(distance * scale)) for distance in list_distance_template]
+        # cum_score[j]: score of the best positions of the discs above the current disc, with current disc at z_ext[j]
+        cum_score = score[0]
+        list_offset_best = []
+        for i_disc in range(1, nb_discs):
+            # distance to the disc above, around the adjusted template distance
+            offsets = np.arange(max(list_distance[i_disc - 1] - search_range, 1), list_distance[i_disc - 1] + search_range + 1)
+            score_offset = np.ones((len(offsets), len(z_ext))) * -np.inf
+            for i_offset, offset in enumerate(offsets):
+                penalty = distance_weight * ((offset - list_distance[i_disc - 1]) / float(search_range)) ** 2
+                score_offset[i_offset, :len(z_ext) - offset] = cum_score[offset:] - penalty
+            ind_offset_best = np.argmax(score_offset, axis=0)
+            list_offset_best.append(offsets[ind_offset_best])
+            cum_score = score_offset[ind_offset_best, np.arange(len(z_ext))] + score[i_disc]
+        if cum_score.max() > best_score:
+            best_score, correcting_factor = cum_score.max(), scale
+            # backtrack positions from the bottom disc
+            list_ind_z = [int(np.argmax(cum_score))]
+            for offset_best in reversed(list_offset_best):
+                list_ind_z.insert(0, list_ind_z[0] + offset_best[list_ind_z[0]])
+
+    printv('.. correcting factor: '+str(correcting_factor), verbose)
+    # keep discs within the FOV
+    list_disc_z, list_disc_value = [], []
+    for i_disc, ind_z in enumerate(list_ind_z):
+        if 0 < z_ext[ind_z] < nz:
+            list_disc_z.append(int(z_ext[ind_z]))
+            list_disc_value.append(list_disc_value_template[i_disc])
+            printv('.. Disc '+str(list_disc_value_template[i_disc])+': z='+str(z_ext[ind_z])+' (correlation = '+str(corr_map[i_disc, z_ext[ind_z]])+')', verbose)
+    return list_disc_z, list_disc_value, correcting_factor
+
+
 def calc_MI(x, y, nbins=32):
     """
     Compute mutual information
@@ -813,6 +1005,55 @@ def calc_MI(x, y, nbins=32):
     return mi
 
 
+def calc_MI_batch(x, y, nbins=32, bin_x=None):
+    """
+    Compute mutual information between each row of x and y. Same as calc_MI() applied to each row (nbins bins between
+    the min and max of each row), but joint histograms of all rows are computed with a single bincount.
+    :param x: 2d array (nb_rows x nb_samples)
+    :param y: 1d array (nb_samples)
+    :param nbins:
+    :param bin_x: bins of x, if already computed with quantize_rows()
+    :return: 1d array (nb_rows) of mutual information
+    """
+    nb_rows = x.shape[0]
+    if bin_x is None:
+        bin_x = quantize_rows(x, nbins)
+    bin_y = quantize_rows(y[np.newaxis, :], nbins)
+    # joint histogram of each row
+    index = (np.arange(nb_rows)[:, np.newaxis] * nbins + bin_x) * nbins + bin_y
+    c_xy = np.bincount(index.ravel(), minlength=nb_rows * nbins * nbins).reshape(nb_rows, nbins, nbins).astype(np.float64)
+    # mutual information: sum(p_xy * log(p_xy / (p_x * p_y))) over non-null bins
+    c_sum = c_xy.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+    outer = c_xy.sum(axis=2)[:, :, np.newaxis] * c_xy.sum(axis=1)[:, np.newaxis, :]
+    nonzero = c_xy > 0
+    log_ratio = np.log(np.where(nonzero, c_xy, 1)) + np.log(c_sum) - np.log(np.where(nonzero, outer, 1))
+    return (c_xy / c_sum * log_ratio).sum(axis=(1, 2))
+
+
+def quantize_rows(data, nbins):
+    """
+    Bin index of each value, with nbins equal bins between the min and max of each row (same bins as np.histogram2d).
+    :param data: 2d array
+    :param nbins:
+    :return: 2d array of int, same shape as data
+    """
+    data_min = data.min(axis=1).astype(np.float64)
+    data_max = data.max(axis=1).astype(np.float64)
+    # constant rows: bins centered on the value
+    ind_constant = data_min == data_max
+    data_min[ind_constant] -= 0.5
+    data_max[ind_constant] += 0.5
+    step = ((data_max - data_min) / nbins)[:, np.newaxis]
+    edges = np.arange(nbins + 1) * step + data_min[:, np.newaxis]
+    # the last bin includes the max
+    bin_data = np.clip(((data - data_min[:, np.newaxis]) / step).astype(int), 0, nbins - 1)
+    # correct rounding errors, so that values on an edge fall in the upper bin
+    edges_flat, offset = edges.ravel(), np.arange(data.shape[0])[:, np.newaxis] * (nbins + 1)
+    bin_data -= data < edges_flat[offset + bin_data]
+    bin_data += (bin_data < nbins - 1) & (data >= edges_flat[offset + bin_data + 1])
+    return bin_data
+
+
 def label_segmentation(fname_seg, list_disc_z, list_disc_value, verbose=1):
     """
     Label segmentation image
@@ -26,7 +26,7 @@ import scipy
 import nibabel
 import sct_utils as sct
 from msct_nurbs import NURBS
-from sct_image import get_orientation_3d, set_orientation
+from sct_image import get_orientation_3d, set_orientation, reorient
 from sct_straighten_spinalcord import smooth_centerline
 from msct_image import Image
 from shutil import move, copyfile
@@ -58,8 +58,8 @@ def get_parser():
     parser.usage.set_description("""This program is used to get the centerline of the spinal cord of a subject by using one of the three methods describe in the -method flag .""")
     parser.add_option(name='-i',
                       type_value='image_nifti',
-                      description='Spinal Cord segmentation',
-                      mandatory=True,
+                      description='Spinal Cord segmentation (mandatory, except in batch mode: see flag -batch)',
+                      mandatory=False,
                       example='seg.nii.gz')
     parser.add_option(name='-p',
                       type_value='multiple_choice',
@@ -108,6 +108,12 @@ def get_parser():
                       description= 'Vertebral levels to compute the CSA across (requires \"-p csa\"). Example: 2:9 for C2 to T2.',
                       mandatory=False,
                       example='2:9')
+    parser.add_option(name='-perlevel',
+                      type_value='multiple_choice',
+                      description='1: output CSA, angle and volume within each vertebral level (all levels, or levels selected with flag -vert) in csa_per_level.txt (requires \"-p csa\" and flag -vertfile).',
+                      mandatory=False,
+                      example=['0', '1'],
+                      default_value='0')
     parser.add_option(name='-t',
                       type_value='image_nifti',
                       description='Vertebral labeling file. Only use with flag -vert',
@@ -116,13 +122,29 @@ def get_parser():
                       default_value='label/template/PAM50_levels.nii.gz')
     parser.add_option(name='-vertfile',
                       type_value='image_nifti',
-                      description='Vertebral labeling file. Only use with flag -vert',
+                      description='Vertebral labeling file. Only use with flag -vert or -perlevel',
                       mandatory=False,
                       default_value='./label/template/PAM50_levels.nii.gz')
     parser.add_option(name='-discfile',
                       type_value='image_nifti',
                       description='Disc labeling. Only use with -p label-vert',
                       mandatory=False)
+    parser.add_option(name='-batch',
+                      type_value='file',
+                      description='Batch mode (with \"-p csa\"): text file with one segmentation per line, optionally followed by a comma and a vertebral labeling file. CSA, angle and volume of each slice and each vertebral level are appended to the table specified by \"-table\". Flag -i is ignored.',
+                      mandatory=False,
+                      example='list_seg.txt')
+    parser.add_option(name='-table',
+                      type_value='file_output',
+                      description='Table of results in batch mode: CSV (.csv) or SQLite (.db) file. Rows are appended if the file exists.',
+                      mandatory=False,
+                      default_value='csa_results.csv',
+                      example='csa_results.db')
+    parser.add_option(name='-cpu-nb',
+                      type_value='int',
+                      description='Number of segmentations processed in parallel in batch mode. 0 or 1: no multiprocessing.',
+                      mandatory=False,
+                      example='8')
     parser.add_option(name='-r',
                       type_value='multiple_choice',
                       description= 'Removes the temporary folder and debug folder used for the algorithm at the end of execution',
@@ -183,8 +205,28 @@ def main(args):
     vert_lev = param.vertebral_levels
     angle_correction = True
 
-    fname_segmentation = arguments['-i']
     name_process = arguments['-p']
+
+    # batch mode
+    if name_process == 'csa' and '-batch' in arguments:
+        cpu_number = 1
+        if '-cpu-nb' in arguments:
+            cpu_number = arguments['-cpu-nb']
+        if '-size' in arguments:
+            smoothing_param = arguments['-size']
+        if '-a' in arguments:
+            param.algo_fitting = arguments['-a']
+        if '-no-angle' in arguments:
+            angle_correction = arguments['-no-angle'] == '0'
+        compute_csa_batch(arguments['-batch'], arguments['-table'], cpu_number=cpu_number, verbose=int(arguments['-v']),
+                          smoothing_param=smoothing_param, algo_fitting=param.algo_fitting, type_window=param.type_window,
+                          window_length=param.window_length, angle_correction=angle_correction)
+        sct.printv('\nFinished! Elapsed time: '+str(int(round(time.time() - start_time)))+'s', int(arguments['-v']))
+        return
+
+    if '-i' not in arguments:
+        sct.printv('\nERROR: Segmentation file is mandatory (flag: -i).\n', 1, 'error')
+    fname_segmentation = arguments['-i']
     overwrite = 0
     if "-ofolder" in arguments:
         output_folder = sct.slash_at_the_end(arguments["-ofolder"], slash=1)
@@ -227,7 +269,7 @@ def main(args):
         sct.printv('fslview '+fname_segmentation+' '+fname_output+' -l Red &\n', param.verbose, 'info')
 
     if name_process == 'csa':
-        compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_lev, fname_vertebral_labeling, algo_fitting = param.algo_fitting, type_window= param.type_window, window_length=param.window_length, angle_correction=angle_correction)
+        compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_lev, fname_vertebral_labeling, algo_fitting = param.algo_fitting, type_window= param.type_window, window_length=param.window_length, angle_correction=angle_correction, per_level=int(arguments['-perlevel']))
 
     if name_process == 'label-vert':
         if '-discfile' in arguments:
@@ -318,11 +360,12 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
     # set_orientation(im_seg, 'RPI')
     # im_seg.setFileName(fname_segmentation_orient)
     # im_seg.save()
-    sct.run('sct_image -i segmentation.nii.gz -setorient RPI -o segmentation_RPI.nii.gz', verbose)
+    im_seg_original = Image('segmentation.nii.gz')
+    orientation = im_seg_original.orientation
+    im_seg = reorient(im_seg_original, 'RPI')
 
     # Open segmentation volume
     sct.printv('\nOpen segmentation volume...', verbose)
-    im_seg = Image('segmentation_RPI.nii.gz')
     data = im_seg.data
 
     # Get size of data
@@ -354,11 +397,13 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
         x_seg, y_seg = (data[:,:,iz]>0).nonzero()
         x_centerline[iz-min_z_index] = np.mean(x_seg)
         y_centerline[iz-min_z_index] = np.mean(y_seg)
+    # the segmentation is smoothed below, after its data are set to zero to receive the centerline
+    im_seg_rpi = im_seg.copy()
     for k in range(len(X)):
         data[X[k], Y[k], Z[k]] = 0
 
     # extract centerline and smooth it
-    x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', type_window = type_window, window_length = window_length, algo_fitting = algo_fitting, verbose = verbose)
+    x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg_rpi, type_window = type_window, window_length = window_length, algo_fitting = algo_fitting, verbose = verbose)
 
     if verbose == 2:
             import matplotlib.pyplot as plt
@@ -400,10 +445,9 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
     im_seg.save()
 
     sct.printv('\nSet to original orientation...', verbose)
-    # get orientation of the input data
-    im_seg_original = Image('segmentation.nii.gz')
-    orientation = im_seg_original.orientation
-    sct.run('sct_image -i centerline_RPI.nii.gz -setorient '+orientation+' -o centerline.nii.gz')
+    im_centerline = reorient(im_seg, orientation)
+    im_centerline.setFileName('centerline.nii.gz')
+    im_centerline.save()
 
     # create a txt file with the centerline
     name_output_txt = 'centerline.txt'
@@ -431,9 +475,7 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
 
 # compute_csa
 # ==========================================================================================
-def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True):
-
-    from math import degrees
+def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, per_level=0):
 
     # Extract path, file and extension
     fname_segmentation = os.path.abspath(fname_segmentation)
@@ -451,11 +493,12 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     os.chdir(path_tmp)
     # Change orientation of the input segmentation into RPI
     sct.printv('\nChange orientation to RPI...', verbose)
-    sct.run('sct_image -i segmentation.nii.gz -setorient RPI -o segmentation_RPI.nii.gz', verbose)
+    im_seg_original = Image('segmentation.nii.gz')
+    orientation = im_seg_original.orientation
+    im_seg = reorient(im_seg_original, 'RPI')
 
     # Open segmentation volume
     sct.printv('\nOpen segmentation volume...', verbose)
-    im_seg = Image('segmentation_RPI.nii.gz')
     data_seg = im_seg.data
     # hdr_seg = im_seg.hdr
 
@@ -464,149 +507,42 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
 
-    # # Extract min and max index in Z direction
-    X, Y, Z = (data_seg > 0).nonzero()
-    min_z_index, max_z_index = min(Z), max(Z)
-
-    # extract centerline and smooth it
-    x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True, verbose=verbose, all_slices=False)
-
-    # transform centerline coordinates into voxel space for further use
-    coord_voxel_centerline = im_seg.transfo_phys2pix([[x_centerline_fit[i], y_centerline_fit[i], z_centerline[i]] for i in range(len(z_centerline))])
-    z_centerline_fit_vox = [coord[2] for coord in coord_voxel_centerline]
-
-    # average over slices
-    P_x = np.array(x_centerline_fit)
-    P_y = np.array(y_centerline_fit)
-    P_z = np.array(z_centerline)
-    P_z_vox = np.array(z_centerline_fit_vox)
-    P_x_d = np.array(x_centerline_deriv)
-    P_y_d = np.array(y_centerline_deriv)
-    P_z_d = np.array(z_centerline_deriv)
-
-    P_z_vox = np.array([int(np.round(P_z_vox[i])) for i in range(0, len(P_z_vox))])
-    # not perfect but works (if "enough" points), in order to deal with missing z slices
-    for i in range(min(P_z_vox), max(P_z_vox) + 1, 1):
-        if i not in P_z_vox:
-            P_x_temp = np.insert(P_x, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_x[np.where(P_z_vox == i - 1)[-1][-1]] + P_x[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-            P_y_temp = np.insert(P_y, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_y[np.where(P_z_vox == i - 1)[-1][-1]] + P_y[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-            P_z_temp = np.insert(P_z, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_z[np.where(P_z_vox == i - 1)[-1][-1]] + P_z[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-            P_x_d_temp = np.insert(P_x_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_x_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_x_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-            P_y_d_temp = np.insert(P_y_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_y_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_y_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-            P_z_d_temp = np.insert(P_z_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_z_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_z_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-            P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
+    # compute CSA and angle of each slice
+    z_slices, csa, angles, coord_centerline = compute_csa_per_slice(im_seg, smoothing_param, algo_fitting, type_window, window_length, angle_correction, verbose)
+    min_z_index, max_z_index = z_slices[0], z_slices[-1]
+    x_centerline_fit, y_centerline_fit, z_centerline = coord_centerline[:, 0], coord_centerline[:, 1], coord_centerline[:, 2]
 
-    coord_mean = np.array([[np.mean(P_x[P_z_vox == i]), np.mean(P_y[P_z_vox == i]), np.mean(P_z[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-    x_centerline_fit = coord_mean[:, :][:, 0]
-    y_centerline_fit = coord_mean[:, :][:, 1]
-    coord_mean_d = np.array([[np.mean(P_x_d[P_z_vox == i]), np.mean(P_y_d[P_z_vox == i]), np.mean(P_z_d[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-    z_centerline = coord_mean[:, :][:, 2]
-    x_centerline_deriv = coord_mean_d[:, :][:, 0]
-    y_centerline_deriv = coord_mean_d[:, :][:, 1]
-    z_centerline_deriv = coord_mean_d[:, :][:, 2]
-
-    # Compute CSA
-    sct.printv('\nCompute CSA...', verbose)
-
-    # Empty arrays in which CSA for each z slice will be stored
-    csa = np.zeros(max_z_index-min_z_index+1)
-    angles = np.zeros(max_z_index - min_z_index + 1)
-
-    for iz in xrange(min_z_index, max_z_index+1):
-        if angle_correction:
-            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
-            try:
-                # compute the vector normal to the plane
-                normal = normalize(np.array([x_centerline_deriv[iz-min_z_index], y_centerline_deriv[iz-min_z_index], z_centerline_deriv[iz-min_z_index]]))
-
-            except IndexError:
-                sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
-
-            # compute the angle between the normal vector of the plane and the vector z
-            angle = np.arccos(np.dot(normal, [0, 0, 1]))
-        else:
-            angle = 0.0
-
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = np.sum(data_seg[:, :, iz])
-
-        # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz-min_z_index] = number_voxels * px * py * np.cos(angle)
-        angles[iz - min_z_index] = degrees(angle)
-
-    sct.printv('\nSmooth CSA across slices...', verbose)
-    if smoothing_param:
-        from msct_smooth import smoothing_window
-        sct.printv('.. Hanning window: '+str(smoothing_param)+' mm', verbose)
-        csa_smooth = smoothing_window(csa, window_len=smoothing_param/pz, window='hanning', verbose=0)
-        # display figure
-        if verbose == 2:
-            import matplotlib.pyplot as plt
-            plt.figure()
-            z_centerline_scaled = [x * pz for x in z_centerline]
-            pltx, = plt.plot(z_centerline_scaled, csa, 'bo')
-            pltx_fit, = plt.plot(z_centerline_scaled, csa_smooth, 'r', linewidth=2)
-            plt.title("Cross-sectional area (CSA)")
-            plt.xlabel('z (mm)')
-            plt.ylabel('CSA (mm^2)')
-            plt.legend([pltx, pltx_fit], ['Raw', 'Smoothed'])
-            plt.show()
-        # update variable
-        csa = csa_smooth
-    else:
-        sct.printv('.. No smoothing!', verbose)
-
-    # output volume of csa values
+    # output volume of csa values: each voxel of the segmentation takes the value of its slice
     sct.printv('\nCreate volume of CSA values...', verbose)
-    data_csa = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index+1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_csa[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i],y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_csa[i[0], i[1], iz] = csa[iz-min_z_index]
-    # replace data
-    im_seg.data = data_csa
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
+    mask_seg = data_seg > 0
+    csa_z = np.zeros(nz, dtype=np.float32)
+    csa_z[min_z_index:max_z_index+1] = csa
+    im_seg.data = np.where(mask_seg, csa_z, data_seg).astype(np.float32)
     # set file name -- use .gz because faster to write
     im_seg.setFileName('csa_volume_RPI.nii.gz')
     im_seg.changeType('float32')
     # save volume
     im_seg.save()
+    # set original orientation
+    im_csa = reorient(im_seg, orientation)
+    im_csa.setFileName('csa_volume_in_initial_orientation.nii.gz')
+    im_csa.save()
 
-    # output volume of csa values
+    # output volume of angle values
     sct.printv('\nCreate volume of angle values...', verbose)
-    data_angle = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_angle[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_angle[i[0], i[1], iz] = angles[iz - min_z_index]
-    # replace data
-    im_seg.data = data_angle
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
+    angle_z = np.zeros(nz, dtype=np.float32)
+    angle_z[min_z_index:max_z_index+1] = angles
+    im_seg.data = np.where(mask_seg, angle_z, data_seg).astype(np.float32)
     # set file name -- use .gz because faster to write
     im_seg.setFileName('angle_volume_RPI.nii.gz')
     im_seg.changeType('float32')
     # save volume
     im_seg.save()
 
-    # get orientation of the input data
-    im_seg_original = Image('segmentation.nii.gz')
-    orientation = im_seg_original.orientation
-    sct.run('sct_image -i csa_volume_RPI.nii.gz -setorient '+orientation+' -o csa_volume_in_initial_orientation.nii.gz')
-    sct.run('sct_image -i angle_volume_RPI.nii.gz -setorient '+orientation+' -o angle_volume_in_initial_orientation.nii.gz')
+    # set original orientation
+    im_angle = reorient(im_seg, orientation)
+    im_angle.setFileName('angle_volume_in_initial_orientation.nii.gz')
+    im_angle.save()
 
     # come back to parent folder
     os.chdir('..')
@@ -621,13 +557,33 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     sct.printv('Display CSA per slice:', verbose)
     file_results = open(output_folder+'csa_per_slice.txt', 'w')
     file_results.write('# Slice (z),CSA (mm^2),Angle with respect to the I-S direction (degrees)\n')
-    for i in range(min_z_index, max_z_index+1):
-        file_results.write(str(int(i)) + ',' + str(csa[i-min_z_index])+ ',' + str(angles[i-min_z_index])+'\n')
-        # Display results
-        sct.printv('z = '+str(i-min_z_index)+', CSA = '+str(csa[i-min_z_index])+' mm^2'+', Angle = '+str(angles[i-min_z_index])+' deg', type='info')
+    file_results.write(''.join([str(int(z)) + ',' + str(csa_i) + ',' + str(angle_i) + '\n' for z, csa_i, angle_i in zip(z_slices, csa, angles)]))
     file_results.close()
+    # Display results
+    for i in range(len(z_slices)):
+        sct.printv('z = '+str(i)+', CSA = '+str(csa[i])+' mm^2'+', Angle = '+str(angles[i])+' deg', type='info')
     sct.printv('Save results in: '+output_folder+'csa_per_slice.txt\n', verbose)
 
+    # CSA, angle and volume within each vertebral level, for all levels at once
+    if per_level:
+        sct.printv('Compute CSA within each vertebral level...', verbose)
+        sct.check_file_exist(fname_vertebral_labeling)
+        levels = get_vertebral_level_per_slice(reorient(Image(fname_vertebral_labeling), 'RPI'), coord_centerline, z_slices)
+        if vert_levels:
+            vert_levels_range = [int(x) for x in vert_levels.split(':')]
+            levels[(levels < vert_levels_range[0]) | (levels > vert_levels_range[-1])] = 0
+        volumes = data_seg[:, :, z_slices].sum(axis=(0, 1)) * px * py * pz
+        list_levels, nb_slices_level, mean_level, std_level, sum_level = average_per_level(levels, np.array([csa, angles, volumes]).T)
+        file_results = open(output_folder+'csa_per_level.txt', 'w')
+        file_results.write('# Vertebral level,Number of slices,Slices (z),CSA mean (mm^2),CSA STD (mm^2),Angle mean (degrees),Angle STD (degrees),Volume (mm^3)\n')
+        for i_level, level in enumerate(list_levels):
+            slices_level = z_slices[levels == level]
+            file_results.write(','.join([str(level), str(nb_slices_level[i_level]), str(slices_level[0])+':'+str(slices_level[-1]),
+                                         str(mean_level[i_level, 0]), str(std_level[i_level, 0]), str(mean_level[i_level, 1]), str(std_level[i_level, 1]), str(sum_level[i_level, 2])])+'\n')
+            sct.printv('Level '+str(level)+': CSA = '+str(mean_level[i_level, 0])+' +/- '+str(std_level[i_level, 0])+' mm^2, Angle = '+str(mean_level[i_level, 1])+' +/- '+str(std_level[i_level, 1])+' deg, Volume = '+str(sum_level[i_level, 2])+' mm^3', verbose, 'info')
+        file_results.close()
+        sct.printv('Save results in: '+output_folder+'csa_per_level.txt\n', verbose)
+
 
     # average csa across vertebral levels or slices if asked (flag -z or -l)
     if slices or vert_levels:
@@ -665,16 +621,10 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
         slices_list = range(int(slices_lim[0]), int(slices_lim[-1])+1)
         sct.printv('Average CSA across slices '+str(slices_lim[0])+' to '+str(slices_lim[-1])+'...', type='info')
 
-        CSA_for_selected_slices = []
-        angles_for_selected_slices = []
-        # Read the file csa_per_slice.txt and get the CSA for the selected slices
-        with open(output_folder+'csa_per_slice.txt') as openfile:
-            for line in openfile:
-                if line[0] != '#':
-                    line_split = line.strip().split(',')
-                    if int(line_split[0]) in slices_list:
-                        CSA_for_selected_slices.append(float(line_split[1]))
-                        angles_for_selected_slices.append(float(line_split[2]))
+        # get the CSA for the selected slices
+        index_selected = np.in1d(z_slices, slices_list)
+        CSA_for_selected_slices = csa[index_selected]
+        angles_for_selected_slices = angles[index_selected]
 
         # average the CSA and angle
         mean_CSA = np.mean(np.asarray(CSA_for_selected_slices))
@@ -709,10 +659,281 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     # Sum up the output file names
     sct.printv('\nOutput a nifti file of CSA values along the segmentation: '+output_folder+'csa_image.nii.gz', param.verbose, 'info')
     sct.printv('Output result text file of CSA per slice: '+output_folder+'csa_per_slice.txt', param.verbose, 'info')
+    if per_level:
+        sct.printv('Output result text file of CSA per vertebral level: '+output_folder+'csa_per_level.txt', param.verbose, 'info')
     if slices or vert_levels:
         sct.printv('Output result files of the mean CSA across the selected slices: \n\t\t'+output_folder+'csa_mean.txt\n\t\t'+output_folder+'csa_mean.xls\n\t\t'+output_folder+'csa_mean.pickle', param.verbose, 'info')
         sct.printv('Output result files of the volume in between the selected slices: \n\t\t'+output_folder+'csa_volume.txt\n\t\t'+output_folder+'csa_volume.xls\n\t\t'+output_folder+'csa_volume.pickle', param.verbose, 'info')
 
+def compute_csa_per_slice(im_seg, smoothing_param=0, algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, verbose=1):
+    """
+    Compute the cross-sectional area and the angle between the centerline and the I-S direction in each slice of the
+    segmentation.
+    :param im_seg: segmentation (Image in RPI orientation)
+    :return: z_slices: array of slice indexes (from first to last non-null slice)
+             csa: array of CSA (mm^2), for each slice of z_slices
+             angles: array of angles (degrees), for each slice of z_slices
+             coord_centerline: array (n, 3) of physical coordinates of the centerline, averaged in each slice
+    """
+    nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
+
+    # # Extract min and max index in Z direction
+    X, Y, Z = (im_seg.data > 0).nonzero()
+    min_z_index, max_z_index = min(Z), max(Z)
+
+    # extract centerline and smooth it
+    x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True, verbose=verbose, all_slices=False)
+
+    # transform centerline coordinates into voxel space for further use
+    coord_voxel_centerline = im_seg.transfo_phys2pix([[x_centerline_fit[i], y_centerline_fit[i], z_centerline[i]] for i in range(len(z_centerline))])
+    z_centerline_fit_vox = [coord[2] for coord in coord_voxel_centerline]
+
+    # average over slices
+    P_x = np.array(x_centerline_fit)
+    P_y = np.array(y_centerline_fit)
+    P_z = np.array(z_centerline)
+    P_z_vox = np.array(z_centerline_fit_vox)
+    P_x_d = np.array(x_centerline_deriv)
+    P_y_d = np.array(y_centerline_deriv)
+    P_z_d = np.array(z_centerline_deriv)
+
+    P_z_vox = np.round(P_z_vox).astype(int)
+    # not perfect but works (if "enough" points), in order to deal with missing z slices
+    for i in range(min(P_z_vox), max(P_z_vox) + 1, 1):
+        if i not in P_z_vox:
+            P_x_temp = np.insert(P_x, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_x[np.where(P_z_vox == i - 1)[-1][-1]] + P_x[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
+            P_y_temp = np.insert(P_y, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_y[np.where(P_z_vox == i - 1)[-1][-1]] + P_y[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
+            P_z_temp = np.insert(P_z, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_z[np.where(P_z_vox == i - 1)[-1][-1]] + P_z[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
+            P_x_d_temp = np.insert(P_x_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_x_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_x_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
+            P_y_d_temp = np.insert(P_y_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_y_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_y_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
+            P_z_d_temp = np.insert(P_z_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_z_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_z_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
+            P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
+
+    index_z = P_z_vox - min(P_z_vox)
+    count_z = np.bincount(index_z).astype(float)
+    coord_mean = np.column_stack([np.bincount(index_z, weights=P) / count_z for P in [P_x, P_y, P_z]])
+    x_centerline_fit = coord_mean[:, :][:, 0]
+    y_centerline_fit = coord_mean[:, :][:, 1]
+    coord_mean_d = np.column_stack([np.bincount(index_z, weights=P) / count_z for P in [P_x_d, P_y_d, P_z_d]])
+    z_centerline = coord_mean[:, :][:, 2]
+    x_centerline_deriv = coord_mean_d[:, :][:, 0]
+    y_centerline_deriv = coord_mean_d[:, :][:, 1]
+    z_centerline_deriv = coord_mean_d[:, :][:, 2]
+
+    # Compute CSA
+    sct.printv('\nCompute CSA...', verbose)
+    data_seg = im_seg.data
+
+    # compute the number of voxels in each slice, assuming the segmentation is coded for partial volume effect between 0 and 1.
+    number_voxels = data_seg[:, :, min_z_index:max_z_index+1].sum(axis=(0, 1))
+
+    if angle_correction:
+        # compute the vector normal to the plane of each slice
+        normals = coord_mean_d[:max_z_index-min_z_index+1]
+        normals = normals / np.linalg.norm(normals, axis=1)[:, np.newaxis]
+        # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
+        if len(normals) < len(number_voxels):
+            sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
+            normals = np.concatenate((normals, np.tile(normals[-1], (len(number_voxels) - len(normals), 1))))
+        # compute the angle between the normal vector of the plane and the vector z
+        angles_rad = np.arccos(normals[:, 2])
+    else:
+        angles_rad = np.zeros(len(number_voxels))
+
+    # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
+    csa = number_voxels * px * py * np.cos(angles_rad)
+    angles = np.degrees(angles_rad)
+
+    sct.printv('\nSmooth CSA across slices...', verbose)
+    if smoothing_param:
+        from msct_smooth import smoothing_window
+        sct.printv('.. Hanning window: '+str(smoothing_param)+' mm', verbose)
+        csa_smooth = smoothing_window(csa, window_len=smoothing_param/pz, window='hanning', verbose=0)
+        # display figure
+        if verbose == 2:
+            import matplotlib.pyplot as plt
+            plt.figure()
+            z_centerline_scaled = [x * pz for x in z_centerline]
+            pltx, = plt.plot(z_centerline_scaled, csa, 'bo')
+            pltx_fit, = plt.plot(z_centerline_scaled, csa_smooth, 'r', linewidth=2)
+            plt.title("Cross-sectional area (CSA)")
+            plt.xlabel('z (mm)')
+            plt.ylabel('CSA (mm^2)')
+            plt.legend([pltx, pltx_fit], ['Raw', 'Smoothed'])
+            plt.show()
+        # update variable
+        csa = csa_smooth
+    else:
+        sct.printv('.. No smoothing!', verbose)
+
+    return np.arange(min_z_index, max_z_index+1), csa, angles, coord_mean
+
+
+def get_vertebral_level_per_slice(im_vertebral_labeling, coord_centerline, z_slices):
+    """
+    Get the vertebral level of each slice, from the value of the vertebral labeling at the centerline.
+    :param im_vertebral_labeling: Image in RPI orientation, in the same space as the segmentation
+    :param coord_centerline: array (n, 3) of physical coordinates of the centerline (see compute_csa_per_slice())
+    :param z_slices: array of slice indexes
+    :return: array of vertebral levels (0 if the centerline is outside the labeling), for each slice of z_slices
+    """
+    data_labeling = im_vertebral_labeling.data
+    coord_vox = np.array(im_vertebral_labeling.transfo_phys2pix(coord_centerline.tolist()), dtype=int).reshape(-1, 3)
+    inside = np.all((coord_vox >= 0) & (coord_vox < data_labeling.shape[:3]), axis=1)
+    coord_vox = coord_vox[inside]
+    level_z = np.zeros(data_labeling.shape[2], dtype=int)
+    level_z[coord_vox[:, 2]] = data_labeling[coord_vox[:, 0], coord_vox[:, 1], coord_vox[:, 2]]
+    return level_z[z_slices]
+
+
+def average_per_level(levels, values):
+    """
+    Average values across the slices of each vertebral level, for all levels in one pass.
+    :param levels: array (nb_slices) of int: vertebral level of each slice (0: no level)
+    :param values: array (nb_slices, nb_values)
+    :return: list_levels, nb_slices, mean, std, sum (one item/row per level)
+    """
+    levels = np.asarray(levels, dtype=int)
+    count = np.bincount(levels)
+    list_levels = np.flatnonzero(count[1:]) + 1
+    sums = np.array([np.bincount(levels, weights=values[:, i], minlength=len(count)) for i in range(values.shape[1])]).T[list_levels]
+    sums2 = np.array([np.bincount(levels, weights=values[:, i]**2, minlength=len(count)) for i in range(values.shape[1])]).T[list_levels]
+    nb_slices = count[list_levels]
+    mean = sums / nb_slices[:, np.newaxis]
+    std = np.sqrt(np.maximum(sums2 / nb_slices[:, np.newaxis] - mean**2, 0))
+    return list_levels, nb_slices, mean, std, sums
+
+
+def compute_csa_rows(fname_segmentation, fname_vertebral_labeling='', smoothing_param=0, algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, verbose=0):
+    """
+    Compute CSA, angle and volume of a segmentation for each slice and, if a vertebral labeling is provided, for each
+    vertebral level. Everything is done in memory (no temporary folder).
+    :return: list of rows of the results table (see CSA_TABLE_COLUMNS)
+    """
+    im_seg = reorient(Image(fname_segmentation, verbose=verbose), 'RPI')
+    nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
+    z_slices, csa, angles, coord_centerline = compute_csa_per_slice(im_seg, smoothing_param, algo_fitting, type_window, window_length, angle_correction, verbose)
+    volumes = im_seg.data[:, :, z_slices].sum(axis=(0, 1)) * px * py * pz
+    if fname_vertebral_labeling:
+        levels = get_vertebral_level_per_slice(reorient(Image(fname_vertebral_labeling, verbose=verbose), 'RPI'), coord_centerline, z_slices)
+    else:
+        levels = np.zeros(len(z_slices), dtype=int)
+
+    # one row per slice
+    fname_segmentation = os.path.abspath(fname_segmentation)
+    rows = [(fname_segmentation, 'slice', int(z), int(level) if level else None, 1, float(csa_z), None, float(angle_z), None, float(volume_z))
+            for z, level, csa_z, angle_z, volume_z in zip(z_slices, levels, csa, angles, volumes)]
+
+    # one row per vertebral level: mean and std across the slices of the level, total volume
+    list_levels, nb_slices, mean, std, sums = average_per_level(levels, np.array([csa, angles, volumes]).T)
+    rows += [(fname_segmentation, 'level', None, int(level), int(nb_slices[i]), float(mean[i, 0]), float(std[i, 0]),
+              float(mean[i, 1]), float(std[i, 1]), float(sums[i, 2])) for i, level in enumerate(list_levels)]
+    return rows
+
+
+# columns of the table of results output in batch mode
+CSA_TABLE_COLUMNS = ['filename', 'scope', 'slice', 'level', 'nb_slices', 'csa', 'csa_std', 'angle', 'angle_std', 'volume']
+
+
+class ResultsTable(object):
+    """
+    Table of results to which rows are appended in bulk. The format depends on the extension of the file name: CSV
+    (.csv, .txt) or SQLite database (.db, .sqlite).
+    """
+    def __init__(self, fname, columns, table_name='csa'):
+        self.fname = fname
+        self.columns = columns
+        self.table_name = table_name
+        self.is_sqlite = os.path.splitext(fname)[1] in ['.db', '.sqlite']
+        if self.is_sqlite:
+            import sqlite3
+            db = sqlite3.connect(self.fname)
+            db.execute('CREATE TABLE IF NOT EXISTS '+self.table_name+' ('+', '.join(self.columns)+')')
+            db.commit()
+            db.close()
+        elif not os.path.isfile(self.fname) or os.path.getsize(self.fname) == 0:
+            import csv
+            with open(self.fname, 'wb') as f:
+                csv.writer(f).writerow(self.columns)
+
+    def append(self, rows):
+        if not rows:
+            return
+        if self.is_sqlite:
+            import sqlite3
+            db = sqlite3.connect(self.fname)
+            with db:
+                db.executemany('INSERT INTO '+self.table_name+' VALUES ('+', '.join(['?'] * len(self.columns))+')', rows)
+            db.close()
+        else:
+            import csv
+            with open(self.fname, 'ab') as f:
+                csv.writer(f).writerows(rows)
+
+
+# parameters of compute_csa_rows() in worker processes, set by init_batch_worker() (see compute_csa_batch())
+batch_args = {}
+
+
+def init_batch_worker(kwargs):
+    global batch_args
+    batch_args = kwargs
+
+
+def compute_csa_rows_batch(args, kwargs=None):
+    """
+    Worker function of compute_csa_batch(). Errors are returned instead of raised, so that one subject does not stop
+    the whole batch.
+    :param kwargs: parameters of compute_csa_rows(). None: batch_args (worker processes)
+    """
+    fname_segmentation, fname_vertebral_labeling = args
+    if kwargs is None:
+        kwargs = batch_args
+    try:
+        return fname_segmentation, compute_csa_rows(fname_segmentation, fname_vertebral_labeling, **kwargs), ''
+    except (Exception, SystemExit) as e:
+        return fname_segmentation, [], repr(e)
+
+
+def compute_csa_batch(fname_list, fname_table, cpu_number=1, verbose=1, **kwargs):
+    """
+    Compute CSA of a list of segmentations and append the results in one table (see compute_csa_rows()).
+    :param fname_list: text file with one segmentation per line, optionally followed by a comma and a vertebral
+    labeling file. Empty lines and lines starting with # are ignored.
+    :param fname_table: table of results (.csv or .db/.sqlite)
+    :param cpu_number: number of subjects processed in parallel
+    :param kwargs: parameters of compute_csa_rows()
+    :return: list of segmentations that could not be processed
+    """
+    list_args = []
+    for line in open(fname_list):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            items = [item.strip() for item in line.split(',')]
+            list_args.append((os.path.abspath(items[0]), os.path.abspath(items[1]) if len(items) > 1 and items[1] else ''))
+    sct.printv('\nCompute CSA of '+str(len(list_args))+' segmentations...', verbose)
+
+    table = ResultsTable(fname_table, CSA_TABLE_COLUMNS)
+    list_failed = []
+
+    def append_results(results):
+        for i, (fname_segmentation, rows, error) in enumerate(results):
+            if error:
+                sct.printv('WARNING: CSA could not be computed for '+fname_segmentation+': '+error, verbose, 'warning')
+                list_failed.append(fname_segmentation)
+            else:
+                sct.printv('  '+str(i+1)+'/'+str(len(list_args))+': '+fname_segmentation, verbose)
+            table.append(rows)
+
+    if cpu_number > 1 and len(list_args) > 1:
+        with sct.process_pool(min(cpu_number, len(list_args)), initializer=init_batch_worker, initargs=(kwargs,)) as pool:
+            append_results(pool.imap_unordered(compute_csa_rows_batch, list_args))
+    else:
+        append_results(compute_csa_rows_batch(args, kwargs) for args in list_args)
+    sct.printv('\nResults appended to: '+fname_table, verbose, 'info')
+    return list_failed
+
+
 def label_vert(fname_seg, fname_label, verbose=1):
     """
     Label segmentation using vertebral labeling information
@@ -928,12 +1149,11 @@ def get_slices_matching_with_vertebral_levels_based_centerline(vertebral_levels,
 
     # Find slices included in the vertebral levels wanted by the user
     sct.printv('\tFind slices corresponding to vertebral levels based on the centerline...')
-    nz = len(z_centerline)
-    matching_slices_centerline_vert_labeling = []
-    for i_z in range(0, nz):
-        # if the centerline is in the vertebral levels asked by the user, record the slice number
-        if vertebral_labeling_data[np.round(x_centerline_fit[i_z]), np.round(y_centerline_fit[i_z]), z_centerline[i_z]] in range(vert_levels_list[0], vert_levels_list[1]+1):
-            matching_slices_centerline_vert_labeling.append(z_centerline[i_z])
+    # vertebral level at the centerline of each slice
+    z_centerline = np.asarray(z_centerline, dtype=int)
+    level_centerline = vertebral_labeling_data[np.round(x_centerline_fit).astype(int), np.round(y_centerline_fit).astype(int), z_centerline]
+    # if the centerline is in the vertebral levels asked by the user, record the slice number
+    matching_slices_centerline_vert_labeling = z_centerline[np.in1d(level_centerline, range(int(vert_levels_list[0]), int(vert_levels_list[1])+1))]
 
     # now, find the min and max slices that are included in the vertebral levels
     slices = str(min(matching_slices_centerline_vert_labeling))+':'+str(max(matching_slices_centerline_vert_labeling))
@@ -266,7 +266,7 @@ if __name__ == "__main__":
 
     # check if input image is in 3D. Otherwise itk image reader will cut the 4D image in 3D volumes and only take the first one.
     from msct_image import Image
-    image_input = Image(input_filename)
+    image_input = Image(input_filename, lazy=True)
     nx, ny, nz, nt, px, py, pz, pt = image_input.dim
     if nt > 1:
         sct.printv('ERROR: your input image needs to be 3D in order to be segmented.', 1, 'error')
@@ -274,14 +274,13 @@ if __name__ == "__main__":
     # if centerline or mask is asked using viewer
     if use_viewer:
         # make sure image is in SAL orientation, as it is the orientation used by PropSeg
-        from sct_image import orientation
+        from sct_image import orientation, set_orientation
         image_input_orientation = orientation(image_input, get=True, verbose=False)
         path_fname, file_fname, ext_fname = sct.extract_fname(input_filename)
         reoriented_image_filename = 'tmp.' + sct.add_suffix(file_fname + ext_fname, "_SAL")
-        sct.run('sct_image -i ' + input_filename + ' -o ' + folder_output + reoriented_image_filename + ' -setorient SAL -v 0', verbose=False)
+        image_input_reoriented = set_orientation(image_input, 'SAL', fname_out=folder_output + reoriented_image_filename)
 
         from sct_viewer import ClickViewer
-        image_input_reoriented = Image(folder_output + reoriented_image_filename)
         viewer = ClickViewer(image_input_reoriented)
         viewer.help_url = 'https://sourceforge.net/p/spinalcordtoolbox/wiki/correction_PropSeg/attachment/propseg_viewer.png'
         if use_viewer == "mask":
@@ -302,7 +301,7 @@ if __name__ == "__main__":
 
             # reorient the initialization mask to correspond to input image orientation
             mask_reoriented_filename = sct.add_suffix(file_fname + ext_fname, "_mask_viewer")
-            sct.run('sct_image -i ' + folder_output + mask_filename + ' -o ' + folder_output + mask_reoriented_filename + ' -setorient ' + image_input_orientation + ' -v 0', verbose=False)
+            set_orientation(folder_output + mask_filename, image_input_orientation, filename=True, fname_out=folder_output + mask_reoriented_filename)
 
             # remove temporary files
             sct.run('rm -rf ' + folder_output + 'tmp.*')
@@ -24,7 +24,8 @@ from sct_utils import add_suffix
 from sct_image import set_orientation
 from sct_register_multimodal import Paramreg, ParamregMultiStep, register
 from msct_parser import Parser
-from msct_image import Image, find_zmin_zmax
+from msct_image import Image
+import msct_pipeline as pipeline
 from shutil import move
 from sct_label_utils import ProcessLabels
 import numpy as np
@@ -132,11 +133,11 @@ def get_parser():
                       description="""Parameters for straightening (see sct_straighten_spinalcord).""",
                       mandatory=False,
                       default_value='')
-    # parser.add_option(name="-cpu-nb",
-    #                   type_value="int",
-    #                   description="Number of CPU used for straightening. 0: no multiprocessing. By default, uses all the available cores.",
-    #                   mandatory=False,
-    #                   example="8")
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for straightening. 0 or 1: no multiprocessing (default).",
+                      mandatory=False,
+                      example="8")
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -177,10 +178,10 @@ def main():
     param.verbose = verbose  # TODO: not clean, unify verbose or param.verbose in code, but not both
     if '-param-straighten' in arguments:
         param.param_straighten = arguments['-param-straighten']
-    # if '-cpu-nb' in arguments:
-    #     arg_cpu = ' -cpu-nb '+str(arguments['-cpu-nb'])
-    # else:
-    #     arg_cpu = ''
+    if '-cpu-nb' in arguments:
+        arg_cpu = ' -cpu-nb '+str(arguments['-cpu-nb'])
+    else:
+        arg_cpu = ''
     # registration parameters
     if '-param' in arguments:
         # reset parameters but keep step=0 (might be overwritten if user specified step=0)
@@ -276,18 +277,23 @@ def main():
     ftmp_template_seg = 'template_seg.nii.gz'
     ftmp_template_label = 'template_label.nii.gz'
 
-    # copy files to temporary folder
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-    sct.run('sct_convert -i '+fname_data+' -o '+path_tmp+ftmp_data)
-    sct.run('sct_convert -i '+fname_seg+' -o '+path_tmp+ftmp_seg)
-    sct.run('sct_convert -i '+fname_landmarks+' -o '+path_tmp+ftmp_label)
-    sct.run('sct_convert -i '+fname_template+' -o '+path_tmp+ftmp_template)
-    sct.run('sct_convert -i '+fname_template_seg+' -o '+path_tmp+ftmp_template_seg)
-    # sct.run('sct_convert -i '+fname_template_label+' -o '+path_tmp+ftmp_template_label)
+    # load input data. N.B. images are processed in memory and only written in the temporary folder when needed by
+    # other programs (ANTs, straightening, registration).
+    sct.printv('\nLoad input data...', verbose)
+    im_data = pipeline.load(fname_data, verbose=verbose)
+    im_seg = pipeline.load(fname_seg, verbose=verbose)
+    im_label = image_label
+    im_template = pipeline.load(fname_template, verbose=verbose)
+    im_template_seg = pipeline.load(fname_template_seg, verbose=verbose)
 
     # go to tmp folder
     os.chdir(path_tmp)
 
+    # write reference spaces used by the concatenation of transformations
+    sct.printv('\nWrite reference spaces in tmp folder...', verbose)
+    pipeline.save(im_data, ftmp_data, verbose=verbose)
+    pipeline.save(im_template, ftmp_template, verbose=verbose)
+
     # Generate labels from template vertebral labeling
     sct.printv('\nGenerate labels from template vertebral labeling', verbose)
     sct.run('sct_label_utils -i '+fname_template_vertebral_labeling+' -vert-body 0 -o '+ftmp_template_label)
@@ -303,7 +309,7 @@ def main():
 
     # binarize segmentation (in case it has values below 0 caused by manual editing)
     sct.printv('\nBinarize segmentation', verbose)
-    sct.run('sct_maths -i seg.nii.gz -bin 0.5 -o seg.nii.gz')
+    im_seg = pipeline.binarize(im_seg, 0.5, verbose=verbose)
 
     # smooth segmentation (jcohenadad, issue #613)
     # sct.printv('\nSmooth segmentation...', verbose)
@@ -317,29 +323,28 @@ def main():
 
         # resample data to 1mm isotropic
         sct.printv('\nResample data to 1mm isotropic...', verbose)
-        sct.run('sct_resample -i '+ftmp_data+' -mm 1.0x1.0x1.0 -x linear -o '+add_suffix(ftmp_data, '_1mm'))
+        im_data = pipeline.resample(im_data, '1.0x1.0x1.0', 'mm', 'linear', verbose=verbose)
         ftmp_data = add_suffix(ftmp_data, '_1mm')
-        sct.run('sct_resample -i '+ftmp_seg+' -mm 1.0x1.0x1.0 -x linear -o '+add_suffix(ftmp_seg, '_1mm'))
+        im_seg = pipeline.resample(im_seg, '1.0x1.0x1.0', 'mm', 'linear', verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_1mm')
         # N.B. resampling of labels is more complicated, because they are single-point labels, therefore resampling with neighrest neighbour can make them disappear. Therefore a more clever approach is required.
-        resample_labels(ftmp_label, ftmp_data, add_suffix(ftmp_label, '_1mm'))
+        im_label = resample_labels(im_label, im_data, verbose=verbose)
         ftmp_label = add_suffix(ftmp_label, '_1mm')
 
         # Change orientation of input images to RPI
         sct.printv('\nChange orientation of input images to RPI...', verbose)
-        sct.run('sct_image -i '+ftmp_data+' -setorient RPI -o '+add_suffix(ftmp_data, '_rpi'))
         ftmp_data = add_suffix(ftmp_data, '_rpi')
-        sct.run('sct_image -i '+ftmp_seg+' -setorient RPI -o '+add_suffix(ftmp_seg, '_rpi'))
+        im_data = pipeline.set_orientation(im_data, 'RPI', fname_out=ftmp_data, verbose=verbose)
+        im_seg = pipeline.set_orientation(im_seg, 'RPI', verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_rpi')
-        sct.run('sct_image -i '+ftmp_label+' -setorient RPI -o '+add_suffix(ftmp_label, '_rpi'))
         ftmp_label = add_suffix(ftmp_label, '_rpi')
+        im_label = pipeline.set_orientation(im_label, 'RPI', fname_out=ftmp_label, verbose=verbose)
 
         # get landmarks in native space
         # crop segmentation
         # output: segmentation_rpi_crop.nii.gz
-        status_crop, output_crop = sct.run('sct_crop_image -i '+ftmp_seg+' -o '+add_suffix(ftmp_seg, '_crop')+' -dim 2 -bzmax', verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_crop')
-        cropping_slices = output_crop.split('Dimension 2: ')[1].split('\n')[0].split(' ')
+        im_seg, zmin_seg, zmax_seg = pipeline.crop_to_content(im_seg, dim=2, fname_out=ftmp_seg, verbose=verbose)
 
         # straighten segmentation
         sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
@@ -351,12 +356,12 @@ def main():
             shutil.copy('../warp_straight2curve.nii.gz', 'warp_straight2curve.nii.gz')
             shutil.copy('../straight_ref.nii.gz', 'straight_ref.nii.gz')
             # apply straightening
-            sct.run('sct_apply_transfo -i '+ftmp_seg+' -w warp_curve2straight.nii.gz -d straight_ref.nii.gz -o '+add_suffix(ftmp_seg, '_straight'))
+            pipeline.apply_transfo(ftmp_seg, 'straight_ref.nii.gz', ['warp_curve2straight.nii.gz'], add_suffix(ftmp_seg, '_straight'), verbose=verbose)
         else:
-            sct.run('sct_straighten_spinalcord -i '+ftmp_seg+' -s '+ftmp_seg+' -o '+add_suffix(ftmp_seg, '_straight')+' -qc 0 -r 0 -v '+str(verbose), verbose)
+            sct.run('sct_straighten_spinalcord -i '+ftmp_seg+' -s '+ftmp_seg+' -o '+add_suffix(ftmp_seg, '_straight')+' -qc 0 -r 0 -v '+str(verbose)+arg_cpu, verbose)
         # N.B. DO NOT UPDATE VARIABLE ftmp_seg BECAUSE TEMPORARY USED LATER
         # re-define warping field using non-cropped space (to avoid issue #367)
-        sct.run('sct_concat_transfo -w warp_straight2curve.nii.gz -d '+ftmp_data+' -o warp_straight2curve.nii.gz')
+        pipeline.concat_transfo(['warp_straight2curve.nii.gz'], ftmp_data, 'warp_straight2curve.nii.gz', verbose=verbose)
 
         # Label preparation:
         # --------------------------------------------------------------------------------
@@ -366,12 +371,12 @@ def main():
 
         # Dilating the input label so they can be straighten without losing them
         sct.printv('\nDilating input labels using 3vox ball radius')
-        sct.run('sct_maths -i '+ftmp_label+' -o '+add_suffix(ftmp_label, '_dilate')+' -dilate 3')
+        im_label = pipeline.dilate(im_label, [3], fname_out=add_suffix(ftmp_label, '_dilate'), verbose=verbose)
         ftmp_label = add_suffix(ftmp_label, '_dilate')
 
         # Apply straightening to labels
         sct.printv('\nApply straightening to labels...', verbose)
-        sct.run('sct_apply_transfo -i '+ftmp_label+' -o '+add_suffix(ftmp_label, '_straight')+' -d '+add_suffix(ftmp_seg, '_straight')+' -w warp_curve2straight.nii.gz -x nn')
+        pipeline.apply_transfo(ftmp_label, add_suffix(ftmp_seg, '_straight'), ['warp_curve2straight.nii.gz'], add_suffix(ftmp_label, '_straight'), interp='nn', verbose=verbose)
         ftmp_label = add_suffix(ftmp_label, '_straight')
 
         # Compute rigid transformation straight landmarks --> template landmarks
@@ -384,13 +389,13 @@ def main():
 
         # Concatenate transformations: curve --> straight --> affine
         sct.printv('\nConcatenate transformations: curve --> straight --> affine...', verbose)
-        sct.run('sct_concat_transfo -w warp_curve2straight.nii.gz,straight2templateAffine.txt -d template.nii -o warp_curve2straightAffine.nii.gz')
+        pipeline.concat_transfo(['warp_curve2straight.nii.gz', 'straight2templateAffine.txt'], 'template.nii', 'warp_curve2straightAffine.nii.gz', verbose=verbose)
 
         # Apply transformation
         sct.printv('\nApply transformation...', verbose)
-        sct.run('sct_apply_transfo -i '+ftmp_data+' -o '+add_suffix(ftmp_data, '_straightAffine')+' -d '+ftmp_template+' -w warp_curve2straightAffine.nii.gz')
+        im_data = pipeline.apply_transfo(ftmp_data, ftmp_template, ['warp_curve2straightAffine.nii.gz'], add_suffix(ftmp_data, '_straightAffine'), verbose=verbose)
         ftmp_data = add_suffix(ftmp_data, '_straightAffine')
-        sct.run('sct_apply_transfo -i '+ftmp_seg+' -o '+add_suffix(ftmp_seg, '_straightAffine')+' -d '+ftmp_template+' -w warp_curve2straightAffine.nii.gz -x linear')
+        im_seg = pipeline.apply_transfo(ftmp_seg, ftmp_template, ['warp_curve2straightAffine.nii.gz'], add_suffix(ftmp_seg, '_straightAffine'), interp='linear', verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_straightAffine')
 
         """
@@ -406,33 +411,33 @@ def main():
 
         # binarize
         sct.printv('\nBinarize segmentation...', verbose)
-        sct.run('sct_maths -i '+ftmp_seg+' -bin 0.5 -o '+add_suffix(ftmp_seg, '_bin'))
+        im_seg = pipeline.binarize(im_seg, 0.5, verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_bin')
 
         # find min-max of anat2template (for subsequent cropping)
-        zmin_template, zmax_template = find_zmin_zmax(ftmp_seg)
+        zmin_template, zmax_template = pipeline.get_bounding_slices(im_seg, dim=2)
 
         # crop template in z-direction (for faster processing)
         sct.printv('\nCrop data in template space (for faster processing)...', verbose)
-        sct.run('sct_crop_image -i '+ftmp_template+' -o '+add_suffix(ftmp_template, '_crop')+' -dim 2 -start '+str(zmin_template)+' -end '+str(zmax_template))
+        im_template = pipeline.crop(im_template, 2, zmin_template, zmax_template, verbose=verbose)
         ftmp_template = add_suffix(ftmp_template, '_crop')
-        sct.run('sct_crop_image -i '+ftmp_template_seg+' -o '+add_suffix(ftmp_template_seg, '_crop')+' -dim 2 -start '+str(zmin_template)+' -end '+str(zmax_template))
+        im_template_seg = pipeline.crop(im_template_seg, 2, zmin_template, zmax_template, verbose=verbose)
         ftmp_template_seg = add_suffix(ftmp_template_seg, '_crop')
-        sct.run('sct_crop_image -i '+ftmp_data+' -o '+add_suffix(ftmp_data, '_crop')+' -dim 2 -start '+str(zmin_template)+' -end '+str(zmax_template))
+        im_data = pipeline.crop(im_data, 2, zmin_template, zmax_template, verbose=verbose)
         ftmp_data = add_suffix(ftmp_data, '_crop')
-        sct.run('sct_crop_image -i '+ftmp_seg+' -o '+add_suffix(ftmp_seg, '_crop')+' -dim 2 -start '+str(zmin_template)+' -end '+str(zmax_template))
+        im_seg = pipeline.crop(im_seg, 2, zmin_template, zmax_template, verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_crop')
 
         # sub-sample in z-direction
         sct.printv('\nSub-sample in z-direction (for faster processing)...', verbose)
-        sct.run('sct_resample -i '+ftmp_template+' -o '+add_suffix(ftmp_template, '_sub')+' -f 1x1x'+zsubsample, verbose)
         ftmp_template = add_suffix(ftmp_template, '_sub')
-        sct.run('sct_resample -i '+ftmp_template_seg+' -o '+add_suffix(ftmp_template_seg, '_sub')+' -f 1x1x'+zsubsample, verbose)
+        pipeline.resample(im_template, '1x1x'+zsubsample, 'factor', fname_out=ftmp_template, verbose=verbose)
         ftmp_template_seg = add_suffix(ftmp_template_seg, '_sub')
-        sct.run('sct_resample -i '+ftmp_data+' -o '+add_suffix(ftmp_data, '_sub')+' -f 1x1x'+zsubsample, verbose)
+        pipeline.resample(im_template_seg, '1x1x'+zsubsample, 'factor', fname_out=ftmp_template_seg, verbose=verbose)
         ftmp_data = add_suffix(ftmp_data, '_sub')
-        sct.run('sct_resample -i '+ftmp_seg+' -o '+add_suffix(ftmp_seg, '_sub')+' -f 1x1x'+zsubsample, verbose)
+        pipeline.resample(im_data, '1x1x'+zsubsample, 'factor', fname_out=ftmp_data, verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_sub')
+        pipeline.resample(im_seg, '1x1x'+zsubsample, 'factor', fname_out=ftmp_seg, verbose=verbose)
 
         # Registration straight spinal cord to template
         sct.printv('\nRegister straight spinal cord to template...', verbose)
@@ -457,7 +462,7 @@ def main():
             if i_step > 1:
                 # sct.run('sct_apply_transfo -i '+src+' -d '+dest+' -w '+','.join(warp_forward)+' -o '+sct.add_suffix(src, '_reg')+' -x '+interp_step, verbose)
                 # apply transformation from previous step, to use as new src for registration
-                sct.run('sct_apply_transfo -i '+src+' -d '+dest+' -w '+','.join(warp_forward)+' -o '+add_suffix(src, '_regStep'+str(i_step-1))+' -x '+interp_step, verbose)
+                pipeline.apply_transfo(src, dest, warp_forward, add_suffix(src, '_regStep'+str(i_step-1)), interp=interp_step, verbose=verbose)
                 src = add_suffix(src, '_regStep'+str(i_step-1))
             # register src --> dest
             # TODO: display param for debugging
@@ -467,23 +472,25 @@ def main():
 
         # Concatenate transformations:
         sct.printv('\nConcatenate transformations: anat --> template...', verbose)
-        sct.run('sct_concat_transfo -w warp_curve2straightAffine.nii.gz,'+','.join(warp_forward)+' -d template.nii -o warp_anat2template.nii.gz', verbose)
+        pipeline.concat_transfo(['warp_curve2straightAffine.nii.gz']+warp_forward, 'template.nii', 'warp_anat2template.nii.gz', verbose=verbose)
         # sct.run('sct_concat_transfo -w warp_curve2straight.nii.gz,straight2templateAffine.txt,'+','.join(warp_forward)+' -d template.nii -o warp_anat2template.nii.gz', verbose)
         sct.printv('\nConcatenate transformations: template --> anat...', verbose)
         warp_inverse.reverse()
-        sct.run('sct_concat_transfo -w '+','.join(warp_inverse)+',-straight2templateAffine.txt,warp_straight2curve.nii.gz -d data.nii -o warp_template2anat.nii.gz', verbose)
+        pipeline.concat_transfo(warp_inverse+['-straight2templateAffine.txt', 'warp_straight2curve.nii.gz'], 'data.nii', 'warp_template2anat.nii.gz', verbose=verbose)
 
     # register template->subject
     elif ref == 'subject':
 
         # Change orientation of input images to RPI
         sct.printv('\nChange orientation of input images to RPI...', verbose)
-        sct.run('sct_image -i ' + ftmp_data + ' -setorient RPI -o ' + add_suffix(ftmp_data, '_rpi'))
         ftmp_data = add_suffix(ftmp_data, '_rpi')
-        sct.run('sct_image -i ' + ftmp_seg + ' -setorient RPI -o ' + add_suffix(ftmp_seg, '_rpi'))
+        pipeline.set_orientation(im_data, 'RPI', fname_out=ftmp_data, verbose=verbose)
         ftmp_seg = add_suffix(ftmp_seg, '_rpi')
-        sct.run('sct_image -i ' + ftmp_label + ' -setorient RPI -o ' + add_suffix(ftmp_label, '_rpi'))
+        pipeline.set_orientation(im_seg, 'RPI', fname_out=ftmp_seg, verbose=verbose)
         ftmp_label = add_suffix(ftmp_label, '_rpi')
+        pipeline.set_orientation(im_label, 'RPI', fname_out=ftmp_label, verbose=verbose)
+        # template files are used as sources for registration
+        pipeline.save(im_template_seg, ftmp_template_seg, verbose=verbose)
 
         # Remove unused label on template. Keep only label present in the input label image
         sct.printv('\nRemove unused label on template. Keep only label present in the input label image...', verbose)
@@ -532,7 +539,7 @@ def main():
             else:
                 sct.printv('ERROR: Wrong image type.', 1, 'error')
             # apply transformation from previous step, to use as new src for registration
-            sct.run('sct_apply_transfo -i '+src+' -d '+dest+' -w '+','.join(warp_forward)+' -o '+add_suffix(src, '_regStep'+str(i_step-1))+' -x '+interp_step, verbose)
+            pipeline.apply_transfo(src, dest, warp_forward, add_suffix(src, '_regStep'+str(i_step-1)), interp=interp_step, verbose=verbose)
             src = add_suffix(src, '_regStep'+str(i_step-1))
             # register src --> dest
             # TODO: display param for debugging
@@ -542,13 +549,13 @@ def main():
 
         # Concatenate transformations:
         sct.printv('\nConcatenate transformations: template --> subject...', verbose)
-        sct.run('sct_concat_transfo -w '+','.join(warp_forward)+' -d data.nii -o warp_template2anat.nii.gz', verbose)
+        pipeline.concat_transfo(warp_forward, 'data.nii', 'warp_template2anat.nii.gz', verbose=verbose)
         sct.printv('\nConcatenate transformations: subject --> template...', verbose)
-        sct.run('sct_concat_transfo -w '+','.join(warp_inverse)+' -d template.nii -o warp_anat2template.nii.gz', verbose)
+        pipeline.concat_transfo(warp_inverse, 'template.nii', 'warp_anat2template.nii.gz', verbose=verbose)
 
     # Apply warping fields to anat and template
-    sct.run('sct_apply_transfo -i template.nii -o template2anat.nii.gz -d data.nii -w warp_template2anat.nii.gz -crop 1', verbose)
-    sct.run('sct_apply_transfo -i data.nii -o anat2template.nii.gz -d template.nii -w warp_anat2template.nii.gz -crop 1', verbose)
+    pipeline.apply_transfo('template.nii', 'data.nii', ['warp_template2anat.nii.gz'], 'template2anat.nii.gz', crop=1, verbose=verbose)
+    pipeline.apply_transfo('data.nii', 'template.nii', ['warp_anat2template.nii.gz'], 'anat2template.nii.gz', crop=1, verbose=verbose)
 
     # come back to parent folder
     os.chdir('..')
@@ -582,29 +589,33 @@ def main():
 
 # Resample labels
 # ==========================================================================================
-def resample_labels(fname_labels, fname_dest, fname_output):
+def resample_labels(im_labels, im_dest, fname_output='', verbose=1):
     """
     This function re-create labels into a space that has been resampled. It works by re-defining the location of each
     label using the old and new voxel size.
+    :param im_labels: Image of labels
+    :param im_dest: Image in the resampled space
+    :param fname_output: if specified, labels are written on disk
+    :param verbose:
+    :return: Image of labels in the resampled space
     """
     # get dimensions of input and destination files
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_labels).dim
-    nxd, nyd, nzd, ntd, pxd, pyd, pzd, ptd = Image(fname_dest).dim
+    nx, ny, nz, nt, px, py, pz, pt = im_labels.dim
+    nxd, nyd, nzd, ntd, pxd, pyd, pzd, ptd = im_dest.dim
     sampling_factor = [float(nx)/nxd, float(ny)/nyd, float(nz)/nzd]
-    # read labels
-    from sct_label_utils import ProcessLabels
-    processor = ProcessLabels(fname_labels)
-    label_list = processor.display_voxel()
-    label_new_list = []
-    for label in label_list:
-        label_sub_new = [str(int(round(int(label.x)/sampling_factor[0]))),
-                         str(int(round(int(label.y)/sampling_factor[1]))),
-                         str(int(round(int(label.z)/sampling_factor[2]))),
-                         str(int(float(label.value)))]
-        label_new_list.append(','.join(label_sub_new))
-    label_new_list = ':'.join(label_new_list)
     # create new labels
-    sct.run('sct_label_utils -i '+fname_dest+' -create '+label_new_list+' -v 1 -o '+fname_output)
+    im_output = Image(np.zeros(im_dest.data.shape), hdr=im_dest.hdr.copy(), orientation=im_dest.orientation,
+                      absolutepath=im_dest.absolutepath, dim=im_dest.dim)
+    for label in im_labels.getNonZeroCoordinates(sorting='z'):
+        x_new = int(round(int(label.x)/sampling_factor[0]))
+        y_new = int(round(int(label.y)/sampling_factor[1]))
+        z_new = int(round(int(label.z)/sampling_factor[2]))
+        sct.printv('Label: '+str(x_new)+','+str(y_new)+','+str(z_new)+' --> '+str(int(float(label.value))), verbose)
+        im_output.data[x_new, y_new, z_new] = int(float(label.value))
+    im_output.setFileName(sct.add_suffix(im_labels.absolutepath, '_1mm'))
+    if fname_output:
+        pipeline.save(im_output, fname_output, type='minimize_int')
+    return im_output
 
 
 # START PROGRAM
@@ -141,6 +141,12 @@ def get_parser():
                       mandatory=False,
                       default_value=0.8,
                       example=0.6)
+    parser.add_option(name="-slice-index",
+                      type_value='multiple_choice',
+                      description="1: use a KD-tree index over the dictionary slices (in the reduced model space, by vertebral level) to compare each target slice only with the most similar dictionary slices. Faster with large dictionaries; similarities (beta) are normalized over these slices only: the other slices account for less than epsilon of the normalization (epsilon: threshold of beta for the selection of slices, 1/(2J)).",
+                      mandatory=False,
+                      default_value='0',
+                      example=['0', '1'])
     parser.add_option(name="-model",
                       type_value="folder",
                       description="Path to the model data",
@@ -658,6 +664,8 @@ if __name__ == "__main__":
             seg_param.target_means = arguments["-means"]
         if "-k" in arguments:
             model_param.k = arguments["-k"]
+        if "-slice-index" in arguments:
+            model_param.use_slice_index = bool(int(arguments["-slice-index"]))
         if "-ratio" in arguments:
             if arguments["-ratio"] == '0':
                 compute_ratio = False
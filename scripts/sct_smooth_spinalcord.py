@@ -111,7 +111,7 @@ def main(args=None):
 
     # Check that input is 3D:
     from msct_image import Image
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_anat).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_anat, lazy=True).dim
     dim = 4  # by default, will be adjusted later
     if nt == 1:
         dim = 3
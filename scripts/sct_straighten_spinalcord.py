@@ -163,11 +163,95 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
             x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
 
 
+# version of the warping fields stored in cache. Change it when the computation of warping fields changes.
+CACHE_VERSION = 'straightening_1'
+
+# approximate peak memory used per voxel when computing displacements (coordinates, nearest points, plane matrices...)
+BYTES_PER_VOXEL = 400
+
+
+def allocate_warp(shape, fname_memmap=''):
+    """
+    Allocate a float32 warping field, in memory or memory-mapped to a file.
+    """
+    if fname_memmap:
+        return np.memmap(fname_memmap, dtype=np.float32, mode='w+', shape=shape)
+    return np.zeros(shape, dtype=np.float32)
+
+
+def compute_displacements(sform, size_xy, slab, centerline, centerline_other, threshold_distance, curved=True):
+    """
+    Compute the displacement (ITK convention, i.e., inverted) of the voxels of a slab of slices, from the space of
+    centerline to the space of centerline_other.
+    For each voxel:
+        a. determine which plane of spinal cord centreline it is included (nearest point of the centerline)
+        b. compute the position of the voxel in the plane (X and Y distance from centreline, along the plane)
+        c. find the correspondant centreline point in the other space
+        d. find the correspondance of the voxel in the corresponding plane
+    Voxels that are more distant from the plane than threshold_distance are set to 100000.
+    :param sform: voxel to physical space matrix of the image
+    :param size_xy: (nx, ny)
+    :param slab: (z_start, z_end), z_end excluded
+    :param centerline: Centerline in the space of the voxels
+    :param centerline_other: Centerline in the other space
+    :param curved: True if voxels are in the curved space (the other space is straight)
+    :return: numpy array (nx, ny, z_end - z_start, 3), float32
+    """
+    nx, ny = size_xy
+    z_start, z_end = slab
+    indexes = np.mgrid[0:nx, 0:ny, z_start:z_end].reshape(3, -1)
+    physical_coordinates = (np.dot(sform[0:3, 0:3], indexes) + sform[0:3, 3:4]).transpose()
+    del indexes
+    nearest_indexes = centerline.find_nearest_indexes(physical_coordinates)
+
+    # compute the distance from voxels to corresponding plans.
+    # This distance is used to blackout voxels that are not in the modified image.
+    distances = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes)
+    indexes_out_distance = np.logical_or(distances > threshold_distance, distances < -threshold_distance)
+
+    # compute the position of the voxel in the plane coordinate system
+    projected_points = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+    coord_in_planes = centerline.get_in_plans_coordinates(projected_points, nearest_indexes)
+    del projected_points
+
+    # compute coordinate in the other space based on position on plane
+    if curved:
+        coord_other = centerline_other.points[nearest_indexes]
+        coord_other[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_other[:, 2] += distances
+    else:
+        coord_other = centerline_other.get_inverse_plans_coordinates(coord_in_planes, nearest_indexes)
+    del coord_in_planes, nearest_indexes, distances
+
+    displacements = coord_other - physical_coordinates
+    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+    # For error-free interpolation purpose, warping fields are inverted in the definition of ITK.
+    return -displacements.reshape(nx, ny, z_end - z_start, 3).astype(np.float32)
+
+
+# arguments of compute_displacements() in worker processes, set by init_slab_worker() (see
+# SpinalCordStraightener.compute_warp())
+slab_args = {}
+
+
+def init_slab_worker(args):
+    global slab_args
+    slab_args = args
+
+
+def compute_displacements_slab(slab):
+    return slab, compute_displacements(slab=slab, **slab_args)
+
+
 class SpinalCordStraightener(object):
 
     def __init__(self, input_filename, centerline_filename, debug=0, deg_poly=10, gapxy=30, gapz=15,
                  leftright_width=150, interpolation_warp='spline', rm_tmp_files=1, verbose=1, algo_fitting='nurbs',
-                 precision=2.0, threshold_distance=2.5, type_window='hanning', window_length=50, output_filename=''):
+                 precision=2.0, threshold_distance=2.5, type_window='hanning', window_length=50, output_filename='',
+                 memory_limit=2048, cpu_number=0, path_cache=None,
+                 cache_size=None):
         self.input_filename = input_filename
         self.centerline_filename = centerline_filename
         self.output_filename = output_filename
@@ -186,11 +270,49 @@ class SpinalCordStraightener(object):
         self.type_window = type_window  # !! for more choices, edit msct_smooth. Possibilities: 'flat', 'hanning',
         # 'hamming', 'bartlett', 'blackman'
         self.window_length = window_length
+        self.memory_limit = memory_limit  # approximate memory (in MB) used to compute warping fields
+        self.cpu_number = cpu_number  # number of processes used to compute warping fields. 0 or 1: no multiprocessing
+        if path_cache is None:
+            path_cache = os.environ.get('SCT_STRAIGHTENING_CACHE', '')
+        self.path_cache = path_cache  # folder where warping fields are cached. '': no cache. None: SCT_STRAIGHTENING_CACHE
+        self.cache_size = cache_size  # maximum size of the cache (MB). None: SCT_STRAIGHTENING_CACHE_SIZE, or 2000
         self.path_output = ""
 
         self.mse_straightening = 0.0
         self.max_distance_straightening = 0.0
 
+    def get_slab_size(self, nx, ny):
+        """
+        Number of slices that are processed at once, so that intermediate arrays fit in memory_limit (shared between
+        processes).
+        """
+        slab_size = int(self.memory_limit * 1024 ** 2 / (BYTES_PER_VOXEL * nx * ny * max(1, self.cpu_number)))
+        return max(1, slab_size)
+
+    def compute_warp(self, image, centerline, centerline_other, data_warp, curved=True):
+        """
+        Fill a warping field, slab by slab. See compute_displacements().
+        :param image: Image defining the space of the warping field
+        :param centerline: Centerline in the space of image
+        :param centerline_other: Centerline in the other space
+        :param data_warp: output array (nx, ny, nz, 1, 3)
+        :param curved: True if image is the curved space
+        """
+        nx, ny, nz = data_warp.shape[:3]
+        slab_size = self.get_slab_size(nx, ny)
+        slabs = [(z_start, min(z_start + slab_size, nz)) for z_start in range(0, nz, slab_size)]
+        sct.printv('.. '+str(len(slabs))+' slab(s) of '+str(min(slab_size, nz))+' slices', self.verbose)
+        args = dict(sform=image.hdr.get_sform(), size_xy=(nx, ny), centerline=centerline,
+                    centerline_other=centerline_other, threshold_distance=self.threshold_distance, curved=curved)
+        if self.cpu_number > 1 and len(slabs) > 1:
+            # centerlines and geometry are passed once to each worker process
+            with sct.process_pool(min(self.cpu_number, len(slabs)), initializer=init_slab_worker, initargs=(args,)) as pool:
+                for slab, displacements in pool.imap_unordered(compute_displacements_slab, slabs):
+                    data_warp[:, :, slab[0]:slab[1], 0, :] = displacements
+        else:
+            for slab in slabs:
+                data_warp[:, :, slab[0]:slab[1], 0, :] = compute_displacements(slab=slab, **args)
+
     def straighten(self):
         # Initialization
         fname_anat = self.input_filename
@@ -255,289 +377,252 @@ class SpinalCordStraightener(object):
                 image_centerline.data[image_centerline.data > 1] = 1
                 image_centerline.save()
 
-            """
-            Steps: (everything is done in physical space)
-            1. open input image and centreline image
-            2. extract bspline fitting of the centreline, and its derivatives
-            3. compute length of centerline
-            4. compute and generate straight space
-            5. compute transformations
-                for each voxel of one space: (done using matrices --> improves speed by a factor x300)
-                    a. determine which plane of spinal cord centreline it is included
-                    b. compute the position of the voxel in the plane (X and Y distance from centreline, along the plane)
-                    c. find the correspondant centreline point in the other space
-                    d. find the correspondance of the voxel in the corresponding plane
-            6. generate warping fields for each transformations
-            7. write warping fields and apply them
-
-            step 5.b: how to find the corresponding plane?
-                The centerline plane corresponding to a voxel correspond to the nearest point of the centerline.
-                However, we need to compute the distance between the voxel position and the plane to be sure it is part of the plane and not too distant.
-                If it is more far than a threshold, warping value should be 0.
-
-            step 5.d: how to make the correspondance between centerline point in both images?
-                Both centerline have the same lenght. Therefore, we can map centerline point via their position along the curve.
-                If we use the same number of points uniformely along the spinal cord (1000 for example), the correspondance is straight-forward.
-            """
-
-            # number of points along the spinal cord
-            if algo_fitting == 'hanning':
-                number_of_points = nz
+            # look for warping fields computed from the same centerline, geometry and parameters
+            fname_warps = ['tmp.curve2straight.nii.gz', 'tmp.straight2curve.nii.gz', 'tmp.centerline_pad_crop.nii.gz']
+            cache, key_cache = None, ''
+            if self.path_cache:
+                from msct_cache import FileCache, get_max_size
+                cache_size = self.cache_size if self.cache_size is not None else get_max_size('SCT_STRAIGHTENING_CACHE_SIZE')
+                cache = FileCache(self.path_cache, max_size=cache_size, verbose=verbose)
+                key_cache = cache.compute_key([CACHE_VERSION, image_centerline.data, image_centerline.hdr.get_best_affine(),
+                                               self.algo_fitting, self.type_window, self.window_length, self.precision,
+                                               self.threshold_distance])
+            if cache is not None and cache.get(key_cache, fname_warps):
+                sct.printv('\nWarping fields found in cache.', verbose)
             else:
-                number_of_points = int(self.precision * (float(nz) / pz))
-                if number_of_points < 100:
-                    number_of_points *= 50
-
-            # 2. extract bspline fitting of the centreline, and its derivatives
-            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('centerline_rpi.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, verbose=verbose, nurbs_pts_number=number_of_points, all_slices=False, phys_coordinates=True, remove_outliers=True)
-            from msct_types import Centerline
-            centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
-
-            # ==========================================================================================
-            sct.printv("\nCreate the straight space and the safe zone...", verbose)
-            # 3. compute length of centerline
-            # compute the length of the spinal cord based on fitted centerline and size of centerline in z direction
-            from math import sqrt, atan2, sin
-
-            # Computation of the safe zone.
-            # The safe zone is defined as the length of the spinal cord for which an axial segmentation will be complete
-            # The safe length (to remove) is computed using the safe radius (given as parameter) and the angle of the
-            # last centerline point with the inferior-superior direction. Formula: Ls = Rs * sin(angle)
-            # Calculate Ls for both edges and remove appropriate number of centerline points
-            radius_safe = 0.0  # mm
-
-            # inferior edge
-            u = np.array([x_centerline_deriv[0], y_centerline_deriv[0], z_centerline_deriv[0]])
-            v = np.array([0, 0, -1])
-            angle_inferior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
-            length_safe_inferior = radius_safe * sin(angle_inferior)
-
-            # superior edge
-            u = np.array([x_centerline_deriv[-1], y_centerline_deriv[-1], z_centerline_deriv[-1]])
-            v = np.array([0, 0, 1])
-            angle_superior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
-            length_safe_superior = radius_safe * sin(angle_superior)
-
-            # remove points
-            from bisect import bisect
-            inferior_bound = bisect(centerline.progressive_length, length_safe_inferior) - 1
-            superior_bound = centerline.number_of_points - bisect(centerline.progressive_length_inverse, length_safe_superior)
-
-            length_centerline = centerline.length
-            size_z_centerline = z_centerline[-1] - z_centerline[0]
-
-            # compute the size factor between initial centerline and straight bended centerline
-            factor_curved_straight = length_centerline / size_z_centerline
-            middle_slice = (z_centerline[0] + z_centerline[-1]) / 2.0
-
-            bound_curved = [z_centerline[inferior_bound], z_centerline[superior_bound]]
-            bound_straight = [(z_centerline[inferior_bound] - middle_slice) * factor_curved_straight + middle_slice,
-                              (z_centerline[superior_bound] - middle_slice) * factor_curved_straight + middle_slice]
-
-            if verbose == 2:
-                print "Length of spinal cord = ", str(length_centerline)
-                print "Size of spinal cord in z direction = ", str(size_z_centerline)
-                print "Ratio length/size = ", str(factor_curved_straight)
-                print "Safe zone boundaries: "
-                print "Curved space = ", bound_curved
-                print "Straight space = ", bound_straight
-
-            # 4. compute and generate straight space
-            # points along curved centerline are already regularly spaced.
-            # calculate position of points along straight centerline
-
-            # Create straight NIFTI volumes
-            # ==========================================================================================
-            sct.printv('\nPad input volume to account for spinal cord length...', verbose)
-            from numpy import ceil
-            start_point = (z_centerline[0] - middle_slice) * factor_curved_straight + middle_slice
-            end_point = (z_centerline[-1] - middle_slice) * factor_curved_straight + middle_slice
-
-            padding_z = int(ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz))
-            sct.run('sct_image -i centerline_rpi.nii.gz -o tmp.centerline_pad.nii.gz -pad 0,0,'+str(padding_z))
-            image_centerline_pad = Image('centerline_rpi.nii.gz')
-            nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
-            hdr_warp = image_centerline_pad.hdr.copy()
-            start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
-            end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
-
-            straight_size_x = int(35 / px)
-            straight_size_y = int(35 / py)
-            warp_space_x = [int(np.round(nx / 2)) - straight_size_x, int(np.round(nx / 2)) + straight_size_x]
-            warp_space_y = [int(np.round(ny / 2)) - straight_size_y, int(np.round(ny / 2)) + straight_size_y]
-            if warp_space_x[0] < 0:
-                warp_space_x[1] += warp_space_x[0] - 2
-                warp_space_x[0] = 0
-            if warp_space_y[0] < 0:
-                warp_space_y[1] += warp_space_y[0] - 2
-                warp_space_y[0] = 0
-
-            sct.run('sct_crop_image -i tmp.centerline_pad.nii.gz -o tmp.centerline_pad_crop.nii.gz -dim 0,1,2 -start ' + str(warp_space_x[0]) + ',' + str(warp_space_y[0]) + ',0 -end ' + str(warp_space_x[1]) + ',' + str(warp_space_y[1]) + ',' + str(end_point_coord[2] - start_point_coord[2]))
-            image_centerline_straight = Image('tmp.centerline_pad_crop.nii.gz')
-            nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
-            hdr_warp_s = image_centerline_straight.hdr.copy()
-            hdr_warp_s.set_data_dtype('float32')
-            #origin = [(nx_s * px_s)/2.0, -(ny_s * py_s)/2.0, -(nz_s * pz_s)/2.0]
-            #hdr_warp_s.structarr['qoffset_x'] = origin[0]
-            #hdr_warp_s.structarr['qoffset_y'] = origin[1]
-            #hdr_warp_s.structarr['qoffset_z'] = origin[2]
-            #hdr_warp_s.structarr['srow_x'][-1] = origin[0]
-            #hdr_warp_s.structarr['srow_y'][-1] = origin[1]
-            #hdr_warp_s.structarr['srow_z'][-1] = origin[2]
-            hdr_warp_s.structarr['quatern_b'] = 0.0
-            hdr_warp_s.structarr['quatern_c'] = 1.0
-            hdr_warp_s.structarr['quatern_d'] = 0.0
-            hdr_warp_s.structarr['srow_x'][0] = -px_s
-            hdr_warp_s.structarr['srow_x'][1] = 0.0
-            hdr_warp_s.structarr['srow_x'][2] = 0.0
-            hdr_warp_s.structarr['srow_y'][0] = 0.0
-            hdr_warp_s.structarr['srow_y'][1] = py_s
-            hdr_warp_s.structarr['srow_y'][2] = 0.0
-            hdr_warp_s.structarr['srow_z'][0] = 0.0
-            hdr_warp_s.structarr['srow_z'][1] = 0.0
-            hdr_warp_s.structarr['srow_z'][2] = pz_s
-            image_centerline_straight.hdr = hdr_warp_s
-            image_centerline_straight.compute_transform_matrix()
-            image_centerline_straight.save()
-
-            start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
-            end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
-
-            number_of_voxel = nx * ny * nz
-            sct.printv("Number of voxel = " + str(number_of_voxel))
-
-            time_centerlines = time.time()
+                """
+                Steps: (everything is done in physical space)
+                1. open input image and centreline image
+                2. extract bspline fitting of the centreline, and its derivatives
+                3. compute length of centerline
+                4. compute and generate straight space
+                5. compute transformations
+                    for each voxel of one space: (done using matrices --> improves speed by a factor x300)
+                        a. determine which plane of spinal cord centreline it is included
+                        b. compute the position of the voxel in the plane (X and Y distance from centreline, along the plane)
+                        c. find the correspondant centreline point in the other space
+                        d. find the correspondance of the voxel in the corresponding plane
+                6. generate warping fields for each transformations
+                7. write warping fields and apply them
+
+                step 5.b: how to find the corresponding plane?
+                    The centerline plane corresponding to a voxel correspond to the nearest point of the centerline.
+                    However, we need to compute the distance between the voxel position and the plane to be sure it is part of the plane and not too distant.
+                    If it is more far than a threshold, warping value should be 0.
+
+                step 5.d: how to make the correspondance between centerline point in both images?
+                    Both centerline have the same lenght. Therefore, we can map centerline point via their position along the curve.
+                    If we use the same number of points uniformely along the spinal cord (1000 for example), the correspondance is straight-forward.
+                """
+
+                # number of points along the spinal cord
+                if algo_fitting == 'hanning':
+                    number_of_points = nz
+                else:
+                    number_of_points = int(self.precision * (float(nz) / pz))
+                    if number_of_points < 100:
+                        number_of_points *= 50
+
+                # 2. extract bspline fitting of the centreline, and its derivatives
+                x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('centerline_rpi.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, verbose=verbose, nurbs_pts_number=number_of_points, all_slices=False, phys_coordinates=True, remove_outliers=True)
+                from msct_types import Centerline
+                centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
+
+                # ==========================================================================================
+                sct.printv("\nCreate the straight space and the safe zone...", verbose)
+                # 3. compute length of centerline
+                # compute the length of the spinal cord based on fitted centerline and size of centerline in z direction
+                from math import sqrt, atan2, sin
+
+                # Computation of the safe zone.
+                # The safe zone is defined as the length of the spinal cord for which an axial segmentation will be complete
+                # The safe length (to remove) is computed using the safe radius (given as parameter) and the angle of the
+                # last centerline point with the inferior-superior direction. Formula: Ls = Rs * sin(angle)
+                # Calculate Ls for both edges and remove appropriate number of centerline points
+                radius_safe = 0.0  # mm
+
+                # inferior edge
+                u = np.array([x_centerline_deriv[0], y_centerline_deriv[0], z_centerline_deriv[0]])
+                v = np.array([0, 0, -1])
+                angle_inferior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
+                length_safe_inferior = radius_safe * sin(angle_inferior)
+
+                # superior edge
+                u = np.array([x_centerline_deriv[-1], y_centerline_deriv[-1], z_centerline_deriv[-1]])
+                v = np.array([0, 0, 1])
+                angle_superior = atan2(np.linalg.norm(np.cross(u, v)), np.dot(u, v))
+                length_safe_superior = radius_safe * sin(angle_superior)
+
+                # remove points
+                from bisect import bisect
+                inferior_bound = bisect(centerline.progressive_length, length_safe_inferior) - 1
+                superior_bound = centerline.number_of_points - bisect(centerline.progressive_length_inverse, length_safe_superior)
+
+                length_centerline = centerline.length
+                size_z_centerline = z_centerline[-1] - z_centerline[0]
+
+                # compute the size factor between initial centerline and straight bended centerline
+                factor_curved_straight = length_centerline / size_z_centerline
+                middle_slice = (z_centerline[0] + z_centerline[-1]) / 2.0
+
+                bound_curved = [z_centerline[inferior_bound], z_centerline[superior_bound]]
+                bound_straight = [(z_centerline[inferior_bound] - middle_slice) * factor_curved_straight + middle_slice,
+                                  (z_centerline[superior_bound] - middle_slice) * factor_curved_straight + middle_slice]
+
+                if verbose == 2:
+                    print "Length of spinal cord = ", str(length_centerline)
+                    print "Size of spinal cord in z direction = ", str(size_z_centerline)
+                    print "Ratio length/size = ", str(factor_curved_straight)
+                    print "Safe zone boundaries: "
+                    print "Curved space = ", bound_curved
+                    print "Straight space = ", bound_straight
+
+                # 4. compute and generate straight space
+                # points along curved centerline are already regularly spaced.
+                # calculate position of points along straight centerline
+
+                # Create straight NIFTI volumes
+                # ==========================================================================================
+                sct.printv('\nPad input volume to account for spinal cord length...', verbose)
+                from numpy import ceil
+                start_point = (z_centerline[0] - middle_slice) * factor_curved_straight + middle_slice
+                end_point = (z_centerline[-1] - middle_slice) * factor_curved_straight + middle_slice
+
+                padding_z = int(ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz))
+                sct.run('sct_image -i centerline_rpi.nii.gz -o tmp.centerline_pad.nii.gz -pad 0,0,'+str(padding_z))
+                image_centerline_pad = Image('centerline_rpi.nii.gz')
+                nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
+                hdr_warp = image_centerline_pad.hdr.copy()
+                start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
+                end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
+
+                straight_size_x = int(35 / px)
+                straight_size_y = int(35 / py)
+                warp_space_x = [int(np.round(nx / 2)) - straight_size_x, int(np.round(nx / 2)) + straight_size_x]
+                warp_space_y = [int(np.round(ny / 2)) - straight_size_y, int(np.round(ny / 2)) + straight_size_y]
+                if warp_space_x[0] < 0:
+                    warp_space_x[1] += warp_space_x[0] - 2
+                    warp_space_x[0] = 0
+                if warp_space_y[0] < 0:
+                    warp_space_y[1] += warp_space_y[0] - 2
+                    warp_space_y[0] = 0
+
+                sct.run('sct_crop_image -i tmp.centerline_pad.nii.gz -o tmp.centerline_pad_crop.nii.gz -dim 0,1,2 -start ' + str(warp_space_x[0]) + ',' + str(warp_space_y[0]) + ',0 -end ' + str(warp_space_x[1]) + ',' + str(warp_space_y[1]) + ',' + str(end_point_coord[2] - start_point_coord[2]))
+                image_centerline_straight = Image('tmp.centerline_pad_crop.nii.gz')
+                nx_s, ny_s, nz_s, nt_s, px_s, py_s, pz_s, pt_s = image_centerline_straight.dim
+                hdr_warp_s = image_centerline_straight.hdr.copy()
+                hdr_warp_s.set_data_dtype('float32')
+                #origin = [(nx_s * px_s)/2.0, -(ny_s * py_s)/2.0, -(nz_s * pz_s)/2.0]
+                #hdr_warp_s.structarr['qoffset_x'] = origin[0]
+                #hdr_warp_s.structarr['qoffset_y'] = origin[1]
+                #hdr_warp_s.structarr['qoffset_z'] = origin[2]
+                #hdr_warp_s.structarr['srow_x'][-1] = origin[0]
+                #hdr_warp_s.structarr['srow_y'][-1] = origin[1]
+                #hdr_warp_s.structarr['srow_z'][-1] = origin[2]
+                hdr_warp_s.structarr['quatern_b'] = 0.0
+                hdr_warp_s.structarr['quatern_c'] = 1.0
+                hdr_warp_s.structarr['quatern_d'] = 0.0
+                hdr_warp_s.structarr['srow_x'][0] = -px_s
+                hdr_warp_s.structarr['srow_x'][1] = 0.0
+                hdr_warp_s.structarr['srow_x'][2] = 0.0
+                hdr_warp_s.structarr['srow_y'][0] = 0.0
+                hdr_warp_s.structarr['srow_y'][1] = py_s
+                hdr_warp_s.structarr['srow_y'][2] = 0.0
+                hdr_warp_s.structarr['srow_z'][0] = 0.0
+                hdr_warp_s.structarr['srow_z'][1] = 0.0
+                hdr_warp_s.structarr['srow_z'][2] = pz_s
+                image_centerline_straight.hdr = hdr_warp_s
+                image_centerline_straight.compute_transform_matrix()
+                image_centerline_straight.save()
+
+                start_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
+                end_point_coord = image_centerline_pad.transfo_phys2pix([[0, 0, end_point]])[0]
+
+                number_of_voxel = nx * ny * nz
+                sct.printv("Number of voxel = " + str(number_of_voxel))
+
+                time_centerlines = time.time()
             
-            from numpy import linspace
-            ix_straight = [int(np.round(nx_s / 2))] * number_of_points
-            iy_straight = [int(np.round(ny_s / 2))] * number_of_points
-            iz_straight = linspace(0, end_point_coord[2] - start_point_coord[2], number_of_points)
-            dx_straight = [0.0] * number_of_points
-            dy_straight = [0.0] * number_of_points
-            dz_straight = [1.0] * number_of_points
-            coord_straight = np.array(zip(ix_straight, iy_straight, iz_straight))
-            coord_phys_straight = np.asarray(image_centerline_straight.transfo_pix2phys(coord_straight))
-
-            centerline_straight = Centerline(coord_phys_straight[:, 0], coord_phys_straight[:, 1], coord_phys_straight[:, 2],
-                                             dx_straight, dy_straight, dz_straight)
-
-
-            time_centerlines = time.time() - time_centerlines
-            sct.printv('Time to generate centerline: ' + str(np.round(time_centerlines * 1000.0)) + ' ms', verbose)
-
-            """
-            import matplotlib.pyplot as plt
-            curved_points = centerline.progressive_length
-            straight_points = centerline_straight.progressive_length
-            range_points = linspace(0, 1, number_of_points)
-            dist_curved = np.zeros(number_of_points)
-            dist_straight = np.zeros(number_of_points)
-            for i in range(1, number_of_points):
-                dist_curved[i] = dist_curved[i - 1] + curved_points[i - 1] / centerline.length
-                dist_straight[i] = dist_straight[i - 1] + straight_points[i - 1] / centerline_straight.length
-            plt.plot(range_points, dist_curved)
-            plt.plot(range_points, dist_straight)
-            plt.grid(True)
-            plt.show()
-            """
-
-            # Create volumes containing curved and straight warping fields
-            time_generation_volumes = time.time()
-            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
-
-            # 5. compute transformations
-            # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
-            # b. determine which plane of spinal cord centreline it is included
-            x, y, z = np.mgrid[0:nx, 0:ny, 0:nz]
-            indexes = np.array(zip(x.ravel(), y.ravel(), z.ravel()))
-            x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, 0:nz_s]
-            indexes_straight = np.array(zip(x_s.ravel(), y_s.ravel(), z_s.ravel()))
-            time_generation_volumes = time.time() - time_generation_volumes
-            sct.printv('Time to generate volumes and indices: ' + str(np.round(time_generation_volumes * 1000.0)) + ' ms', verbose)
-
-            time_find_nearest_indexes = time.time()
-            physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-            physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-            nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-            nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-            time_find_nearest_indexes = time.time() - time_find_nearest_indexes
-            sct.printv('Time to find nearest centerline points: ' + str(np.round(time_find_nearest_indexes * 1000.0)) + ' ms', verbose)
-
-            # compute the distance from voxels to corresponding plans.
-            # This distance is used to blackout voxels that are not in the modified image.
-            time_get_distances_from_planes = time.time()
-            distances_curved = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes_curved)
-            distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight, nearest_indexes_straight)
-            indexes_out_distance_curved = np.logical_or(distances_curved > self.threshold_distance, distances_curved < -self.threshold_distance)
-            indexes_out_distance_straight = np.logical_or(distances_straight > self.threshold_distance, distances_straight < -self.threshold_distance)
-            time_get_distances_from_planes = time.time() - time_get_distances_from_planes
-            sct.printv('Time to compute distance between voxels and nearest planes: ' + str(np.round(time_get_distances_from_planes * 1000.0)) + ' ms', verbose)
-
-            # c. compute the position of the voxel in the plane coordinate system
-            # (X and Y distance from centreline, along the plane)
-            time_get_projected_coordinates_on_planes = time.time()
-            projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes_curved)
-            projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(physical_coordinates_straight, nearest_indexes_straight)
-            time_get_projected_coordinates_on_planes = time.time() - time_get_projected_coordinates_on_planes
-            sct.printv('Time to get projected voxels on planes: ' + str(np.round(time_get_projected_coordinates_on_planes * 1000.0)) + ' ms', verbose)
-
-            # e. find the correspondance of the voxel in the corresponding plane
-            time_get_in_plans_coordinates = time.time()
-            coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved, nearest_indexes_curved)
-            coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight, nearest_indexes_straight)
-            time_get_in_plans_coordinates = time.time() - time_get_in_plans_coordinates
-            sct.printv('Time to get in-plane coordinates: ' + str(np.round(time_get_in_plans_coordinates * 1000.0)) + ' ms', verbose)
-
-            # 6. generate warping fields for each transformations
-            # compute coordinate in straight space based on position on plane
-            time_displacements = time.time()
-            coord_curved2straight = centerline_straight.points[nearest_indexes_curved]
-            coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-            coord_curved2straight[:, 2] += distances_curved
-
-            displacements_curved = coord_curved2straight - physical_coordinates
-            # for some reason, displacement in Z is inverted. Probably due to left/right-hended definition of referential.
-            #displacements_curved[:, 0] = -displacements_curved[:, 0]
-            displacements_curved[:, 2] = -displacements_curved[:, 2]
-            displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-            coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, nearest_indexes_straight)
-            displacements_straight = coord_straight2curved - physical_coordinates_straight
-            # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
-            #displacements_straight[:, 0] = -displacements_straight[:, 0]
-            displacements_straight[:, 2] = -displacements_straight[:, 2]
-            displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-            # For error-free interpolation purpose, warping fields are inverted in the definition of ITK.
-            data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :] = -displacements_straight
-            data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
-
-            time_displacements = time.time() - time_displacements
-            sct.printv('Time to compute physical displacements: ' + str(np.round(time_displacements * 1000.0)) + ' ms', verbose)
-
-            # Creation of the safe zone based on pre-calculated safe boundaries
-            coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
-            coord_bound_straight_inf, coord_bound_straight_sup = image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
-
-            if radius_safe > 0:
-                data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
-                data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
-                data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
-                data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
-
-            # Generate warp files as a warping fields
-            hdr_warp_s.set_intent('vector', (), '')
-            hdr_warp_s.set_data_dtype('float32')
-            hdr_warp.set_intent('vector', (), '')
-            hdr_warp.set_data_dtype('float32')
-            img = Nifti1Image(data_warp_curved2straight, None, hdr_warp_s)
-            save(img, 'tmp.curve2straight.nii.gz')
-            sct.printv('\nDONE ! Warping field generated: tmp.curve2straight.nii.gz', verbose)
-
-            img = Nifti1Image(data_warp_straight2curved, None, hdr_warp)
-            save(img, 'tmp.straight2curve.nii.gz')
-            sct.printv('\nDONE ! Warping field generated: tmp.straight2curve.nii.gz', verbose)
+                from numpy import linspace
+                ix_straight = [int(np.round(nx_s / 2))] * number_of_points
+                iy_straight = [int(np.round(ny_s / 2))] * number_of_points
+                iz_straight = linspace(0, end_point_coord[2] - start_point_coord[2], number_of_points)
+                dx_straight = [0.0] * number_of_points
+                dy_straight = [0.0] * number_of_points
+                dz_straight = [1.0] * number_of_points
+                coord_straight = np.array(zip(ix_straight, iy_straight, iz_straight))
+                coord_phys_straight = np.asarray(image_centerline_straight.transfo_pix2phys(coord_straight))
+
+                centerline_straight = Centerline(coord_phys_straight[:, 0], coord_phys_straight[:, 1], coord_phys_straight[:, 2],
+                                                 dx_straight, dy_straight, dz_straight)
+
+
+                time_centerlines = time.time() - time_centerlines
+                sct.printv('Time to generate centerline: ' + str(np.round(time_centerlines * 1000.0)) + ' ms', verbose)
+
+                """
+                import matplotlib.pyplot as plt
+                curved_points = centerline.progressive_length
+                straight_points = centerline_straight.progressive_length
+                range_points = linspace(0, 1, number_of_points)
+                dist_curved = np.zeros(number_of_points)
+                dist_straight = np.zeros(number_of_points)
+                for i in range(1, number_of_points):
+                    dist_curved[i] = dist_curved[i - 1] + curved_points[i - 1] / centerline.length
+                    dist_straight[i] = dist_straight[i - 1] + straight_points[i - 1] / centerline_straight.length
+                plt.plot(range_points, dist_curved)
+                plt.plot(range_points, dist_straight)
+                plt.grid(True)
+                plt.show()
+                """
+
+                # Create volumes containing curved and straight warping fields
+                # 5. compute transformations
+                # Voxels are processed by slabs of slices to bound memory usage (see memory_limit). Warping fields are
+                # stored in float32 (as written on disk), in memory-mapped files if they do not fit in memory_limit.
+                time_generation_volumes = time.time()
+                size_warps = 4 * 3 * (nx * ny * nz + nx_s * ny_s * nz_s) / 1024.0 ** 2
+                use_memmap = size_warps > self.memory_limit / 2.0
+                data_warp_curved2straight = allocate_warp((nx_s, ny_s, nz_s, 1, 3), 'tmp.curve2straight.dat' if use_memmap else '')
+                data_warp_straight2curved = allocate_warp((nx, ny, nz, 1, 3), 'tmp.straight2curve.dat' if use_memmap else '')
+                time_generation_volumes = time.time() - time_generation_volumes
+                sct.printv('Time to generate volumes: ' + str(np.round(time_generation_volumes * 1000.0)) + ' ms', verbose)
+
+                # For error-free interpolation purpose, warping fields are inverted in the definition of ITK.
+                time_displacements = time.time()
+                # straight space --> curved space
+                self.compute_warp(image_centerline_straight, centerline_straight, centerline, data_warp_curved2straight, curved=False)
+                # curved space --> straight space
+                self.compute_warp(image_centerline_pad, centerline, centerline_straight, data_warp_straight2curved, curved=True)
+                time_displacements = time.time() - time_displacements
+                sct.printv('Time to compute physical displacements: ' + str(np.round(time_displacements * 1000.0)) + ' ms', verbose)
+
+                # Creation of the safe zone based on pre-calculated safe boundaries
+                coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
+                coord_bound_straight_inf, coord_bound_straight_sup = image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[0]]]), image_centerline_straight.transfo_phys2pix([[0, 0, bound_straight[1]]])
+
+                if radius_safe > 0:
+                    data_warp_curved2straight[:, :, 0:coord_bound_straight_inf[0][2], 0, :] = 100000.0
+                    data_warp_curved2straight[:, :, coord_bound_straight_sup[0][2]:, 0, :] = 100000.0
+                    data_warp_straight2curved[:, :, 0:coord_bound_curved_inf[0][2], 0, :] = 100000.0
+                    data_warp_straight2curved[:, :, coord_bound_curved_sup[0][2]:, 0, :] = 100000.0
+
+                # Generate warp files as a warping fields
+                hdr_warp_s.set_intent('vector', (), '')
+                hdr_warp_s.set_data_dtype('float32')
+                hdr_warp.set_intent('vector', (), '')
+                hdr_warp.set_data_dtype('float32')
+                img = Nifti1Image(data_warp_curved2straight, None, hdr_warp_s)
+                save(img, 'tmp.curve2straight.nii.gz')
+                sct.printv('\nDONE ! Warping field generated: tmp.curve2straight.nii.gz', verbose)
+
+                img = Nifti1Image(data_warp_straight2curved, None, hdr_warp)
+                save(img, 'tmp.straight2curve.nii.gz')
+                sct.printv('\nDONE ! Warping field generated: tmp.straight2curve.nii.gz', verbose)
+
+                # store warping fields and straight space in cache
+                if cache is not None:
+                    cache.put(key_cache, fname_warps)
 
             # Apply transformation to input image
             sct.printv('\nApply transformation to input image...', verbose)
@@ -550,16 +635,12 @@ class SpinalCordStraightener(object):
             Transform(input_filename='centerline.nii.gz', fname_dest="tmp.centerline_pad_crop.nii.gz",
                       output_filename="tmp.centerline_straight.nii.gz", interp="nn",
                       warp="tmp.curve2straight.nii.gz", verbose=verbose).apply()
-            from msct_image import Image
+            from msct_image import Image, average_coordinates_by_slice
             file_centerline_straight = Image('tmp.centerline_straight.nii.gz', verbose=verbose)
-            coordinates_centerline = file_centerline_straight.getNonZeroCoordinates(sorting='z')
-            mean_coord = []
-            for z in range(coordinates_centerline[0].z, coordinates_centerline[-1].z):
-                temp_mean = [coord.value for coord in coordinates_centerline if coord.z == z]
-                if temp_mean:
-                    mean_value = np.mean(temp_mean)
-                    mean_coord.append(np.mean([[coord.x * coord.value / mean_value, coord.y * coord.value / mean_value]
-                                                for coord in coordinates_centerline if coord.z == z], axis=0))
+            coordinates_centerline = file_centerline_straight.getNonZeroCoordinatesArray()
+            # center of mass of each slice (weighted by voxel value), last slice excluded
+            z_centerline, x_mean, y_mean = average_coordinates_by_slice(coordinates_centerline)
+            mean_coord = np.column_stack((x_mean, y_mean))[:-1]
 
             # compute error between the straightened centerline and the straight line.
             from math import sqrt
@@ -629,7 +710,11 @@ def get_parser():
     parser.usage.set_description("This program takes as input an anatomic image and the centerline or segmentation of "
                                  "its spinal cord (that you can get using sct_get_centerline.py or "
                                  "sct_segmentation_propagation) and returns the anatomic image where the spinal cord "
-                                 "was straightened.")
+                                 "was straightened.\n"
+                                 "Warping fields can be cached across runs: use flag -cache, or set the environment "
+                                 "variable SCT_STRAIGHTENING_CACHE to a folder. The size of the cache is limited by flag "
+                                 "-cache-size, or by the environment variable SCT_STRAIGHTENING_CACHE_SIZE (in MB, "
+                                 "default: 2000): least recently used warping fields are removed first.")
     parser.add_option(name="-i",
                       type_value="image_nifti",
                       description="input image.",
@@ -685,7 +770,8 @@ def get_parser():
                       description="Parameters for spinal cord straightening. Separate arguments with ','."
                                   "\nalgo_fitting: {hanning,nurbs} algorithm for curve fitting. Default=nurbs"
                                   "\nprecision: [1.0,inf[. Precision factor of straightening, related to the number of slices. Increasing this parameter increases the precision along with a loss of time. Is not taken into account with hanning fitting method. Default=2.0"
-                                  "\nthreshold_distance: [0.0,inf[. Threshold for which voxels are not considered into displacement. Increase this threshold if the image is blackout around the spinal cord too much. Default=1.0",
+                                  "\nthreshold_distance: [0.0,inf[. Threshold for which voxels are not considered into displacement. Increase this threshold if the image is blackout around the spinal cord too much. Default=1.0"
+                                  "\nmemory_limit: ]0,inf[. Approximate memory (in MB) used to compute warping fields. Voxels are processed by slabs of slices that fit in this memory. Default=2048",
                       mandatory=False,
                       example="algo_fitting=nurbs")
     parser.add_option(name="-params",
@@ -697,6 +783,21 @@ def get_parser():
                       mandatory=False,
                       deprecated_by='-param')
 
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for computing warping fields. 0 or 1: no multiprocessing.",
+                      mandatory=False,
+                      example="8")
+    parser.add_option(name="-cache",
+                      type_value="str",
+                      description="Folder where warping fields are cached across runs (created if it does not exist). Default: environment variable SCT_STRAIGHTENING_CACHE, if set (no cache otherwise).",
+                      mandatory=False,
+                      example="~/.sct_cache/straightening")
+    parser.add_option(name="-cache-size",
+                      type_value="float",
+                      description="Maximum size of the cache, in MB. Default: environment variable SCT_STRAIGHTENING_CACHE_SIZE, if set, 2000 otherwise.",
+                      mandatory=False,
+                      example="5000")
     parser.add_option(name='-qc',
                       type_value='multiple_choice',
                       description='Output images for quality control.',
@@ -730,8 +831,12 @@ if __name__ == "__main__":
         sc_straight.path_output = './'
     if "-v" in arguments:
         sc_straight.verbose = int(arguments["-v"])
-    # if "-cpu-nb" in arguments:
-    #     sc_straight.cpu_number = int(arguments["-cpu-nb"])
+    if "-cpu-nb" in arguments:
+        sc_straight.cpu_number = int(arguments["-cpu-nb"])
+    if "-cache" in arguments:
+        sc_straight.path_cache = arguments["-cache"]
+    if "-cache-size" in arguments:
+        sc_straight.cache_size = float(arguments["-cache-size"])
     if '-qc' in arguments:
         sc_straight.qc = int(arguments['-qc'])
 
@@ -749,5 +854,7 @@ if __name__ == "__main__":
                 sc_straight.precision = float(param_split[1])
             if param_split[0] == 'threshold_distance':
                 sc_straight.threshold_distance = float(param_split[1])
+            if param_split[0] == 'memory_limit':
+                sc_straight.memory_limit = float(param_split[1])
 
     sc_straight.straighten()
@@ -22,6 +22,7 @@ import commands
 import subprocess
 import re
 from sys import stdout
+from contextlib import contextmanager
 
 # TODO: under run(): add a flag "ignore error" for isct_ComposeMultiTransform
 # TODO: check if user has bash or t-schell for fsloutput definition
@@ -335,8 +336,8 @@ def check_if_3d(fname):
     :param fname:
     :return: True or False
     """
-    from msct_image import Image
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname).dim
+    from msct_image import ImageMetadata
+    nx, ny, nz, nt, px, py, pz, pt = ImageMetadata(fname).dim
     if not nt == 1:
         printv('\nERROR: '+fname+' is not a 3D volume. Exit program.\n', 1, 'error')
     else:
@@ -346,8 +347,8 @@ def check_if_3d(fname):
 # check_if_rpi:  check if data are in RPI orientation
 #=======================================================================================================================
 def check_if_rpi(fname):
-    from sct_image import get_orientation_3d
-    if not get_orientation_3d(fname, filename=True) == 'RPI':
+    from msct_image import ImageMetadata
+    if not ImageMetadata(fname).orientation == 'RPI':
         printv('\nERROR: '+fname+' is not in RPI orientation. Use sct_image -setorient to reorient your data. Exit program.\n', 1, 'error')
 
 
@@ -478,15 +479,14 @@ def check_if_installed(cmd, name_software):
 #=======================================================================================================================
 # check if two images are in the same space and same orientation
 def check_if_same_space(fname_1, fname_2):
-    from msct_image import Image
+    from msct_image import ImageMetadata
     from numpy import min, nonzero, all, around
     from numpy import abs as np_abs
     from numpy import log10 as np_log10
 
-    im_1 = Image(fname_1)
-    im_2 = Image(fname_2)
-    q1 = im_1.hdr.get_qform()
-    q2 = im_2.hdr.get_qform()
+    # only headers are read
+    q1 = ImageMetadata(fname_1).hdr.get_qform()
+    q2 = ImageMetadata(fname_2).hdr.get_qform()
 
     dec = int(np_abs(round(np_log10(min(np_abs(q1[nonzero(q1)]))))) + 1)
     dec = 4 if dec > 4 else dec
@@ -612,6 +612,48 @@ def template_dict(template):
     return dict_template
 
 
+#=======================================================================================================================
+# pool of worker processes
+#=======================================================================================================================
+def init_worker(initializer=None, initargs=()):
+    """
+    Initialization of the worker processes of process_pool(): workers ignore SIGINT (Ctrl+C is handled by the parent
+    process, which terminates the pool), then initializer(*initargs) is called, if any.
+    """
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+@contextmanager
+def process_pool(cpu_number, initializer=None, initargs=()):
+    """
+    Pool of worker processes, used as a context manager. If an exception is raised (in a worker, while consuming the
+    results or by Ctrl+C), the pool is terminated before the exception is propagated. Otherwise, it is closed. In both
+    cases, worker processes are joined.
+    Data needed by the workers should be passed through initializer/initargs (e.g., to set module-level variables in
+    the workers), so that it does not depend on the start method of the processes.
+    Example:
+        with process_pool(4) as pool:
+            for res in pool.imap_unordered(func, list_args):
+                ...
+    :param cpu_number: number of processes
+    :param initializer: function called at the start of each worker process, with arguments initargs
+    :return: multiprocessing.Pool
+    """
+    from multiprocessing import Pool
+    pool = Pool(processes=cpu_number, initializer=init_worker, initargs=(initializer, initargs))
+    try:
+        yield pool
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 class UnsupportedOs(Exception):
     def __init__(self, value):
         self.value = value
@@ -45,11 +45,62 @@ def test(data_path):
     status += s
     output += o
 
+    # test Python engine (-native 1): output should be close to the one of ANTs
+    fname_ants, fname_native = 'template_ants.nii.gz', 'template_native.nii.gz'
+    cmd_base = 'sct_apply_transfo -i ' + data_path + folder_data[0] + file_data[0] \
+               + ' -d ' + data_path + folder_data[1] + file_data[1] \
+               + ' -x linear'
+    for cmd in [cmd_base + ' -w ' + data_path + folder_data[1] + file_data[2] + ' -o ' + fname_ants,
+                cmd_base + ' -w ' + data_path + folder_data[1] + file_data[2] + ' -o ' + fname_native + ' -native 1']:
+        output += cmd+'\n'  # copy command
+        s, o = commands.getstatusoutput(cmd)
+        status += s
+        output += o
+    if status == 0:
+        s, o = check_native(fname_native, fname_ants, threshold=0.05)
+        status += s
+        output += o
+
+    # test fallback of the Python engine to ANTs for unsupported transformations (here: Euler transformation)
+    fname_euler = 'euler.txt'
+    open(fname_euler, 'w').write('#Insight Transform File V1.0\n'
+                                 '#Transform 0\n'
+                                 'Transform: Euler3DTransform_double_3_3\n'
+                                 'Parameters: 0 0 0 0 0 0\n'
+                                 'FixedParameters: 0 0 0 0\n')
+    fname_ants, fname_native = 'euler_ants.nii.gz', 'euler_native.nii.gz'
+    for cmd in [cmd_base + ' -w ' + fname_euler + ' -o ' + fname_ants,
+                cmd_base + ' -w ' + fname_euler + ' -o ' + fname_native + ' -native 1']:
+        output += cmd+'\n'  # copy command
+        s, o = commands.getstatusoutput(cmd)
+        status += s
+        output += o
+    if status == 0:
+        s, o = check_native(fname_native, fname_ants, threshold=0)
+        status += s
+        output += o
+
     # return
     #return sct.run(cmd, 0)
     return status, output
 
 
+def check_native(fname_native, fname_ants, threshold=0.05):
+    """
+    Compare the output of the Python engine with the output of ANTs.
+    :param threshold: maximum relative difference (L2 norm)
+    """
+    from msct_image import Image
+    from numpy.linalg import norm
+    data_native, data_ants = Image(fname_native).data, Image(fname_ants).data
+    if data_native.shape != data_ants.shape:
+        return 99, '\nWARNING: '+fname_native+' and '+fname_ants+' do not have the same dimensions'
+    diff = norm(data_native - data_ants) / max(norm(data_ants), 1e-6)
+    if diff > threshold:
+        return 99, '\nWARNING: relative difference between '+fname_native+' and '+fname_ants+' = '+str(diff)+' > '+str(threshold)
+    return 0, '\nRelative difference between '+fname_native+' and '+fname_ants+' = '+str(diff)
+
+
 if __name__ == "__main__":
     # call main function
     test()
\ No newline at end of file
@@ -21,14 +21,46 @@ def test(path_data):
     file_data = ['dmri.nii.gz', 'bvecs.txt']
 
 
+    output = ''
+    status = 0
+
+    cmd = 'sct_dmri_moco -i ' + path_data + folder_data + file_data[0] \
+                + ' -bvec '+ path_data + folder_data + file_data[1] \
+                + ' -v 1'\
+                + ' -g 3'\
+                + ' -r 0'\
+                + ' -x spline'
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    # apply motion parameters of the previous run (no estimation, bvecs not needed)
+    cmd = 'sct_dmri_moco -i ' + path_data + folder_data + file_data[0] \
+                + ' -mat dmri_moco_params.npz'\
+                + ' -ofolder dmri_moco_mat/'\
+                + ' -v 1'\
+                + ' -x spline'
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    # volumes registered in parallel
     cmd = 'sct_dmri_moco -i ' + path_data + folder_data + file_data[0] \
                 + ' -bvec '+ path_data + folder_data + file_data[1] \
                 + ' -v 1'\
                 + ' -g 3'\
+                + ' -cpu-nb 2'\
+                + ' -ofolder dmri_moco_cpu/'\
                 + ' -r 0'\
                 + ' -x spline'
+    output += cmd+'\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
 
-    return commands.getstatusoutput(cmd)
+    return status, output
 
 
 if __name__ == "__main__":
@@ -32,9 +32,52 @@ def test(path_data):
         ' -o quantif_'+file_data[0]+ \
         ' -v 1'
 
+    status, output = commands.getstatusoutput(cmd)
+
+    # compare the one-pass estimation in all vertebral levels with the estimation in each level
+    if status == 0:
+        s, o = check_per_level(path_data+folder_data[0]+file_data[0], path_data+folder_data[0]+folder_data[1]+'/')
+        status += s
+        output += o
+
     # return
     #return sct.run(cmd, 0)
-    return commands.getstatusoutput(cmd)
+    return status, output
+
+
+def check_per_level(fname_data, path_label, threshold=1e-6):
+    """
+    Compare the estimation in all vertebral levels at once (methods wa, bin and wath) with the estimation in each level
+    separately, for one metric and for several metrics.
+    :param threshold: maximum absolute difference
+    """
+    import numpy as np
+    import nibabel as nib
+    import sct_utils as sct
+    from msct_atlas import SparseAtlas
+    from sct_extract_metric import Param, read_label_file, get_slices_per_level, extract_metric, extract_metric_per_level
+    indiv_labels_ids, indiv_labels_names, indiv_labels_files, combined_labels_ids, combined_labels_names, combined_labels_id_groups = read_label_file(path_label, Param().file_info_label)
+    labels = SparseAtlas.load([path_label+fname for fname in indiv_labels_files], verbose=0)
+    data = np.float64(nib.load(fname_data).get_data())
+    data[np.logical_or(data < 0, np.isnan(data))] = 0
+    fname_vertebral_labeling = sct.find_file_within_folder('*_levels.nii.gz', path_label+'..')[0]
+    slices_per_level = get_slices_per_level(nib.load(fname_vertebral_labeling).get_data())
+    list_levels = sorted(slices_per_level.keys())
+    output = ''
+    for data_metrics in [data, np.array([data, 2*data+1])]:
+        for method in ['wa', 'bin', 'wath']:
+            results = extract_metric_per_level(method, data_metrics, labels, slices_per_level, list_levels, indiv_labels_ids, combined_labels_id_groups)
+            for level, result_level in zip(list_levels, results):
+                slices_list = range(slices_per_level[level][0], slices_per_level[level][1]+1)
+                data_level, labels_level = data_metrics[..., slices_list], labels.select_slices(slices_list)
+                result_expected = list(extract_metric(method, data_level, labels_level, indiv_labels_ids))
+                result_combined = [extract_metric(method, data_level, labels_level, indiv_labels_ids, combined_labels_id_group=group) for group in combined_labels_id_groups]
+                result_expected += [[result_group[i] for result_group in result_combined] for i in range(3)]
+                diff = max([np.max(np.abs(np.hstack(a).astype(float) - np.hstack(b).astype(float))) for a, b in zip(result_level, result_expected) if len(a)])
+                if diff > threshold:
+                    return 99, '\nWARNING: method '+method+', level '+str(level)+': difference with the estimation in each level = '+str(diff)+' > '+str(threshold)
+            output += '\nMethod '+method+' ('+str(data_metrics.ndim-2)+' metric(s)): same results in all vertebral levels'
+    return 0, output
 
 
 # call to function
@@ -34,6 +34,20 @@ def test(path_data):
     status += s
     output += o
 
+    # volumes registered in parallel
+    cmd = 'sct_fmri_moco -i ' + path_data + folder_data + file_data[0] \
+                + ' -g 5' \
+                + ' -x spline' \
+                + ' -cpu-nb 2' \
+                + ' -ofolder fmri_moco_cpu/' \
+                + ' -r 0' \
+                + ' -v 1'
+    output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
     return status, output
 
 if __name__ == "__main__":
@@ -14,7 +14,7 @@ import sct_utils as sct
 import sys
 # from msct_parser import Parser
 import sct_label_vertebrae
-from pandas import DataFrame
+from pandas import DataFrame, concat
 import os.path
 from copy import deepcopy
 
@@ -31,6 +31,8 @@ def test(path_data='', parameters=''):
     max_dist = float('NaN')
     diff_manual_result = float('NaN')
 
+    # with default parameters, the global search of discs is also tested (see end of function)
+    test_global = not parameters
     if not parameters:
         parameters = '-i t2/t2.nii.gz -s t2/t2_seg.nii.gz -c t2 -initfile t2/init_label_vertebrae.txt'
 
@@ -173,6 +175,13 @@ def test(path_data='', parameters=''):
     from sct_testing import write_to_log_file
     write_to_log_file(fname_log, output, 'w')
 
+    # test global search of discs, with the same thresholds
+    if test_global:
+        status_global, output_global, results_global = test(path_data, parameters + ' -method global')
+        status = max(status, status_global)
+        output += output_global
+        results = concat([results, results_global.drop('output', axis=1).add_suffix(' (global)')], axis=1)
+
     return status, output, results
 
 if __name__ == "__main__":
@@ -48,6 +48,28 @@ def test(path_data):
     status, o = sct.run(cmd, 0)
     output += o
 
+    # batch mode: the same segmentation twice, processed in parallel, results appended to one table
+    fname_list = 'list_seg.txt'
+    open(fname_list, 'w').write('# batch CSA\n' + (path_data + folder_data + file_data + '\n') * 2)
+    fname_table = 'csa_batch.csv'
+    cmd = 'sct_process_segmentation -p csa' \
+          + ' -batch ' + fname_list \
+          + ' -table ' + fname_table \
+          + ' -cpu-nb 2' \
+          + ' -size 1'\
+          + ' -v 1'
+    output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+    status_batch, o = sct.run(cmd, 0)
+    output += o
+    if status_batch == 0:
+        import csv
+        rows = list(csv.DictReader(open(fname_table, 'rb')))
+        filenames = set([row['filename'] for row in rows])
+        if len(filenames) != 1 or len(rows) % 2:
+            status_batch = 99
+            output += '\nWARNING: unexpected rows in ' + fname_table + ' (' + str(len(rows)) + ' rows)'
+    status = max(status, status_batch)
+
     return status, output
 
 if __name__ == "__main__":
@@ -14,7 +14,7 @@
 # import commands
 # import sys
 import os
-from pandas import DataFrame
+from pandas import DataFrame, concat
 import sct_segment_graymatter
 # from msct_image import Image
 import sct_utils as sct
@@ -28,6 +28,8 @@ from sct_warp_template import get_file_label
 
 def test(path_data, parameters=''):
 
+    # with default parameters, the index of the dictionary slices is also tested (see end of function)
+    test_slice_index = not parameters
     if not parameters:
         # get file name of vertebral labeling from template
         file_vertfile = get_file_label(path_data+'mt/label/template', 'vertebral', output='file')
@@ -149,9 +151,45 @@ def test(path_data, parameters=''):
     # transform results into Pandas structure
     results = DataFrame(data={'status': status, 'output': output, 'dice_gm': result_dice_gm, 'dice_wm': result_dice_wm, 'hausdorff': result_hausdorff, 'med_dist': result_median_dist, 'duration_[s]': duration}, index=[path_data])
 
+    # test index of the dictionary slices, with the same thresholds
+    if test_slice_index:
+        status_index, output_index, results_index = test(path_data, parameters + ' -slice-index 1')
+        s, o = check_slice_index()
+        status = max(status, status_index, s)
+        output += output_index + o
+        results = concat([results, results_index.drop('output', axis=1).add_suffix(' (slice index)')], axis=1)
+
     return status, output, results
 
 
+def check_slice_index(nb_targets=10):
+    """
+    Compare the model similarities (beta) computed with the index of the dictionary slices with the ones computed with
+    all the dictionary slices. The slices that are not compared to the target account for less than epsilon of the
+    partition function, so that the sum of absolute differences is below 2*epsilon.
+    :param nb_targets: number of target slices, built from pairs of dictionary slices
+    """
+    import numpy as np
+    from msct_multiatlas_seg import Model, ModelParam
+    model_param = ModelParam()
+    model_param.use_slice_index = True
+    model_param.verbose = 0
+    model = Model(model_param=model_param)
+    dataset_coord = model.pca.dataset_coord.T
+    dataset_levels = [dic_slice.level for dic_slice in model.dictionary.slices]
+    # targets: midpoints between dictionary slices, with the level of the first slice
+    ind = np.linspace(0, len(dataset_levels)-1, nb_targets).astype(int)
+    coord_target = (np.asarray(dataset_coord)[ind] + np.asarray(dataset_coord)[ind[::-1]]) / 2.
+    target_levels = np.asarray(dataset_levels)[ind]
+    beta_index = model.compute_beta(coord_target, target_levels=target_levels, tau=model.tau)
+    # giving the coordinates of the dictionary slices skips the index
+    beta = model.compute_beta(coord_target, target_levels=target_levels, dataset_coord=dataset_coord, dataset_levels=dataset_levels, tau=model.tau)
+    diff = np.abs(beta_index - beta).sum(axis=1).max()
+    if diff > 2*model.epsilon:
+        return 99, '\nWARNING: difference of similarities with the index of the dictionary slices = '+str(diff)+' > '+str(2*model.epsilon)
+    return 0, '\nDifference of similarities with the index of the dictionary slices = '+str(diff)+' (<= '+str(2*model.epsilon)+')'
+
+
 if __name__ == "__main__":
     # call main function
     test(path_sct+'/data')
@@ -49,6 +49,7 @@ def test(path_data='', parameters=''):
     else:
         subject_folder = subject_folder[-1]
     path_output = sct.slash_at_the_end('sct_straighten_spinalcord_' + subject_folder + '_' + time.strftime("%y%m%d%H%M%S") + '_'+str(random.randint(1, 1000000)), slash=1)
+    param_with_path_init = param_with_path
     param_with_path += ' -ofolder ' + path_output
 
     # run command
@@ -95,6 +96,27 @@ def test(path_data='', parameters=''):
             status = 99
             output += '\nWARNING: DICE = '+str(result_dice)+' < '+str(th_dice)
 
+        # multiprocessing: warping fields computed by several processes, by slabs of a few slices (small memory_limit),
+        # must be identical to the ones computed by one process (cache disabled to force the computation)
+        if '-cpu-nb' not in dict_param and '-param' not in dict_param:
+            path_output_cpu = sct.slash_at_the_end(path_output[:-1] + '_cpu', slash=1)
+            cmd = 'SCT_STRAIGHTENING_CACHE= sct_straighten_spinalcord ' + param_with_path_init + ' -ofolder ' + path_output_cpu + ' -cpu-nb 2 -param memory_limit=1'
+            output += '\n' + cmd + '\n'
+            try:
+                status_cpu, o = sct.run(cmd, 0)
+            except:
+                status_cpu, o = 1, 'ERROR: Function crashed with -cpu-nb 2!'
+            output += o
+            if status_cpu != 0:
+                status = status_cpu
+            else:
+                from msct_image import Image
+                from numpy import array_equal
+                for fname_warp in ['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz']:
+                    if not array_equal(Image(path_output + fname_warp).data, Image(path_output_cpu + fname_warp).data):
+                        status = 99
+                        output += '\nWARNING: ' + fname_warp + ' differs when computed with -cpu-nb 2'
+
     # transform results into Pandas structure
     results = DataFrame(data={'status': int(status), 'output': output, 'rmse': result_rmse, 'dist_max': result_dist_max, 'dice': result_dice, 'duration': duration}, index=[path_data])
 